@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+End-to-end crawl benchmark for download.py against the local stub server.
+
+Starts benchmarks/stub_innsyn.py in-process, crawls a range of dates with
+process_date/process_case into a temporary archive, and reports cases/sec,
+MB/sec, peak RSS and per-phase latencies. Nothing touches the real kommune
+sites. The crawl runs with download.py's default --rate and --burst, as a
+real crawl would; --no-rate-limit measures the crawler alone.
+
+Usage:
+    python benchmarks/crawl_bench.py [--days 3] [--workers 4] [--latency 0.05] [--no-rate-limit]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import download  # noqa: E402
+from stub_innsyn import start_server  # noqa: E402
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark download.py against a local stub innsyn server.")
+    parser.add_argument("--days", type=int, default=3, help="Number of dates to crawl (default: 3).")
+    parser.add_argument("--cases-per-page", type=int, default=20, help="Cases on each postliste page (default: 20).")
+    parser.add_argument("--pages", type=int, default=2, help="Postliste pages per date (default: 2).")
+    parser.add_argument("--document-kb", type=int, default=256, help="Size of each document in KB (default: 256).")
+    parser.add_argument("--latency", type=float, default=0.02, help="Server latency per request in seconds (default: 0.02).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency of up to this many seconds (default: 0).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the server answers with 503 or 429 (default: 0).")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="download.py --workers (default: 1).")
+    parser.add_argument("--rate", type=float, default=download.DEFAULT_RATE, help=f"download.py --rate (default: {download.DEFAULT_RATE:g}).")
+    parser.add_argument("--burst", type=int, default=download.DEFAULT_BURST, help=f"download.py --burst (default: {download.DEFAULT_BURST}).")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Let the stub's latency be the only pacing, to measure the crawler itself.")
+    parser.add_argument("--parser", choices=["auto", "lxml", "html.parser"], default="auto", help="HTML parser backend (default: auto).")
+    parser.add_argument("--no-dedup", action="store_true", help="Store plain files instead of using the blob store.")
+    parser.add_argument("--packed", action="store_true", help="Pack finished cases into segment files (download.py --packed).")
+    parser.add_argument("--output", type=str, help="Archive directory to crawl into (default: a temporary directory that is removed).")
+    parser.add_argument("--json", type=str, help="Also write the results as JSON to this file.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the crawler's log output.")
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, cases_per_page=args.cases_per_page,
+                          pages_per_date=args.pages, document_size=args.document_kb * 1024)
+    output_dir = args.output or tempfile.mkdtemp(prefix="kommune-bench-")
+    download.KOMMUNE_CONFIG["bench"] = {
+        "base_url": f"http://127.0.0.1:{server.server_port}/innsyn.aspx",
+        "mid": "1",
+        "output_dir": output_dir,
+    }
+    if args.no_rate_limit:
+        download.configure_rate_limit(1e9, 1000)  # The stub's latency is the only pacing
+    else:
+        download.configure_rate_limit(args.rate, args.burst)
+    download.configure_page_cache(None)
+    download.configure_parser(args.parser)
+    download.configure_blob_store(not args.no_dedup)
+    download.configure_packed(args.packed)
+    download.configure_concurrency(args.workers)
+
+    start_date = datetime(2025, 1, 10)
+    stop_date = start_date + timedelta(days=args.days - 1)
+    started = time.perf_counter()
+    try:
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+            download.crawl_kommune("bench", start_date, stop_date, workers=args.workers)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+        if not args.output:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    counts, _ = download.get_crawl_stats(download.KOMMUNE_CONFIG["bench"]["base_url"]).snapshot()
+    megabytes = counts.get("bytes", 0) / (1024 * 1024)
+    phases = download.METRICS.summary()["phases"]
+    results = {
+        "days": args.days,
+        "workers": args.workers,
+        "latency_seconds": args.latency,
+        "rate_limit": None if args.no_rate_limit else args.rate,
+        "parser": download.HTML_PARSER,
+        "elapsed_seconds": round(elapsed, 3),
+        "cases": counts.get("cases", 0),
+        "documents": counts.get("documents", 0),
+        "megabytes": round(megabytes, 2),
+        "errors": counts.get("errors", 0),
+        "retries": counts.get("retries", 0),
+        "cases_per_second": round(counts.get("cases", 0) / elapsed, 2),
+        "megabytes_per_second": round(megabytes / elapsed, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "phase_avg_ms": {phase: round(p["avg_seconds"] * 1000, 2) for phase, p in phases.items()},
+    }
+
+    print(f"Crawled {results['cases']} cases and {results['documents']} documents ({megabytes:.1f} MB) "
+          f"in {elapsed:.2f} s with {args.workers} worker(s), {args.latency * 1000:.0f} ms latency, {download.HTML_PARSER}, "
+          f"{'no rate limit' if args.no_rate_limit else f'{args.rate:g} requests/sec per host'}")
+    print(f"  cases/sec:  {results['cases_per_second']:.2f}")
+    print(f"  MB/sec:     {results['megabytes_per_second']:.2f}")
+    print(f"  peak RSS:   {results['peak_rss_mb']:.1f} MB")
+    print(f"  errors:     {results['errors']}")
+    print(f"  retries:    {results['retries']}")
+    for phase, avg in results["phase_avg_ms"].items():
+        print(f"  {phase + ':':<19} {avg:8.2f} ms avg ({phases[phase]['count']} calls)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for case and postliste page parsing in download.py.
+
+Compares the old approach (the case page parsed twice with html.parser)
+with the single-pass extraction, with and without lxml.
+
+Usage:
+    python benchmarks/parse_bench.py [-n ITERATIONS]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import download  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CASE_URL = "https://vagan.kommune.no/innsyn.aspx?response=journalpost_detaljer&journalpostid=2021113419&scripturi=/innsyn.aspx&skin=infolink&Mid1=731&"
+BASE_URL = "https://vagan.kommune.no/innsyn.aspx"
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def legacy_case(case_html):
+    """The case page handling as it was: one parse for the IDs, one for details.txt."""
+    soup = BeautifulSoup(case_html, "html.parser")
+    arkivsak_row = soup.find("th", string=lambda x: x and "ArkivsakID" in x)
+    arkivsak_id = download.sanitize_string(arkivsak_row.find_next("td").get_text(separator=" ", strip=True))
+    tekstdokument = soup.find("h2", string="Tekstdokument")
+    soup.find("h2", string="Tekstdokument").find_next("ul", class_="innsyn_dok")
+    censor_text = tekstdokument.find_next("div", class_="content-text")
+
+    soup = BeautifulSoup(case_html, "html.parser")
+    table = soup.find("table", class_="table hh i-bgw two")
+    for row in table.find_all("tr"):
+        row.find("th").get_text(strip=True)
+        download.sanitize_string(row.find("td").get_text(strip=True))
+    soup.find("h2", string="Avsender(e)").find_next("div", class_="dokmottakere").get_text(separator="\n", strip=True)
+    return arkivsak_id, censor_text
+
+
+def legacy_listing(page_html):
+    soup = BeautifulSoup(page_html, "html.parser")
+    download.extract_case_links(soup, BASE_URL)
+    soup.find("a", string="neste")
+
+
+def single_pass_case(case_html):
+    record = download.extract_case_record(case_html, CASE_URL)
+    download.format_case_details(record, [name for _, name in record.documents])
+
+
+def single_pass_listing(page_html):
+    download.extract_listing(page_html, BASE_URL)
+
+
+def pages_per_second(func, pages, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for page in pages:
+            func(page)
+    elapsed = time.perf_counter() - start
+    return iterations * len(pages) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark case and postliste page parsing.")
+    parser.add_argument("-n", "--iterations", type=int, default=50, help="Passes over the fixtures per variant (default: 50).")
+    args = parser.parse_args()
+
+    case_pages = [read_fixture("journalpost_detaljer.html"), read_fixture("journalpost_detaljer_censored.html")]
+    listing_pages = [read_fixture("journalpost_postliste.html")]
+
+    variants = [("legacy (html.parser, parsed twice)", None, legacy_case, legacy_listing)]
+    backends = ["html.parser"]
+    if download.DEFAULT_HTML_PARSER == "lxml":
+        backends.append("lxml")
+    for backend in backends:
+        variants.append((f"single pass ({backend} + SoupStrainer)", backend, single_pass_case, single_pass_listing))
+
+    print(f"{'variant':<42} {'case pages/s':>14} {'postliste pages/s':>18}")
+    baseline = None
+    for label, backend, case_func, listing_func in variants:
+        if backend:
+            download.configure_parser(backend)
+        case_rate = pages_per_second(case_func, case_pages, args.iterations)
+        listing_rate = pages_per_second(listing_func, listing_pages, args.iterations)
+        if baseline is None:
+            baseline = case_rate
+        print(f"{label:<42} {case_rate:>14.1f} {listing_rate:>18.1f}  ({case_rate / baseline:.1f}x)")
+
+    if "lxml" not in backends:
+        print("\nlxml is not installed; install it with 'pip install lxml' to benchmark the faster backend.")
+
+
+if __name__ == "__main__":
+    main()
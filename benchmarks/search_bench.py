@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Benchmark for search_index.py on a large synthetic archive index.
+
+Builds a search index of generated cases, whose words follow a Zipf
+distribution over a vocabulary of made-up Norwegian-looking words, through
+the same indexing code as search_index.py update, and times date-ordered
+and ranked (BM25) searches for words from very common to rare, misspelt
+words and multi-word queries.
+
+Usage:
+    python benchmarks/search_bench.py [--cases 200000] [--terms 60] [--dir /tmp/search-bench]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search_index  # noqa: E402
+
+SYLLABLES = ["byg", "ge", "sak", "kle", "pp", "stad", "vei", "en", "fisk", "kar", "opp", "drett", "søk", "nad",
+             "til", "lat", "else", "sva", "r", "vå", "gan", "hav", "n", "ing", "plan", "reg", "ul", "er", "sjø",
+             "ber", "g", "mo", "ske", "nes", "lof", "ot", "fer", "je", "kom", "mune", "skol", "e", "and"]
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))))
+    return sorted(words, key=lambda word: (len(word), word))
+
+
+def build(directory, cases, terms_per_case, vocabulary_size, seed):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    rng.shuffle(vocabulary)
+    cum_weights = list(accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    index = search_index.SearchIndex(directory)
+    started = time.monotonic()
+    with index.lock:
+        for i in range(cases):
+            words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(terms_per_case // 2, terms_per_case * 3 // 2))
+            date = f"{2015 + i * 10 // cases}-{1 + i % 12:02d}-{1 + i % 28:02d}"
+            index._index_text(f"{date.replace('-', '/')}/{i} sak", 0.0, date, f"Sak {i}", " ".join(words))
+            if i % 5000 == 4999:
+                index.conn.commit()
+                print(f"\r  indexed {i + 1} cases", end="", flush=True)
+        index._refresh_impacts()
+        index.conn.commit()
+    print(f"\r  indexed {cases} cases in {time.monotonic() - started:.0f} s")
+    return index, vocabulary
+
+
+def misspell(word, rng):
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1:]
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results = function()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), max(times), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time searches on a large synthetic search index.")
+    parser.add_argument("--cases", type=int, default=200000, help="Cases in the index (default: 200000).")
+    parser.add_argument("--terms", type=int, default=60, help="Average words per case (default: 60).")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Distinct words (default: 50000).")
+    parser.add_argument("--dir", help="Keep the index in this directory and reuse it on later runs.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each query (default: 5).")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="search-bench-")
+    os.makedirs(directory, exist_ok=True)
+    index = search_index.SearchIndex(directory)
+    if index.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] != args.cases:
+        index.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        print(f"Building an index of {args.cases} cases in {directory}")
+        index, vocabulary = build(directory, args.cases, args.terms, args.vocabulary, args.seed)
+    else:
+        rng = random.Random(args.seed)
+        vocabulary = make_vocabulary(args.vocabulary, rng)
+        rng.shuffle(vocabulary)
+
+    rng = random.Random(args.seed + 1)
+    long_words = [word for word in vocabulary[:2000] if len(word) >= 8]
+    queries = [
+        ("most common word", vocabulary[0]),
+        ("common word (rank 20)", vocabulary[19]),
+        ("mid word (rank 1000)", vocabulary[999]),
+        ("rare word (rank 30000)", vocabulary[29999]),
+        ("misspelt word", misspell(long_words[5], rng)),
+        ("two common words", f"{vocabulary[0]} {vocabulary[1]}"),
+        ("common + mid word", f"{vocabulary[2]} {vocabulary[1500]}"),
+        ("prefix", vocabulary[3][:3]),
+    ]
+    print(f"{'query':26} {'words':28} {'date ms':>9} {'ranked ms':>10} {'max ms':>7}  hits")
+    for label, query in queries:
+        date_ms, _, date_results = timed(lambda: index.search_page(query, 20), args.repeat)
+        ranked_ms, ranked_max, ranked_results = timed(lambda: index.search_ranked_page(query, 20), args.repeat)
+        print(f"{label:26} {query[:28]:28} {date_ms:9.1f} {ranked_ms:10.1f} {ranked_max:7.1f}  {len(ranked_results[0])}")
+    index.close()
+    if not args.dir:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
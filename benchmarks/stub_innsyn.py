@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Local stub of a kommune innsyn.aspx server, serving the recorded pages in
+benchmarks/fixtures.
+
+Every date gets a postliste with the configured number of pages and cases
+per page. Case pages and documents are the recorded ones with the
+journalpostid rewritten, so every case and document is unique. Every
+request can be delayed to simulate server latency, and a share of the
+requests can be answered with 503 or 429 to exercise retries and backoff.
+
+Usage:
+    python benchmarks/stub_innsyn.py [--port 8765] [--latency 0.05]
+"""
+
+import os
+import re
+import time
+import random
+import argparse
+import threading
+import http.server
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def read_fixture(name, mode="r"):
+    with open(os.path.join(FIXTURES_DIR, name), mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        return f.read()
+
+
+class StubInnsyn:
+    """Renders postliste, case and document responses from the recorded fixtures."""
+
+    def __init__(self, cases_per_page=20, pages_per_date=2, censored_every=5, document_size=64 * 1024):
+        self.cases_per_page = cases_per_page
+        self.pages_per_date = pages_per_date
+        self.censored_every = censored_every
+        self.document_size = document_size
+        self.listing = read_fixture("journalpost_postliste.html")
+        self.case = read_fixture("journalpost_detaljer.html")
+        self.censored_case = read_fixture("journalpost_detaljer_censored.html")
+        self.document = read_fixture("document.pdf", "rb")
+
+        # Split the recorded listing around its case entries so we can repeat one entry
+        entries = list(re.finditer(r'\s*<div class="journalpost">.*?</div>', self.listing, re.S))
+        self.listing_head = self.listing[:entries[0].start()]
+        self.listing_entry = entries[0].group(0)
+        self.listing_tail = self.listing[entries[-1].end():]
+
+    def journalpostid(self, fradato, page, index):
+        day = int(fradato[:10].replace("-", ""))
+        return f"{day}{page:02d}{index:03d}"
+
+    def postliste(self, query):
+        fradato = query.get("fradato", ["2025-01-10T00:00:00"])[0]
+        page = int(query.get("page", ["1"])[0])
+        entries = []
+        for index in range(self.cases_per_page):
+            journalpostid = self.journalpostid(fradato, page, index)
+            entries.append(re.sub(r"journalpostid=\d+", f"journalpostid={journalpostid}", self.listing_entry))
+        tail = self.listing_tail
+        if page < self.pages_per_date:
+            tail = re.sub(r"page=\d+\">neste", f"page={page + 1}\">neste", tail)
+            tail = tail.replace("fradato=2025-01-10T00:00:00", f"fradato={fradato}")
+        else:
+            tail = re.sub(r'\s*<a [^>]*>neste</a>', "", tail)
+        return self.listing_head + "".join(entries) + tail
+
+    def case_page(self, query):
+        journalpostid = query.get("journalpostid", ["0"])[0]
+        censored = self.censored_every and int(journalpostid) % self.censored_every == 0
+        html = self.censored_case if censored else self.case
+        html = re.sub(r"journalpostid=\d+", f"journalpostid={journalpostid}", html)
+        return html.replace("Kleppstadveien 7", f"Kleppstadveien {journalpostid}")
+
+    def document_body(self, query):
+        """The recorded PDF padded to document_size, with a trailer that makes each document unique."""
+        trailer = f"%{query.get('dokid', [''])[0]}-{query.get('journalpostid', [''])[0]}\n".encode("ascii")
+        padding = max(0, self.document_size - len(self.document) - len(trailer))
+        lines, rest = divmod(padding, 64)
+        return self.document + (b"%" + b"0" * 62 + b"\n") * lines + b"%" * rest + trailer
+
+
+def make_handler(stub, latency=0.0, jitter=0.0, error_rate=0.0):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if latency or jitter:
+                time.sleep(latency + random.uniform(0, jitter))
+            if error_rate and random.random() < error_rate:
+                # Alternate between an overloaded server and one asking us to slow down
+                status = random.choice((503, 429))
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            query = parse_qs(urlparse(self.path).query)
+            response = query.get("response", [""])[0]
+            if response == "journalpost_postliste":
+                body, content_type = stub.postliste(query).encode("utf-8"), "text/html; charset=utf-8"
+            elif response == "journalpost_detaljer":
+                body, content_type = stub.case_page(query).encode("utf-8"), "text/html; charset=utf-8"
+            elif response == "journalpost_dokument":
+                body, content_type = stub.document_body(query), "application/pdf"
+            else:
+                self.send_error(404)
+                return
+
+            start, status = 0, 200
+            range_header = self.headers.get("Range")
+            if range_header and range_header.startswith("bytes="):
+                start = int(range_header[6:].split("-")[0] or 0)
+                status = 206
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body) - start))
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            self.end_headers()
+            self.wfile.write(body[start:])
+
+    return Handler
+
+
+def start_server(port=0, latency=0.0, jitter=0.0, error_rate=0.0, **stub_options):
+    """Start the stub server in a background thread and return it; server.server_port is the port."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), make_handler(StubInnsyn(**stub_options), latency, jitter, error_rate))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-innsyn", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded innsyn.aspx pages locally.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to delay every response (default: 0).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random delay of up to this many seconds (default: 0).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503 or 429 (default: 0).")
+    parser.add_argument("--cases-per-page", type=int, default=20, help="Cases on each postliste page (default: 20).")
+    parser.add_argument("--pages", type=int, default=2, help="Postliste pages per date (default: 2).")
+    parser.add_argument("--document-kb", type=int, default=64, help="Size of each document in KB (default: 64).")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.jitter, args.error_rate, cases_per_page=args.cases_per_page,
+                          pages_per_date=args.pages, document_size=args.document_kb * 1024)
+    print(f"Serving on http://127.0.0.1:{server.server_port}/innsyn.aspx")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
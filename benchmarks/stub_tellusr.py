@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Local stub of the TellusR API used by tellusr-upload.py.
+
+Implements update-many-docs, delete-docs and upload-file for any project.
+Metadata documents are kept in memory, and a document whose ID is already
+stored is answered with the same "Duplicate ID" error as TellusR, so the
+upload script's duplicate handling is exercised; with --allow-duplicates
+(or reject_duplicates=False) such documents overwrite the stored ones
+instead. Attachments are read and counted
+but not kept. Every request can be delayed to simulate server latency, and
+a share of the requests can be answered with 503 or 429 to exercise
+retries and backoff. GET /stats returns the counters as JSON.
+
+Usage:
+    python benchmarks/stub_tellusr.py [--port 8766] [--latency 0.05]
+    TELLUSR_URL=http://127.0.0.1:8766 TELLUSR_BASE_DIR=/path/to/archives python tellusr-upload.py
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import http.server
+from urllib.parse import urlparse, parse_qs
+
+
+class StubTellusr:
+    """In-memory document store with the counters the upload benchmark reports."""
+
+    def __init__(self, reject_duplicates=True):
+        self.reject_duplicates = reject_duplicates
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.stats = {"doc_requests": 0, "docs": 0, "duplicates": 0, "deleted": 0, "files": 0, "file_bytes": 0, "errors": 0}
+
+    def update_docs(self, body):
+        """Store a batch of documents; returns (status, message)."""
+        try:
+            docs = json.loads(body)["docs"]
+            ids = [doc["id"] for doc in docs]
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, f"Invalid request: {e}"
+        with self.lock:
+            self.stats["doc_requests"] += 1
+            if self.reject_duplicates:
+                seen = set()
+                for doc_id in ids:
+                    if doc_id in self.docs or doc_id in seen:
+                        self.stats["duplicates"] += 1
+                        return 400, f"Duplicate ID: {doc_id}"
+                    seen.add(doc_id)
+            self.docs.update(zip(ids, docs))
+            self.stats["docs"] += len(docs)
+        return 200, json.dumps({"updated": len(docs)})
+
+    def delete_docs(self, body):
+        """Delete documents by ID; unknown IDs are ignored. Returns (status, message)."""
+        try:
+            ids = json.loads(body)["ids"]
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, f"Invalid request: {e}"
+        with self.lock:
+            deleted = sum(self.docs.pop(doc_id, None) is not None for doc_id in ids)
+            self.stats["deleted"] += deleted
+        return 200, json.dumps({"deleted": deleted})
+
+    def upload_file(self, query, size):
+        """Count an uploaded attachment; returns (status, message)."""
+        if not query.get("id"):
+            return 400, "Missing id"
+        with self.lock:
+            self.stats["files"] += 1
+            self.stats["file_bytes"] += size
+        return 200, json.dumps({"id": query["id"][0]})
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, stored_docs=len(self.docs))
+
+    def documents(self):
+        with self.lock:
+            return list(self.docs.values())
+
+
+def make_handler(stub, latency=0.0, jitter=0.0, error_rate=0.0):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, status, message, content_type="application/json"):
+            body = message.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type if status == 200 else "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/stats":
+                self.send_error(404)
+                return
+            self.respond(200, json.dumps(stub.snapshot()))
+
+        def do_POST(self):
+            # Read the whole request first, so the connection can be reused whatever the answer
+            remaining = int(self.headers.get("Content-Length", 0))
+            chunks = []
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            body = b"".join(chunks)
+
+            if latency or jitter:
+                time.sleep(latency + random.uniform(0, jitter))
+            if error_rate and random.random() < error_rate:
+                with stub.lock:
+                    stub.stats["errors"] += 1
+                # Alternate between an overloaded server and one asking us to slow down
+                self.respond(random.choice((503, 429)), "Service unavailable")
+                return
+
+            url = urlparse(self.path)
+            if url.path.endswith("/update-many-docs"):
+                self.respond(*stub.update_docs(body))
+            elif url.path.endswith("/delete-docs"):
+                self.respond(*stub.delete_docs(body))
+            elif url.path.endswith("/upload-file"):
+                self.respond(*stub.upload_file(parse_qs(url.query), len(body)))
+            else:
+                self.send_error(404)
+
+    return Handler
+
+
+def start_server(port=0, latency=0.0, jitter=0.0, error_rate=0.0, **stub_options):
+    """Start the stub server in a background thread and return it; server.stub holds the documents and counters."""
+    stub = StubTellusr(**stub_options)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), make_handler(stub, latency, jitter, error_rate))
+    server.daemon_threads = True
+    server.stub = stub
+    threading.Thread(target=server.serve_forever, name="stub-tellusr", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stub of the TellusR upload API.")
+    parser.add_argument("--port", type=int, default=8766, help="Port to listen on (default: 8766).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to delay every response (default: 0).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random delay of up to this many seconds (default: 0).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503 or 429 (default: 0).")
+    parser.add_argument("--allow-duplicates", action="store_true", help="Replace documents with a known ID instead of answering Duplicate ID.")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.jitter, args.error_rate, reject_duplicates=not args.allow_duplicates)
+    print(f"Serving on http://127.0.0.1:{server.server_port} (set TELLUSR_URL to this address)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
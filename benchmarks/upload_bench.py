@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+End-to-end upload benchmark for tellusr-upload.py against the local stub server.
+
+Generates a synthetic archive of cases with details.txt and attachments,
+starts benchmarks/stub_tellusr.py in-process, points tellusr-upload.py at
+it through TELLUSR_URL and runs a full upload followed by a second,
+incremental run with nothing changed, and a third run after a sender is
+added to some cases, which must replace their documents on the server
+rather than add new ones. For that run the stub overwrites documents with
+a known ID, as update-many-docs does, unless --delete-before-replace is
+given: then it keeps answering Duplicate ID and the upload script deletes
+the old documents first (TELLUSR_DELETE_BEFORE_REPLACE). Reports docs/sec, attachment MB/sec, end-to-end
+time and peak RSS. Nothing is sent to a real TellusR server.
+
+Usage:
+    python benchmarks/upload_bench.py [--cases 2000] [--attachments 2] [--attachment-kb 256] [--latency 0.02] [--packed] [--delete-before-replace]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import random
+import resource
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))  # tellusr-upload.py imports segments
+from stub_tellusr import start_server  # noqa: E402
+from segments import SegmentStore, is_packed, pack  # noqa: E402
+
+UPLOAD_SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), "tellusr-upload.py")
+
+TITLES = ["Gbn 58/28 - Utskifting av oppdrettskar", "Feil i tvangsbegjæring", "Søknad om dispensasjon - Kleppstadveien",
+          "Reguleringsplan for Svolvær havn", "Tilsyn med skole", "Klage på vedtak om byggetillatelse"]
+
+# Sender added to the cases changed before the last run
+CHANGED_SENDER = "Ola Nordmann"
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def make_archive(base_dir, cases, attachments, attachment_kb, duplicate_every, seed):
+    """Write a synthetic archive-bench with the given number of cases; returns the bytes of attachments written."""
+    rng = random.Random(seed)
+    block = rng.randbytes(attachment_kb * 1024)
+    total = 0
+    for i in range(cases):
+        day = 1 + i % 28
+        journalpostid = f"202501{day:02d}{i:05d}"
+        # Every duplicate_every-th case reuses the previous case's DokumentID, as happens in the real archives
+        if i == 0 or not duplicate_every or i % duplicate_every:
+            title, arkivsak, dokument_id = rng.choice(TITLES), f"25/{100 + i // 10}", journalpostid
+        case_dir = os.path.join(base_dir, "archive-bench", "2025", "01", f"{day:02d}",
+                                f"{journalpostid} {arkivsak.replace('/', '_')} - {title.replace('/', '_')}")
+        os.makedirs(case_dir, exist_ok=True)
+        with open(os.path.join(case_dir, "details.txt"), "w", encoding="utf-8") as f:
+            f.write(f"DokumentID: {arkivsak}-{dokument_id} - {title}\n"
+                    f"ArkivsakID: {arkivsak} - {title}\n"
+                    f"Journaldato: {day:02d}.01.2025\n"
+                    f"Brevdato: {day:02d}.01.2025\n"
+                    f"Dokumentansvarlig: Kari Nordmann\n\n"
+                    f"Avsender(e):\nPolarsmolt AS\n")
+        for n in range(rng.randint(max(0, attachments - 1), attachments + 1)):
+            data = block + f"%{journalpostid}-{n}\n".encode("ascii")  # Unique content per attachment
+            with open(os.path.join(case_dir, f"Vedlegg {n + 1}.pdf"), "wb") as f:
+                f.write(data)
+            total += len(data)
+    return total
+
+
+def change_cases(archive_dir, changed):
+    """Add CHANGED_SENDER to changed cases spread over the archive, packed or not; returns the number changed."""
+    if not changed:
+        return 0
+    store = SegmentStore(archive_dir) if is_packed(archive_dir) else None
+    if store is not None:
+        case_dirs = [os.path.join(archive_dir, case_dir) for case_dir, _, _ in store.cases()]
+    else:
+        case_dirs = sorted(os.path.dirname(path) for path in glob.glob(os.path.join(archive_dir, "*", "*", "*", "*", "details.txt")))
+    chosen = case_dirs[::max(1, len(case_dirs) // changed)][:changed]
+    for case_dir in chosen:
+        if store is not None:
+            store.extract_case(os.path.relpath(case_dir, archive_dir))
+        with open(os.path.join(case_dir, "details.txt"), "a", encoding="utf-8") as f:
+            f.write(f"{CHANGED_SENDER}\n")
+        if store is not None:
+            store.add_case(case_dir)
+    if store is not None:
+        store.close()
+    return len(chosen)
+
+
+def load_upload_script():
+    spec = importlib.util.spec_from_file_location("tellusr_upload", UPLOAD_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed_run(upload, verbose):
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        upload.process_all_cases()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tellusr-upload.py against a local stub TellusR server.")
+    parser.add_argument("--cases", type=int, default=2000, help="Cases in the synthetic archive (default: 2000).")
+    parser.add_argument("--attachments", type=int, default=2, help="Average attachments per case (default: 2).")
+    parser.add_argument("--attachment-kb", type=int, default=256, help="Size of each attachment in KB (default: 256).")
+    parser.add_argument("--duplicate-every", type=int, default=50, help="Every Nth case reuses a DokumentID, 0 for none (default: 50).")
+    parser.add_argument("--latency", type=float, default=0.02, help="Server latency per request in seconds (default: 0.02).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency of up to this many seconds (default: 0).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the server answers with 503 or 429 (default: 0).")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Attachment upload workers, TELLUSR_WORKERS (default: 8).")
+    parser.add_argument("--batch", type=int, default=100, help="Metadata documents per update-many-docs request (default: 100).")
+    parser.add_argument("--changed", type=int, default=20, help="Cases changed before the last run, 0 for none (default: 20).")
+    parser.add_argument("--delete-before-replace", action="store_true",
+                        help="Replace changed documents with delete-docs and a new upload, TELLUSR_DELETE_BEFORE_REPLACE.")
+    parser.add_argument("--packed", action="store_true", help="Pack the archive into segment files (segments.py) before uploading.")
+    parser.add_argument("--output", type=str, help="Directory for the archive and sync state (default: a temporary directory that is removed).")
+    parser.add_argument("--json", type=str, help="Also write the results as JSON to this file.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the upload script's output.")
+    args = parser.parse_args()
+
+    work_dir = args.output or tempfile.mkdtemp(prefix="tellusr-bench-")
+    base_dir = os.path.join(work_dir, "archives")
+    sync_db = os.path.join(work_dir, "tellusr-sync.sqlite")
+    server = start_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    try:
+        shutil.rmtree(base_dir, ignore_errors=True)
+        if os.path.exists(sync_db):
+            os.remove(sync_db)
+        attachment_bytes = make_archive(base_dir, args.cases, args.attachments, args.attachment_kb, args.duplicate_every, args.seed)
+        if args.packed:
+            pack(os.path.join(base_dir, "archive-bench"))
+
+        os.environ.update({
+            "TELLUSR_URL": f"http://127.0.0.1:{server.server_port}",
+            "TELLUSR_PROJECT": "bench",
+            "TELLUSR_BASE_DIR": base_dir,
+            "TELLUSR_SYNC_DB": sync_db,
+            "TELLUSR_WORKERS": str(args.workers),
+            "TELLUSR_DELETE_BEFORE_REPLACE": "1" if args.delete_before_replace else "",
+        })
+        upload = load_upload_script()
+        upload.BATCH_MAX_DOCS = args.batch
+        upload.LOG_FILE = os.path.join(work_dir, "uploaded_cases.log")
+
+        elapsed = timed_run(upload, args.verbose)
+        stats = server.stub.snapshot()
+        incremental = timed_run(upload, args.verbose)
+        incremental_stats = server.stub.snapshot()
+        changed = change_cases(os.path.join(base_dir, "archive-bench"), args.changed)
+        server.stub.reject_duplicates = args.delete_before_replace
+        changed_elapsed = timed_run(upload, args.verbose)
+        changed_stats = server.stub.snapshot()
+        updated = sum(CHANGED_SENDER in document.get("authors", []) for document in server.stub.documents())
+    finally:
+        server.shutdown()
+        if not args.output:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    megabytes = attachment_bytes / (1024 * 1024)
+    results = {
+        "cases": args.cases,
+        "workers": args.workers,
+        "batch": args.batch,
+        "packed": args.packed,
+        "delete_before_replace": args.delete_before_replace,
+        "latency_seconds": args.latency,
+        "error_rate": args.error_rate,
+        "elapsed_seconds": round(elapsed, 3),
+        "docs": stats["docs"],
+        "doc_requests": stats["doc_requests"],
+        "duplicates": stats["duplicates"],
+        "files": stats["files"],
+        "megabytes": round(megabytes, 2),
+        "server_errors": stats["errors"],
+        "docs_per_second": round(stats["docs"] / elapsed, 2),
+        "megabytes_per_second": round(megabytes / elapsed, 2),
+        "incremental_seconds": round(incremental, 3),
+        "incremental_requests": incremental_stats["doc_requests"] + incremental_stats["files"] - stats["doc_requests"] - stats["files"],
+        "changed_cases": changed,
+        "changed_seconds": round(changed_elapsed, 3),
+        "changed_documents_updated": updated,
+        "stored_docs": stats["stored_docs"],
+        "stored_docs_after_change": changed_stats["stored_docs"],
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+    print(f"Uploaded {results['docs']} docs and {results['files']} attachments ({megabytes:.1f} MB) in {elapsed:.2f} s "
+          f"with {args.workers} worker(s), batches of {args.batch}, {args.latency * 1000:.0f} ms latency")
+    print(f"  docs/sec:       {results['docs_per_second']:.2f}")
+    print(f"  MB/sec:         {results['megabytes_per_second']:.2f}")
+    print(f"  doc requests:   {results['doc_requests']} ({results['duplicates']} duplicate ID answers)")
+    print(f"  server errors:  {results['server_errors']}")
+    print(f"  incremental:    {incremental:.2f} s, {results['incremental_requests']} requests")
+    print(f"  changed:        {changed} cases in {changed_elapsed:.2f} s, {updated} documents updated, "
+          f"{changed_stats['stored_docs']} documents on the server (was {stats['stored_docs']})")
+    print(f"  peak RSS:       {results['peak_rss_mb']:.1f} MB")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if updated != changed or changed_stats["stored_docs"] != stats["stored_docs"]:
+        sys.exit("Changed cases were not uploaded as updates of their documents")
+
+
+if __name__ == "__main__":
+    main()
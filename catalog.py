@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Structured catalog of an archive directory.
+
+download.py adds every case it writes to <output_dir>/catalog.sqlite, so
+other tools can query cases, senders and documents without walking the
+archive and re-parsing details.txt. The catalog for an existing archive can
+be (re)built from its details.txt files:
+
+    python catalog.py rebuild archive-vagan [archive-vestvagoy ...]
+
+Cases can be looked up by date range, sender, Dokumentansvarlig, ArkivsakID
+prefix and censorship through indexes on those fields:
+
+    python catalog.py query archive-vagan --from 2024-01-01 --to 2024-12-31 --sender "Polarsmolt"
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import unicodedata
+from urllib.parse import quote
+
+CATALOG_FILENAME = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    journalpostid TEXT PRIMARY KEY,
+    case_dir TEXT NOT NULL,
+    date TEXT,
+    dokument_id TEXT,
+    arkivsak_id TEXT,
+    journaldato TEXT,
+    brevdato TEXT,
+    dokumentansvarlig TEXT,
+    is_censored INTEGER NOT NULL DEFAULT 0,
+    censor_reason TEXT,
+    fields TEXT,
+    updated_at REAL,
+    dokumentansvarlig_key TEXT
+);
+CREATE TABLE IF NOT EXISTS senders (
+    journalpostid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    name_key TEXT,
+    PRIMARY KEY (journalpostid, position)
+);
+CREATE TABLE IF NOT EXISTS documents (
+    journalpostid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    mime_type TEXT,
+    url TEXT,
+    PRIMARY KEY (journalpostid, position)
+);
+"""
+
+# Created after the columns added to older catalogs (see Catalog._migrate) exist
+INDEXES = """
+DROP INDEX IF EXISTS cases_date;
+CREATE INDEX IF NOT EXISTS cases_order ON cases (date DESC, case_dir);
+CREATE INDEX IF NOT EXISTS cases_arkivsak_id ON cases (arkivsak_id);
+CREATE INDEX IF NOT EXISTS cases_dokumentansvarlig ON cases (dokumentansvarlig);
+CREATE INDEX IF NOT EXISTS cases_dokumentansvarlig_key ON cases (dokumentansvarlig_key, date);
+CREATE INDEX IF NOT EXISTS cases_updated_at ON cases (updated_at);
+CREATE INDEX IF NOT EXISTS senders_name ON senders (name);
+CREATE INDEX IF NOT EXISTS senders_name_key ON senders (name_key);
+CREATE INDEX IF NOT EXISTS documents_sha256 ON documents (sha256);
+"""
+
+# Upper bound for a prefix range: every string starting with the prefix sorts below prefix + this
+PREFIX_END = "\U0010ffff"
+
+
+def norwegian_date_to_iso(value):
+    """Convert a DD.MM.YYYY date to YYYY-MM-DD, returning None if it doesn't parse."""
+    try:
+        day, month, year = value.strip().split(".")
+        return f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+    except (AttributeError, ValueError):
+        return None
+
+
+def name_key(value):
+    """Casefolded form of a name, used to match senders and Dokumentansvarlig regardless of case and spacing."""
+    if value is None:
+        return None
+    return " ".join(unicodedata.normalize("NFC", value).casefold().split())
+
+
+def case_date_from_path(case_dir):
+    """Return YYYY-MM-DD for a case directory laid out as .../YYYY/MM/DD/<case>."""
+    parts = os.path.normpath(case_dir).split(os.sep)
+    if len(parts) >= 4 and all(p.isdigit() for p in parts[-4:-1]):
+        return f"{parts[-4]}-{parts[-3]}-{parts[-2]}"
+    return None
+
+
+def parse_details_text(text):
+    """Parse the contents of a details.txt file.
+
+    Returns a dict with the "fields" of the case table as (header, value)
+    pairs, the list of "senders", "is_censored" and "censor_reason", and the
+    "documents" file names listed at the end.
+    """
+    lines = text.split("\n")
+    fields = []
+    senders = []
+    documents = []
+    is_censored = False
+    censor_reason = None
+
+    i = 0
+    # Table fields, up to the first blank line
+    while i < len(lines) and lines[i].strip():
+        if ": " in lines[i]:
+            header, value = lines[i].split(": ", 1)
+            fields.append((header.strip(), value.strip()))
+        i += 1
+
+    rest = [line.strip() for line in lines[i:]]
+    j = 0
+    while j < len(rest):
+        line = rest[j]
+        if line == "Avsender(e):":
+            j += 1
+            while j < len(rest) and rest[j]:
+                senders.append(rest[j])
+                j += 1
+        elif line == "Tekstdokument":
+            is_censored = True
+            censor_reason = " ".join(x for x in rest[j + 1:] if x) or None
+            break
+        elif line:
+            documents.append(line)
+        j += 1
+
+    return {
+        "fields": fields,
+        "senders": senders,
+        "is_censored": is_censored,
+        "censor_reason": censor_reason,
+        "documents": documents,
+    }
+
+
+class Catalog:
+    """SQLite catalog of the cases in one archive directory."""
+
+    def __init__(self, output_dir, read_only=False):
+        """Open the catalog of an archive directory, creating or upgrading it unless read_only is set.
+
+        A read-only catalog must exist, and is used as it is: a catalog
+        written before the name key columns existed can't be queried by
+        sender or Dokumentansvarlig until it is opened for writing once.
+        """
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        path = os.path.join(output_dir, CATALOG_FILENAME)
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True, check_same_thread=False)
+            return
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+        self.conn.executescript(INDEXES)
+        self.conn.commit()
+
+    def has_name_keys(self):
+        """Whether the catalog has the name key columns sender and Dokumentansvarlig queries use."""
+        with self.lock:
+            case_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(cases)")}
+            sender_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(senders)")}
+        return "dokumentansvarlig_key" in case_columns and "name_key" in sender_columns
+
+    def _migrate(self):
+        """Add the name key columns to a catalog written before they existed, and fill them in."""
+        case_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(cases)")}
+        if "dokumentansvarlig_key" not in case_columns:
+            self.conn.execute("ALTER TABLE cases ADD COLUMN dokumentansvarlig_key TEXT")
+            rows = self.conn.execute("SELECT journalpostid, dokumentansvarlig FROM cases").fetchall()
+            self.conn.executemany("UPDATE cases SET dokumentansvarlig_key = ? WHERE journalpostid = ?",
+                                  [(name_key(name), journalpostid) for journalpostid, name in rows])
+        sender_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(senders)")}
+        if "name_key" not in sender_columns:
+            self.conn.execute("ALTER TABLE senders ADD COLUMN name_key TEXT")
+            rows = self.conn.execute("SELECT journalpostid, position, name FROM senders").fetchall()
+            self.conn.executemany("UPDATE senders SET name_key = ? WHERE journalpostid = ? AND position = ?",
+                                  [(name_key(name), journalpostid, position) for journalpostid, position, name in rows])
+
+    def record_case(self, journalpostid, case_dir, fields, senders, is_censored, censor_reason, documents):
+        """Add or replace a case.
+
+        fields are the (header, value) rows of the case table, senders a list
+        of names and documents a list of dicts with "name" and optionally
+        "size", "sha256", "mime_type" and "url".
+        """
+        values = dict(fields)
+        row = (
+            journalpostid,
+            os.path.relpath(case_dir, self.output_dir),
+            case_date_from_path(case_dir),
+            values.get("DokumentID"),
+            values.get("ArkivsakID"),
+            norwegian_date_to_iso(values.get("Journaldato")),
+            norwegian_date_to_iso(values.get("Brevdato")),
+            values.get("Dokumentansvarlig"),
+            1 if is_censored else 0,
+            censor_reason,
+            json.dumps(fields, ensure_ascii=False),
+            time.time(),
+            name_key(values.get("Dokumentansvarlig")),
+        )
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self.conn.execute("DELETE FROM senders WHERE journalpostid = ?", (journalpostid,))
+            self.conn.execute("DELETE FROM documents WHERE journalpostid = ?", (journalpostid,))
+            self.conn.executemany("INSERT INTO senders VALUES (?, ?, ?, ?)",
+                                  [(journalpostid, i, name, name_key(name)) for i, name in enumerate(senders)])
+            self.conn.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(journalpostid, i, doc["name"], doc.get("size"), doc.get("sha256"),
+                                    doc.get("mime_type"), doc.get("url"))
+                                   for i, doc in enumerate(documents)])
+            self.conn.commit()
+
+    def record_case_dir(self, case_dir):
+        """Add a case from the details.txt and files in its directory. Returns False if it isn't a case."""
+        journalpostid = os.path.basename(case_dir).split(" ", 1)[0]
+        details_file = os.path.join(case_dir, "details.txt")
+        if not journalpostid.isdigit() or not os.path.exists(details_file):
+            return False
+        with open(details_file, "r", encoding="utf-8") as f:
+            details = parse_details_text(f.read())
+        documents = []
+        for name in details["documents"]:
+            file_path = os.path.join(case_dir, name)
+            documents.append({"name": name, "size": os.path.getsize(file_path) if os.path.exists(file_path) else None})
+        self.record_case(journalpostid, case_dir, details["fields"], details["senders"],
+                         details["is_censored"], details["censor_reason"], documents)
+        return True
+
+    def record_packed_case(self, store, rel_dir):
+        """Add a case from the details.txt and files packed in a SegmentStore. Returns False if it isn't a case."""
+        journalpostid = os.path.basename(rel_dir).split(" ", 1)[0]
+        details_text = store.read(os.path.join(rel_dir, "details.txt"))
+        if not journalpostid.isdigit() or details_text is None:
+            return False
+        details = parse_details_text(details_text.decode("utf-8"))
+        packed_sizes = {name: size for name, size, _ in store.case(rel_dir)[1]}
+        documents = [{"name": name, "size": packed_sizes.get(name)} for name in details["documents"]]
+        self.record_case(journalpostid, os.path.join(self.output_dir, rel_dir), details["fields"], details["senders"],
+                         details["is_censored"], details["censor_reason"], documents)
+        return True
+
+    def query_cases(self, from_date=None, to_date=None, sender=None, dokumentansvarlig=None,
+                    arkivsak_prefix=None, censored=None, limit=50, after=None):
+        """Return up to limit cases matching every given filter, newest first.
+
+        Dates are inclusive YYYY-MM-DD bounds on the case date. sender and
+        dokumentansvarlig match names starting with the given text, ignoring
+        case; arkivsak_prefix matches the start of the ArkivsakID ("25/75");
+        censored=True/False keeps only censored or uncensored cases. With
+        after=(date, case_dir), only cases that sort after that one are
+        returned. Each filter is a range on its own index, so SQLite can
+        start from the most selective one instead of reading every case.
+
+        Results are dicts with journalpostid, case_dir (relative to the
+        archive directory), date, dokument_id, arkivsak_id,
+        dokumentansvarlig, is_censored and senders.
+        """
+        conditions, params = [], []
+        if from_date:
+            conditions.append("date >= ?")
+            params.append(from_date)
+        if to_date:
+            conditions.append("date <= ?")
+            params.append(to_date)
+        if sender:
+            key = name_key(sender)
+            conditions.append("journalpostid IN (SELECT journalpostid FROM senders WHERE name_key >= ? AND name_key < ?)")
+            params += [key, key + PREFIX_END]
+        if dokumentansvarlig:
+            key = name_key(dokumentansvarlig)
+            conditions.append("dokumentansvarlig_key >= ? AND dokumentansvarlig_key < ?")
+            params += [key, key + PREFIX_END]
+        if arkivsak_prefix:
+            conditions.append("arkivsak_id >= ? AND arkivsak_id < ?")
+            params += [arkivsak_prefix, arkivsak_prefix + PREFIX_END]
+        if censored is not None:
+            conditions.append("is_censored = ?")
+            params.append(1 if censored else 0)
+        if after is not None:
+            conditions.append("(date < ? OR (date = ? AND case_dir > ?))")
+            params += [after[0], after[0], after[1]]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.conn.execute("SELECT journalpostid, case_dir, date, dokument_id, arkivsak_id, dokumentansvarlig, is_censored "
+                                     f"FROM cases {where} ORDER BY date DESC, case_dir LIMIT ?", params + [limit]).fetchall()
+            senders = {}
+            for journalpostid, name in self.conn.execute(
+                    f"SELECT journalpostid, name FROM senders WHERE journalpostid IN ({', '.join('?' * len(rows))}) "
+                    "ORDER BY journalpostid, position", [row[0] for row in rows]):
+                senders.setdefault(journalpostid, []).append(name)
+        return [{"journalpostid": journalpostid, "case_dir": case_dir, "date": date, "dokument_id": dokument_id,
+                 "arkivsak_id": arkivsak_id, "dokumentansvarlig": dokumentansvarlig, "is_censored": bool(is_censored),
+                 "senders": senders.get(journalpostid, [])}
+                for journalpostid, case_dir, date, dokument_id, arkivsak_id, dokumentansvarlig, is_censored in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def rebuild(output_dir):
+    """Add every case under an archive directory, packed or not, to its catalog and return the number of cases."""
+    catalog = Catalog(output_dir)
+    added = 0
+    for root, dirs, files in os.walk(output_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        if "details.txt" in files and catalog.record_case_dir(root):
+            added += 1
+            dirs[:] = []
+    # Imported here because segments imports this module.
+    from segments import SegmentStore, is_packed
+    if is_packed(output_dir):
+        store = SegmentStore(output_dir)
+        for rel_dir, _, _ in store.cases():
+            if not os.path.exists(os.path.join(output_dir, rel_dir, "details.txt")) and catalog.record_packed_case(store, rel_dir):
+                added += 1
+        store.close()
+    catalog.close()
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the structured catalog of kommune archives.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Build the catalog from the details.txt files in an archive.")
+    rebuild_parser.add_argument("archives", nargs="+", help="Archive directories (e.g. archive-vagan).")
+    query_parser = subparsers.add_parser("query", help="List the cases in an archive matching the given filters, newest first.")
+    query_parser.add_argument("archive", help="Archive directory (e.g. archive-vagan).")
+    query_parser.add_argument("--from", dest="from_date", help="First date (YYYY-MM-DD).")
+    query_parser.add_argument("--to", dest="to_date", help="Last date (YYYY-MM-DD).")
+    query_parser.add_argument("--sender", help="Sender name, or the start of it.")
+    query_parser.add_argument("--dokumentansvarlig", help="Dokumentansvarlig name, or the start of it.")
+    query_parser.add_argument("--arkivsak", help="Start of the ArkivsakID, e.g. 25/75.")
+    query_parser.add_argument("--censored", action="store_true", default=None, help="Only censored cases.")
+    query_parser.add_argument("--uncensored", dest="censored", action="store_false", help="Only uncensored cases.")
+    query_parser.add_argument("--limit", type=int, default=50, help="Maximum number of cases (default: 50).")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        for archive in args.archives:
+            if not os.path.isdir(archive):
+                print(f"Error: {archive} is not a directory")
+                continue
+            print(f"{archive}: {rebuild(archive)} cases")
+    elif args.command == "query":
+        if not os.path.exists(os.path.join(args.archive, CATALOG_FILENAME)):
+            print(f"Error: {args.archive} has no {CATALOG_FILENAME}; build it with 'python catalog.py rebuild {args.archive}'")
+            return
+        catalog = Catalog(args.archive)
+        for case in catalog.query_cases(args.from_date, args.to_date, args.sender, args.dokumentansvarlig,
+                                        args.arkivsak, args.censored, args.limit):
+            print(f"{case['date']}  {case['case_dir']}")
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,40 @@
 import os
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from datetime import datetime, timedelta
 import time
-from random import randint
-from urllib.parse import urljoin
+import json
+import random
+import hashlib
+import sqlite3
+import socket
+import shutil
+import multiprocessing
+import http.server
+from contextlib import contextmanager
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from queue import Queue, Full
+from urllib.parse import urljoin, urlparse
+from email.utils import parsedate_to_datetime
 import sys
 import argparse
 import magic
+from requests.adapters import HTTPAdapter
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional, Tuple
+
+from catalog import Catalog
+from segments import SegmentStore, is_packed
+
+# lxml is optional; it is a considerably faster parser backend for BeautifulSoup
+try:
+    import lxml  # noqa: F401
+    DEFAULT_HTML_PARSER = "lxml"
+except ImportError:
+    DEFAULT_HTML_PARSER = "html.parser"
+HTML_PARSER = DEFAULT_HTML_PARSER
 
 # Supported kommune configurations
 KOMMUNE_CONFIG = {
@@ -38,14 +65,554 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
 }
 
+# Default location of the conditional-request cache for fetched pages
+DEFAULT_CACHE_DIR = "./.http-cache"
+
+# File name of the journalpostid -> case directory index kept in each output_dir
+CASE_INDEX_FILENAME = "case-index.sqlite"
+
+# Content-addressed document store kept in each output_dir
+BLOB_DIR_NAME = ".blobs"
+
+# Documents are streamed in chunks of this size; the MIME type is sniffed from the first bytes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MIME_SNIFF_BYTES = 4096
+PARTIAL_SUFFIX = ".part"
+
+# Postliste pages fetched ahead of the cases being processed
+PREFETCH_PAGES = 2
+
+# Work queue defaults: attempts before a unit is marked failed, and how long a claim is held. A worker
+# renews its claim this many times per lease while it works on the unit, so only a dead worker's claim expires
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_LEASE_SECONDS = 30 * 60
+LEASE_RENEWALS = 3
+
+# File systems a work queue can't be kept on, since SQLite's WAL journal needs shared memory
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "9p", "fuse.sshfs", "ceph", "glusterfs", "lustre")
+
+# Upper bounds in seconds of the per-phase latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEFAULT_METRICS_INTERVAL = 15
+
+# Address the metrics endpoint listens on; only this machine can scrape it unless --metrics-host says otherwise
+DEFAULT_METRICS_HOST = "127.0.0.1"
+
+# Default politeness: sustained requests per second and burst size per host. One worker seldom gets
+# above this against the real servers, so it only caps the extra speed of --workers
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 10
+
+# Requests that time out, or get one of these statuses, are retried with jittered exponential backoff
+DEFAULT_MAX_RETRIES = 4
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
+RETRY_AFTER_MAX = 300.0
+REQUEST_TIMEOUT = (10, 60)
+
+# Adaptive concurrency: a response slower than LATENCY_TOLERANCE times the fastest one seen
+# from a host (plus LATENCY_SLACK seconds) counts as a sign of an overloaded server
+LATENCY_TOLERANCE = 3.0
+LATENCY_SLACK = 0.25
+
+# Set on Ctrl-C so crawl loops and retry waits stop early
+_stop_requested = threading.Event()
+
+_log_lock = threading.Lock()
+_log_context = threading.local()
+
 def log(message):
-    """Log a message."""
-    print(message)
+    """Log a message, prefixed with the current thread's kommune when crawling several."""
+    prefix = getattr(_log_context, "prefix", "")
+    with _log_lock:
+        print(prefix + message)
+
+def set_log_prefix(prefix):
+    """Set the prefix used by log() in the calling thread."""
+    _log_context.prefix = prefix
+
+class CrawlStats:
+    """Thread-safe counters for one host's crawl, used for the throughput summary."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counts = {"dates": 0, "pages": 0, "cases": 0, "documents": 0, "bytes": 0, "errors": 0}
+
+    def add(self, key, amount=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts), time.monotonic() - self.started
+
+_crawl_stats = {}
+_crawl_stats_lock = threading.Lock()
+
+def get_crawl_stats(url):
+    """Return the CrawlStats for the host of the given URL."""
+    host = urlparse(url).netloc
+    with _crawl_stats_lock:
+        if host not in _crawl_stats:
+            _crawl_stats[host] = CrawlStats()
+        return _crawl_stats[host]
+
+def count(url, key, amount=1):
+    """Add to a crawl counter for the host of the given URL."""
+    get_crawl_stats(url).add(key, amount)
+
+class LatencyHistogram:
+    """Cumulative latency histogram over LATENCY_BUCKETS."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Approximate a quantile by the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum_seconds": round(self.sum, 6),
+            "avg_seconds": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "p99_seconds": self.quantile(0.99),
+            "max_seconds": round(self.max, 6),
+        }
+
+class Metrics:
+    """Per-phase latency histograms and error counts for the hot paths of a crawl.
+
+    Phases are fetch_page and fetch_document (one HTTP exchange, up to the
+    headers for documents), download_document (reading document bodies),
+    parse_listing, parse_case, mime_sniff, write_file, catalog and pack, and
+    the local waits rate_limit_wait, concurrency_wait and retry_backoff.
+    Request and byte counters are the per-host CrawlStats.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.histograms = {}
+        self.errors = {}
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = LatencyHistogram()
+            self.histograms[phase].observe(seconds)
+
+    def error(self, phase):
+        with self.lock:
+            self.errors[phase] = self.errors.get(phase, 0) + 1
+
+    @contextmanager
+    def timed(self, phase):
+        """Time the enclosed block as one observation of phase, counting exceptions as errors."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(phase)
+            raise
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def summary(self):
+        """Return the metrics as a JSON-serializable dict."""
+        elapsed = time.monotonic() - self.started
+        with _crawl_stats_lock:
+            hosts = {host: stats.snapshot()[0] for host, stats in _crawl_stats.items()}
+        requests_total = sum(c.get("requests", 0) for c in hosts.values())
+        bytes_total = sum(c.get("bytes", 0) + c.get("page_bytes", 0) for c in hosts.values())
+        with _host_controllers_lock:
+            concurrency = {host: round(c.limit, 2) for host, c in _host_controllers.items()}
+        with self.lock:
+            phases = {phase: h.to_dict() for phase, h in sorted(self.histograms.items())}
+            errors = dict(self.errors)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "requests_total": requests_total,
+            "requests_per_second": round(requests_total / elapsed, 3) if elapsed else 0.0,
+            "bytes_total": bytes_total,
+            "bytes_per_second": round(bytes_total / elapsed, 1) if elapsed else 0.0,
+            "hosts": hosts,
+            "concurrency": concurrency,
+            "phases": phases,
+            "errors": errors,
+        }
+
+    def prometheus_text(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        lines = []
+        with _crawl_stats_lock:
+            hosts = {host: stats.snapshot()[0] for host, stats in _crawl_stats.items()}
+        keys = sorted({key for counts in hosts.values() for key in counts})
+        for key in keys:
+            name = f"kommune_crawl_{key}_total"
+            lines.append(f"# TYPE {name} counter")
+            for host, counts in sorted(hosts.items()):
+                lines.append(f'{name}{{host="{host}"}} {counts.get(key, 0)}')
+        with _host_controllers_lock:
+            limits = {host: c.limit for host, c in _host_controllers.items()}
+        lines.append("# TYPE kommune_crawl_concurrency_limit gauge")
+        for host, limit in sorted(limits.items()):
+            lines.append(f'kommune_crawl_concurrency_limit{{host="{host}"}} {limit:.2f}')
+        with self.lock:
+            histograms = {phase: (list(h.buckets), h.count, h.sum) for phase, h in self.histograms.items()}
+            errors = dict(self.errors)
+        lines.append("# TYPE kommune_crawl_phase_seconds histogram")
+        for phase, (buckets, n, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(list(LATENCY_BUCKETS) + ["+Inf"], buckets):
+                cumulative += bucket
+                lines.append(f'kommune_crawl_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'kommune_crawl_phase_seconds_sum{{phase="{phase}"}} {total:.6f}')
+            lines.append(f'kommune_crawl_phase_seconds_count{{phase="{phase}"}} {n}')
+        lines.append("# TYPE kommune_crawl_phase_errors_total counter")
+        for phase, n in sorted(errors.items()):
+            lines.append(f'kommune_crawl_phase_errors_total{{phase="{phase}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def write_metrics_json(path):
+    """Write the metrics summary as JSON."""
+    _write_atomic(path, json.dumps(METRICS.summary(), indent=2).encode("utf-8"))
+
+def write_metrics_prometheus(path):
+    """Write the metrics as a Prometheus text file (e.g. for node_exporter's textfile collector)."""
+    _write_atomic(path, METRICS.prometheus_text().encode("utf-8"))
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = METRICS.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_exporter(prometheus_file=None, port=None, interval=DEFAULT_METRICS_INTERVAL, host=DEFAULT_METRICS_HOST):
+    """Serve /metrics on host:port and/or rewrite prometheus_file every interval seconds in the background."""
+    if port:
+        server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        log(f"(Serving metrics on http://{f'[{host}]' if ':' in host else host}:{port}/metrics)")
+    if prometheus_file:
+        def refresh():
+            while True:
+                time.sleep(interval)
+                write_metrics_prometheus(prometheus_file)
+        threading.Thread(target=refresh, name="metrics-file", daemon=True).start()
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the request rate against one host."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_rate_settings = {"rate": DEFAULT_RATE, "burst": DEFAULT_BURST}
+
+def configure_rate_limit(rate, burst):
+    """Set the per-host rate used for buckets created from now on."""
+    _rate_settings["rate"] = rate
+    _rate_settings["burst"] = burst
+
+def throttle(url):
+    """Wait for permission to send a request to the host of the given URL."""
+    host = urlparse(url).netloc
+    with _rate_limiters_lock:
+        bucket = _rate_limiters.get(host)
+        if bucket is None:
+            bucket = TokenBucket(_rate_settings["rate"], _rate_settings["burst"])
+            _rate_limiters[host] = bucket
+    bucket.acquire()
+
+class HostController:
+    """AIMD controller for the number of requests in flight against one host.
+
+    Every timely response raises the limit by 1/limit, so it grows by about
+    one per round of requests, up to max_limit. A 429, a 5xx, a timeout or a
+    response much slower than the fastest one seen halves it, at most once per
+    round trip so that a burst of failures counts as one signal. A Retry-After
+    header pauses the host.
+    """
+
+    def __init__(self, max_limit, adaptive=True):
+        self.max_limit = max(1, max_limit)
+        self.adaptive = adaptive
+        self.limit = 1.0 if adaptive else float(self.max_limit)
+        self.in_flight = 0
+        self.min_latency = None
+        self.avg_latency = 0.0
+        self.last_decrease = 0.0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Block until the host is not paused and a request slot is free, then take it."""
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait if wait > 0 else None)
+
+    def release(self, latency=None, congested=False, retry_after=None):
+        """Give back a slot and adjust the limit from the outcome of the request."""
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if latency is not None:
+                self.avg_latency = latency if not self.avg_latency else 0.8 * self.avg_latency + 0.2 * latency
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency > self.min_latency * LATENCY_TOLERANCE + LATENCY_SLACK:
+                    congested = True
+            if self.adaptive:
+                if congested:
+                    if now - self.last_decrease >= self.avg_latency:
+                        self.limit = max(1.0, self.limit / 2)
+                        self.last_decrease = now
+                elif latency is not None:
+                    self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            self.condition.notify_all()
+
+_host_controllers = {}
+_host_controllers_lock = threading.Lock()
+_controller_settings = {"max_in_flight": 1, "adaptive": True, "max_retries": DEFAULT_MAX_RETRIES}
+
+def configure_concurrency(max_in_flight, adaptive=True, max_retries=DEFAULT_MAX_RETRIES):
+    """Set the per-host request limit and retry count used for hosts seen from now on."""
+    _controller_settings["max_in_flight"] = max_in_flight
+    _controller_settings["adaptive"] = adaptive
+    _controller_settings["max_retries"] = max_retries
+
+def get_host_controller(url):
+    """Return the concurrency controller for the host of the given URL."""
+    host = urlparse(url).netloc
+    with _host_controllers_lock:
+        controller = _host_controllers.get(host)
+        if controller is None:
+            controller = HostController(_controller_settings["max_in_flight"], _controller_settings["adaptive"])
+            _host_controllers[host] = controller
+    return controller
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt (from 0): exponential backoff with jitter, or Retry-After if longer."""
+    backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)
+    return max(backoff / 2 + random.uniform(0, backoff / 2), retry_after or 0)
+
+def parse_retry_after(value):
+    """Return the seconds asked for by a Retry-After header (delay or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+            seconds = (when - datetime.now(when.tzinfo)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX)
+
+_thread_local = threading.local()
+
+def get_session():
+    """Return this thread's HTTP session, keeping connections alive between requests."""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _thread_local.session = session
+    return session
+
+def send_request(url, headers=None, stream=False, phase="fetch_page"):
+    """GET a URL through the host's rate limit and concurrency controller, retrying transient failures.
+
+    Timeouts, connection errors and 429/5xx responses are retried up to the
+    configured number of times with jittered exponential backoff, honouring
+    Retry-After. The last response is returned even if it is an error, so the
+    caller decides what to do with it; a request that never got a response
+    raises. With stream=True the request slot is held until the headers arrive.
+
+    Each HTTP exchange is timed as one observation of phase. The time spent
+    waiting for the rate limit (rate_limit_wait), for a request slot
+    (concurrency_wait) and in retry backoff (retry_backoff) is recorded as
+    phases of its own, so server latency can be told apart from local pacing.
+    """
+    controller = get_host_controller(url)
+    max_retries = _controller_settings["max_retries"]
+    for attempt in range(max_retries + 1):
+        wait_start = time.perf_counter()
+        throttle(url)
+        slot_start = time.perf_counter()
+        controller.acquire()
+        start = time.perf_counter()
+        METRICS.observe("rate_limit_wait", slot_start - wait_start)
+        METRICS.observe("concurrency_wait", start - slot_start)
+        try:
+            response = get_session().get(url, headers=headers, stream=stream, timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            METRICS.observe(phase, time.perf_counter() - start)
+            METRICS.error(phase)
+            controller.release(congested=True)
+            if attempt == max_retries or _stop_requested.is_set():
+                raise
+            error, retry_after = e, None
+        else:
+            latency = time.perf_counter() - start
+            METRICS.observe(phase, latency)
+            if response.status_code not in RETRY_STATUS_CODES:
+                controller.release(latency)
+                return response
+            METRICS.error(phase)
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            controller.release(latency, congested=True, retry_after=retry_after)
+            if attempt == max_retries or _stop_requested.is_set():
+                return response
+            error = f"HTTP {response.status_code}"
+            response.close()
+        delay = retry_delay(attempt, retry_after)
+        count(url, "retries")
+        log(f"    (retrying {url} in {delay:.1f} s: {error})")
+        backoff_start = time.perf_counter()
+        _stop_requested.wait(delay)
+        METRICS.observe("retry_backoff", time.perf_counter() - backoff_start)
+
+class PageCache:
+    """On-disk cache of fetched pages keyed by URL, revalidated with ETag/Last-Modified."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return base + ".json", base + ".html"
+
+    def load(self, url):
+        """Return (validators, body) for a cached URL, or (None, None)."""
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(body_path, "r", encoding="utf-8") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def store(self, url, response):
+        """Store a response body if the server gave us something to revalidate with."""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        meta_path, body_path = self._paths(url)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified}
+        _write_atomic(body_path, response.text.encode("utf-8"))
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+def _write_atomic(path, data):
+    """Write data to a temporary file next to path and rename it into place."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+_page_cache = None
+
+def configure_page_cache(cache_dir):
+    """Enable the conditional-request page cache in cache_dir, or disable it with None."""
+    global _page_cache
+    _page_cache = PageCache(cache_dir) if cache_dir else None
 
 def fetch_page(url):
-    """Fetch a page and return its HTML content."""
-    response = requests.get(url, headers=HEADERS)
+    """Fetch a page and return its HTML content.
+
+    When the page cache is enabled, a previously seen page is revalidated with
+    a conditional request, and a 304 response returns the cached copy.
+    """
+    headers = {}
+    cached_body = None
+    if _page_cache is not None:
+        meta, cached_body = _page_cache.load(url)
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = send_request(url, headers)
+    count(url, "pages")
+    count(url, "requests")
+    count(url, "page_bytes", len(response.content))
+    if response.status_code == 304 and cached_body is not None:
+        return cached_body
     response.raise_for_status()
+    if _page_cache is not None:
+        _page_cache.store(url, response)
     return response.text
 
 def sanitize_string(value):
@@ -57,6 +624,216 @@ def sanitize_filename(name):
     name = sanitize_string(name)
     return "".join(c if c.isalnum() or c in " ._-()" else "_" for c in name).replace("/", "-")
 
+def extract_journalpostid(case_url):
+    """Extract the journalpostid parameter from a case URL."""
+    return case_url.split("journalpostid=")[1].split("&")[0]
+
+class CaseIndex:
+    """Persistent journalpostid -> case directory index stored in SQLite under an output_dir.
+
+    Paths are stored relative to the output_dir. The first time an archive is
+    opened, the index is seeded from the case directories already on disk and
+    the cases in its segment store.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(output_dir, CASE_INDEX_FILENAME), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cases (journalpostid TEXT PRIMARY KEY, case_dir TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        if not self.conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone():
+            self._seed_from_disk()
+
+    def _seed_from_disk(self):
+        """Register every completed YYYY/MM/DD/<journalpostid> ... case already in the archive, packed or not."""
+        rows = []
+        for root, dirs, files in os.walk(self.output_dir):
+            rel_root = os.path.relpath(root, self.output_dir)
+            if rel_root.count(os.sep) == 2:  # YYYY/MM/DD
+                for name in dirs:
+                    journalpostid = name.split(" ", 1)[0]
+                    if journalpostid.isdigit() and os.path.exists(os.path.join(root, name, "details.txt")):
+                        rows.append((journalpostid, os.path.join(rel_root, name)))
+                dirs[:] = []
+        if is_packed(self.output_dir):
+            store = SegmentStore(self.output_dir)
+            for rel_dir, _, _ in store.cases():
+                journalpostid = os.path.basename(rel_dir).split(" ", 1)[0]
+                if journalpostid.isdigit():
+                    rows.append((journalpostid, rel_dir))
+            store.close()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO cases VALUES (?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', '1')")
+            self.conn.commit()
+        if rows:
+            log(f"(Indexed {len(rows)} existing cases in {self.output_dir})")
+
+    def known_case_dir(self, journalpostid):
+        """Return the case directory for an archived journalpost, or None if unknown or removed."""
+        with self.lock:
+            row = self.conn.execute("SELECT case_dir FROM cases WHERE journalpostid = ?", (journalpostid,)).fetchone()
+        if row:
+            case_dir = os.path.join(self.output_dir, row[0])
+            if os.path.exists(os.path.join(case_dir, "details.txt")):
+                return case_dir
+            segment_store = get_segment_store(self.output_dir)
+            if segment_store is not None and segment_store.file_info(os.path.join(row[0], "details.txt")):
+                return case_dir
+        return None
+
+    def add(self, journalpostid, case_dir):
+        """Record that a journalpost has been archived in case_dir."""
+        rel_dir = os.path.relpath(case_dir, self.output_dir)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cases VALUES (?, ?)", (journalpostid, rel_dir))
+            self.conn.commit()
+
+_case_indexes = {}
+_case_indexes_lock = threading.Lock()
+
+def get_case_index(output_dir):
+    """Return the shared CaseIndex for an output_dir, opening it on first use."""
+    with _case_indexes_lock:
+        if output_dir not in _case_indexes:
+            _case_indexes[output_dir] = CaseIndex(output_dir)
+        return _case_indexes[output_dir]
+
+class BlobStore:
+    """Content-addressed store of documents under <output_dir>/.blobs.
+
+    Each distinct document is stored once, named by its SHA-256, and hard
+    linked into every case directory that has it (copied where the file
+    system does not support hard links). An index maps document URLs to
+    their hash and MIME type, so a known URL is linked without downloading it.
+    """
+
+    def __init__(self, output_dir):
+        self.blob_dir = os.path.join(output_dir, BLOB_DIR_NAME)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.blob_dir, "index.sqlite"), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, mime_type TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+        self.conn.commit()
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def lookup_url(self, url):
+        """Return (sha256, mime_type) for a URL whose blob is stored, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT blobs.sha256, blobs.mime_type FROM urls JOIN blobs ON urls.sha256 = blobs.sha256 WHERE urls.url = ?",
+                (url,)).fetchone()
+        if row and os.path.exists(self.blob_path(row[0])):
+            return row
+        return None
+
+    def add(self, url, file_path, sha256, size, mime_type):
+        """Move a completed download into the store, or drop it if the content is already there."""
+        blob_path = self.blob_path(sha256)
+        with self.lock:
+            if os.path.exists(blob_path):
+                os.remove(file_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(file_path, blob_path)
+            self.conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (sha256, size, mime_type))
+            self.conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, sha256))
+            self.conn.commit()
+        return blob_path
+
+    def link(self, sha256, file_path):
+        """Make file_path refer to the stored blob."""
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(blob_path, file_path)
+        except OSError:
+            shutil.copyfile(blob_path, file_path)
+
+_blob_stores = {}
+_blob_stores_lock = threading.Lock()
+_blob_store_enabled = True
+
+def configure_blob_store(enabled):
+    """Turn the content-addressed document store on or off."""
+    global _blob_store_enabled
+    _blob_store_enabled = enabled
+
+def get_blob_store(output_dir):
+    """Return the shared BlobStore for an output_dir, or None when deduplication is off."""
+    if not _blob_store_enabled:
+        return None
+    with _blob_stores_lock:
+        if output_dir not in _blob_stores:
+            _blob_stores[output_dir] = BlobStore(output_dir)
+        return _blob_stores[output_dir]
+
+_segment_stores = {}
+_segment_stores_lock = threading.Lock()
+_packed_enabled = False
+
+def configure_packed(enabled):
+    """Turn packing finished cases into the archive's segment files on or off."""
+    global _packed_enabled
+    _packed_enabled = enabled
+
+def get_segment_store(output_dir):
+    """Return the shared SegmentStore for an output_dir, or None unless packing is on or the archive has packed cases.
+
+    New cases in an archive that has packed cases are packed too.
+    """
+    if not _packed_enabled and not is_packed(output_dir):
+        return None
+    with _segment_stores_lock:
+        if output_dir not in _segment_stores:
+            _segment_stores[output_dir] = SegmentStore(output_dir)
+        return _segment_stores[output_dir]
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def get_catalog(output_dir):
+    """Return the shared Catalog for an output_dir, opening it on first use."""
+    with _catalogs_lock:
+        if output_dir not in _catalogs:
+            _catalogs[output_dir] = Catalog(output_dir)
+        return _catalogs[output_dir]
+
+def _is_case_page_element(name, attrs=None):
+    """SoupStrainer filter keeping only the parts of a case page we extract."""
+    if name == "h2":
+        return True
+    if attrs is None:  # Newer BeautifulSoup versions only pass the tag name
+        return name in ("table", "div", "ul")
+    css = attrs.get("class") or ""
+    classes = css.split() if isinstance(css, str) else css
+    if name == "table":
+        return "two" in classes and "hh" in classes
+    if name == "div":
+        return "dokmottakere" in classes or "content-text" in classes
+    if name == "ul":
+        return "innsyn_dok" in classes
+    return False
+
+CASE_PAGE_STRAINER = SoupStrainer(_is_case_page_element)
+LISTING_PAGE_STRAINER = SoupStrainer("a", href=True)
+
+def make_soup(html, parse_only=None, parser=None):
+    """Build a BeautifulSoup tree with the configured parser backend."""
+    return BeautifulSoup(html, parser or HTML_PARSER, parse_only=parse_only)
+
+def configure_parser(parser):
+    """Select the HTML parser backend ("auto", "lxml" or "html.parser")."""
+    global HTML_PARSER
+    HTML_PARSER = DEFAULT_HTML_PARSER if parser == "auto" else parser
+
 def extract_case_links(soup, base_url):
     """Extracts all 'Gå til journalposten' links from the soup."""
     return [urljoin(base_url, a['href']) for a in soup.find_all('a', string='Gå til journalposten', href=True)]
@@ -65,158 +842,829 @@ def extract_pagination_links(soup, base_url):
     """Extracts pagination links from the current page."""
     return [urljoin(base_url, a['href']) for a in soup.find_all('a', href=True) if a.text.isdigit() or a.text.lower() == 'neste']
 
-def write_details_file(details_path, content):
-    """Write the details file with a trailing newline."""
-    with open(details_path, "w", encoding="utf-8") as f:
-        f.write(content.strip() + "\n\n")  # Ensure trailing newline
+def extract_listing(page_html, base_url):
+    """Parse a postliste page once and return its case links and the "neste" URL."""
+    with METRICS.timed("parse_listing"):
+        soup = make_soup(page_html, parse_only=LISTING_PAGE_STRAINER)
+        next_link = soup.find("a", string="neste")
+        next_url = urljoin(base_url, next_link["href"]) if next_link else None
+        return extract_case_links(soup, base_url), next_url
 
-def parse_case_details(case_html, sanitized_arkivsak_id, is_censored, censor_reason=None, downloaded_files=None):
-    """Parse and format case details into plain text."""
-    soup = BeautifulSoup(case_html, "html.parser")
-    details = []
+@dataclass
+class CaseRecord:
+    """Everything we extract from a journalpost_detaljer page."""
+    journalpostid: str
+    arkivsak_id: Optional[str] = None
+    fields: List[Tuple[str, str]] = field(default_factory=list)  # (header, value) rows of the case table
+    senders: Optional[str] = None
+    is_censored: bool = False
+    censor_reason: Optional[str] = None
+    documents: List[Tuple[str, str]] = field(default_factory=list)  # (url, sanitized name)
+
+def extract_case_record(case_html, case_url):
+    """Build a CaseRecord from a single parse of the case page."""
+    with METRICS.timed("parse_case"):
+        return _extract_case_record(case_html, case_url)
+
+def _extract_case_record(case_html, case_url):
+    soup = make_soup(case_html, parse_only=CASE_PAGE_STRAINER)
+    record = CaseRecord(journalpostid=extract_journalpostid(case_url))
 
     # Extract table data
     table = soup.find("table", class_="table hh i-bgw two")
     if table:
-        rows = table.find_all("tr")
-        for row in rows:
-            header = row.find("th").get_text(strip=True).rstrip(":")
-            value = sanitize_string(row.find("td").get_text(strip=True))
-            if header == "ArkivsakID":
-                details.append(f"{header}: {sanitized_arkivsak_id}")
-            else:
-                details.append(f"{header}: {value}")
+        for row in table.find_all("tr"):
+            th, td = row.find("th"), row.find("td")
+            if not th or not td:
+                continue
+            header = th.get_text(strip=True).rstrip(":")
+            if "ArkivsakID" in header:
+                record.arkivsak_id = sanitize_string(td.get_text(separator=" ", strip=True))
+            record.fields.append((header, sanitize_string(td.get_text(strip=True))))
 
     # Extract sender
     sender_section = soup.find("h2", string="Avsender(e)")
     if sender_section:
         sender_div = sender_section.find_next("div", class_="dokmottakere")
         if sender_div:
-            sender_text = sender_div.get_text(separator="\n", strip=True)
-            details.append("\nAvsender(e):\n" + sender_text + "\n")
+            record.senders = sender_div.get_text(separator="\n", strip=True)
+
+    # Determine censorship and collect documents
+    tekstdokument = soup.find("h2", string="Tekstdokument")
+    if tekstdokument:
+        censor_text = tekstdokument.find_next("div", class_="content-text")
+        if censor_text and "ikke offentlig" in censor_text.get_text():
+            record.is_censored = True
+            record.censor_reason = censor_text.get_text(strip=True)
+        else:
+            document_list = tekstdokument.find_next("ul", class_="innsyn_dok")
+            if document_list:
+                record.documents = [
+                    (urljoin(case_url, doc['href']), sanitize_filename(doc.get_text(strip=True)))
+                    for doc in document_list.find_all("a", href=True)
+                ]
+
+    return record
+
+def write_details_file(details_path, content):
+    """Write the details file with a trailing newline."""
+    with METRICS.timed("write_file"):
+        _write_atomic(details_path, (content.strip() + "\n\n").encode("utf-8"))  # Ensure trailing newline
+
+def format_case_details(record, downloaded_files=None):
+    """Format a CaseRecord as the plain text written to details.txt."""
+    details = []
+
+    for header, value in record.fields:
+        if header == "ArkivsakID":
+            details.append(f"{header}: {record.arkivsak_id}")
+        else:
+            details.append(f"{header}: {value}")
+
+    if record.senders:
+        details.append("\nAvsender(e):\n" + record.senders + "\n")
 
     # Add documents
-    if is_censored:
-        details.append("\nTekstdokument\n" + censor_reason)
+    if record.is_censored:
+        details.append("\nTekstdokument\n" + record.censor_reason)
     elif downloaded_files:
         details.extend(downloaded_files)
 
     return "\n".join(details)
 
-def process_case(case_url, date_dir, base_url, force=False):
-    """Process a single case by downloading its details and documents."""
-    case_html = fetch_page(case_url)
-    soup = BeautifulSoup(case_html, "html.parser")
+def detect_mime_type(buffer):
+    """Detect the MIME type of a buffer with a shared libmagic detector."""
+    global _mime_detector
+    with METRICS.timed("mime_sniff"), _mime_lock:
+        if _mime_detector is None:
+            _mime_detector = magic.Magic(mime=True)
+        return _mime_detector.from_buffer(buffer)
 
-    journalpostid = case_url.split("journalpostid=")[1].split("&")[0]
-    arkivsak_row = soup.find("th", string=lambda x: x and "ArkivsakID" in x)
-    if arkivsak_row:
-        arkivsak_id_raw = arkivsak_row.find_next("td").get_text(separator=" ", strip=True)
-        arkivsak_id = sanitize_string(arkivsak_id_raw)
-    else:
+_mime_detector = None
+_mime_lock = threading.Lock()
+
+def partial_download_path(case_dir, original_name):
+    """Path of the hidden temporary file a document is streamed into before it is renamed."""
+    return os.path.join(case_dir, f".{original_name}{PARTIAL_SUFFIX}")
+
+def _open_document_stream(file_url, offset):
+    """Request a document, asking for the bytes from offset onwards when resuming."""
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    response = send_request(file_url, headers, stream=True, phase="fetch_document")
+    if offset and response.status_code == 416:
+        # The partial file is not a prefix of what the server has now; start over
+        response.close()
+        return _open_document_stream(file_url, 0)
+    response.raise_for_status()
+    if offset and response.status_code != 206:
+        offset = 0  # The server ignored the Range header and sent the whole file
+    return response, offset
+
+@dataclass
+class DocumentFile:
+    """A document saved in a case directory."""
+    name: str
+    url: str
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+    mime_type: Optional[str] = None
+
+def _file_name_for(original_name, mime_type):
+    """Add the extension for a MIME type to a document name unless it is already there."""
+    ext = mime_type.split("/")[-1]
+    ext = f".{ext}" if ext else ".bin"
+    return original_name if original_name.endswith(ext) else original_name + ext
+
+def download_document(file_url, case_dir, original_name, force=False, blob_store=None):
+    """Download a single document into the case directory and return it as a DocumentFile.
+
+    The document is streamed into a hidden partial file and renamed into place
+    once complete, so an interrupted download never leaves a truncated file
+    under its final name. A partial file left by an earlier run is resumed
+    with an HTTP Range request. With a blob_store, the document is hashed
+    while streaming, stored once by content and linked into the case
+    directory, and a URL already in the store is not downloaded again. A
+    connection that breaks mid-download is resumed after a backoff.
+    """
+    part_path = partial_download_path(case_dir, original_name)
+    try:
+        if blob_store is not None and not force:
+            known = blob_store.lookup_url(file_url)
+            if known:
+                sha256, mime_type = known
+                file_path = os.path.join(case_dir, _file_name_for(original_name, mime_type))
+                if not os.path.exists(file_path):
+                    blob_store.link(sha256, file_path)
+                    log(f"    - {os.path.basename(file_path)} (already stored)")
+                return DocumentFile(os.path.basename(file_path), file_url, os.path.getsize(file_path), sha256, mime_type)
+
+        transfer_seconds = 0.0  # Reading the body over the network, without waits, backoff and disk writes
+        max_retries = _controller_settings["max_retries"]
+        for attempt in range(max_retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            response, offset = _open_document_stream(file_url, offset)
+            count(file_url, "requests")
+            try:
+                with response:
+                    chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+                    read_start = time.perf_counter()
+                    first_chunk = next(chunks, b"")
+                    transfer_seconds += time.perf_counter() - read_start
+
+                    # Use MIME type detection on the start of the file to determine the correct suffix
+                    digest = hashlib.sha256()
+                    if offset:
+                        with open(part_path, "rb") as f:
+                            head = f.read(MIME_SNIFF_BYTES)
+                            f.seek(0)
+                            for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                                digest.update(block)
+                    else:
+                        head = first_chunk[:MIME_SNIFF_BYTES]
+                    mime_type = detect_mime_type(head)
+                    file_path = os.path.join(case_dir, _file_name_for(original_name, mime_type))
+
+                    # Avoid overwriting existing files unless forced
+                    if os.path.exists(file_path) and not force:
+                        log(f"    - Skipping duplicate: {os.path.basename(file_path)}")
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                        return DocumentFile(os.path.basename(file_path), file_url, os.path.getsize(file_path), mime_type=mime_type)
+
+                    # Stream the rest of the file to disk, hashing it on the way
+                    size = len(first_chunk)
+                    digest.update(first_chunk)
+                    write_seconds = 0.0
+                    with open(part_path, "ab" if offset else "wb") as f:
+                        f.write(first_chunk)
+                        read_start = time.perf_counter()
+                        for chunk in chunks:
+                            write_start = time.perf_counter()
+                            transfer_seconds += write_start - read_start
+                            f.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                            read_start = time.perf_counter()
+                            write_seconds += read_start - write_start
+                    METRICS.observe("write_file", write_seconds)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                # The connection broke mid-download; resume from the partial file after a backoff
+                if attempt == max_retries or _stop_requested.is_set():
+                    raise
+                delay = retry_delay(attempt)
+                count(file_url, "retries")
+                log(f"    (download of {original_name} interrupted, resuming in {delay:.1f} s: {e})")
+                backoff_start = time.perf_counter()
+                _stop_requested.wait(delay)
+                METRICS.observe("retry_backoff", time.perf_counter() - backoff_start)
+
+        if blob_store is not None:
+            blob_store.add(file_url, part_path, digest.hexdigest(), offset + size, mime_type)
+            blob_store.link(digest.hexdigest(), file_path)
+        else:
+            os.replace(part_path, file_path)
+        METRICS.observe("download_document", transfer_seconds)
+        count(file_url, "documents")
+        count(file_url, "bytes", size)
+        if offset:
+            log(f"    - {os.path.basename(file_path)} (resumed at {offset} bytes)")
+        else:
+            log(f"    - {os.path.basename(file_path)}")
+        return DocumentFile(os.path.basename(file_path), file_url, offset + size, digest.hexdigest(), mime_type)
+    except Exception as e:
+        count(file_url, "errors")
+        METRICS.error("download_document")
+        log(f"    - Error downloading document: {file_url} - {e}")
+        return None
+
+def process_case(case_url, date_dir, base_url, force=False, document_pool=None, case_index=None, blob_store=None, catalog=None,
+                 segment_store=None):
+    """Process a single case by downloading its details and documents.
+
+    If a document_pool executor is given, the case's documents are fetched
+    concurrently through it. The file list keeps the order of the page.
+    Archived cases are recorded in case_index when one is given, and documents
+    are deduplicated through blob_store when one is given. Written cases are
+    added to catalog when one is given. With a segment_store, the finished
+    case directory is packed into the archive's segment files and removed.
+    """
+    case_html = fetch_page(case_url)
+    record = extract_case_record(case_html, case_url)
+    journalpostid = record.journalpostid
+    arkivsak_id = record.arkivsak_id
+    if not arkivsak_id:
         log(f"  {journalpostid}: ArkivsakID not found, skipping case.")
         return
 
     case_dir_name = sanitize_filename(f"{journalpostid} {arkivsak_id}")
     case_dir = os.path.join(date_dir, case_dir_name)
-    if os.path.exists(case_dir) and not force:
+    details_path = os.path.join(case_dir, "details.txt")
+    packed = segment_store is not None and segment_store.file_info(os.path.relpath(details_path, segment_store.output_dir))
+    if (os.path.exists(details_path) or packed) and not force:
         log(f"  {journalpostid}: Already processed.")
+        if segment_store is not None and os.path.exists(details_path):
+            segment_store.add_case(case_dir)  # Written, but not packed before the last run stopped
+        if case_index is not None:
+            case_index.add(journalpostid, case_dir)
         return
 
     os.makedirs(case_dir, exist_ok=True)
 
-    # Determine censorship
-    tekstdokument = soup.find("h2", string="Tekstdokument")
-    is_censored = False
-    censor_reason = None
-    if tekstdokument:
-        censor_text = tekstdokument.find_next("div", class_="content-text")
-        if censor_text and "ikke offentlig" in censor_text.get_text():
-            is_censored = True
-            censor_reason = censor_text.get_text(strip=True)
-
     # Log case details
     log(f"  {journalpostid}: {arkivsak_id}")
 
     # Download documents and prepare file list
-    downloaded_files = []
-    if not is_censored:
-        document_section = soup.find("h2", string="Tekstdokument")
-        if document_section:
-            document_list = document_section.find_next("ul", class_="innsyn_dok")
-            if document_list:
-                documents = document_list.find_all("a", href=True)
-                for doc in documents:
-                    file_url = urljoin(case_url, doc['href'])
-                    original_name = sanitize_filename(doc.get_text(strip=True))
-
-                    try:
-                        # Fetch file
-                        response = requests.get(file_url, headers=HEADERS, stream=True)
-                        response.raise_for_status()
-
-                        # Use MIME type detection to determine the correct suffix
-                        mime = magic.Magic(mime=True)
-                        mime_type = mime.from_buffer(response.content[:4096])
-                        ext = mime_type.split("/")[-1]
-                        ext = f".{ext}" if ext else ".bin"
-
-                        # Add the extension if not already present
-                        if not original_name.endswith(ext):
-                            original_name += ext
-
-                        file_path = os.path.join(case_dir, original_name)
-
-                        # Avoid overwriting existing files unless forced
-                        if os.path.exists(file_path) and not force:
-                            log(f"    - Skipping duplicate: {os.path.basename(file_path)}")
-                            continue
-
-                        # Save the file
-                        with open(file_path, "wb") as f:
-                            for chunk in response.iter_content(chunk_size=8192):
-                                f.write(chunk)
-
-                        log(f"    - {os.path.basename(file_path)}")
-                        downloaded_files.append(os.path.basename(file_path))
-                    except Exception as e:
-                        log(f"    - Error downloading document: {file_url} - {e}")
-
-    # Parse and write details
-    case_details = parse_case_details(case_html, arkivsak_id, is_censored, censor_reason, downloaded_files)
-    details_path = os.path.join(case_dir, "details.txt")
+    downloaded = []
+    if record.documents:
+        jobs = record.documents
+        if document_pool is not None:
+            futures = [document_pool.submit(download_document, url, case_dir, name, force, blob_store) for url, name in jobs]
+            results = [future.result() for future in futures]
+        else:
+            results = [download_document(url, case_dir, name, force, blob_store) for url, name in jobs]
+        downloaded = list({doc.name: doc for doc in results if doc}.values())
+
+        # Leave details.txt unwritten so the next run resumes the interrupted downloads
+        if any(os.path.exists(partial_download_path(case_dir, name)) for _, name in jobs):
+            log(f"  {journalpostid}: Incomplete downloads, will resume on next run.")
+            return
+
+    # Write details
+    case_details = format_case_details(record, [doc.name for doc in downloaded])
     write_details_file(details_path, case_details)
+    count(case_url, "cases")
+    if catalog is not None:
+        with METRICS.timed("catalog"):
+            catalog.record_case(journalpostid, case_dir, record.fields, record.senders.split("\n") if record.senders else [],
+                                record.is_censored, record.censor_reason, [asdict(doc) for doc in downloaded])
+    if segment_store is not None:
+        with METRICS.timed("pack"):
+            segment_store.add_case(case_dir)
+    if case_index is not None:
+        case_index.add(journalpostid, case_dir)
 
-def process_date(kommune_config, date, force=False):
-    """Processes a specific date URL, including all paginated pages."""
+def postliste_url(kommune_config, date):
+    """Return the URL of the first postliste page for a date."""
+    return f"{kommune_config['base_url']}?response=journalpost_postliste&MId1={kommune_config['mid']}&scripturi=/innsyn.aspx&skin=infolink&fradato={date.strftime(DATE_FORMAT)}T00:00:00"
+
+def fetch_listing(kommune_config, page_url):
+    """Fetch a postliste page and return its (case_links, next_url)."""
+    return extract_listing(fetch_page(page_url), kommune_config["base_url"])
+
+def submit_cases(kommune_config, date, case_links, force=False, case_pool=None, document_pool=None):
+    """Start processing the cases linked from one postliste page for a date.
+
+    Returns a list of (case_link, future) pairs to pass to wait_for_cases().
+    With a case_pool executor, the cases are processed concurrently; without
+    one they are processed before this returns. Journalposts already in the
+    archive's case index are skipped without fetching their case page, unless
+    force is set.
+    """
     base_url = kommune_config["base_url"]
-    date_url = f"{base_url}?response=journalpost_postliste&MId1={kommune_config['mid']}&scripturi=/innsyn.aspx&skin=infolink&fradato={date.strftime(DATE_FORMAT)}T00:00:00"
-    log(date.strftime("%Y-%m-%d"))
     date_dir = os.path.join(kommune_config["output_dir"], date.strftime("%Y/%m/%d"))
     os.makedirs(date_dir, exist_ok=True)
+    case_index = get_case_index(kommune_config["output_dir"])
+    catalog = get_catalog(kommune_config["output_dir"])
+    segment_store = get_segment_store(kommune_config["output_dir"])
+    # Packed documents are deduplicated by the segment index instead of the blob store
+    blob_store = get_blob_store(kommune_config["output_dir"]) if segment_store is None else None
+
+    if not force:
+        new_links = [link for link in case_links if not case_index.known_case_dir(extract_journalpostid(link))]
+        skipped = len(case_links) - len(new_links)
+        if skipped:
+            log(f"  ({skipped} already archived)")
+        case_links = new_links
 
-    while date_url:
-        page_content = fetch_page(date_url)
-        soup = BeautifulSoup(page_content, "html.parser")
+    pending = []
+    for case_link in case_links:
+        args = (case_link, date_dir, base_url, force, document_pool, case_index, blob_store, catalog, segment_store)
+        if case_pool is not None:
+            future = case_pool.submit(process_case, *args)
+        else:
+            future = Future()
+            try:
+                future.set_result(process_case(*args))
+            except Exception as e:
+                future.set_exception(e)
+        pending.append((case_link, future))
+    return pending
 
-        # Extract case links from the current page
-        case_links = extract_case_links(soup, base_url)
-        for case_link in case_links:
-            process_case(case_link, date_dir, base_url, force)
+def wait_for_cases(pending):
+    """Wait for cases started by submit_cases() and return the number that failed."""
+    failures = 0
+    for case_link, future in pending:
+        try:
+            future.result()
+        except Exception as e:
+            failures += 1
+            count(case_link, "errors")
+            log(f"  Error processing case {case_link}: {e}")
+    return failures
 
-        # Find the "neste" link and continue pagination
-        next_link = soup.find("a", string="neste")
-        if next_link:
-            date_url = urljoin(base_url, next_link["href"])
+def process_cases(kommune_config, date, case_links, force=False, case_pool=None, document_pool=None):
+    """Process the cases linked from one postliste page for a date and return the number that failed."""
+    return wait_for_cases(submit_cases(kommune_config, date, case_links, force, case_pool, document_pool))
+
+def prefetch_listings(kommune_config, dates, depth=PREFETCH_PAGES):
+    """Yield (date, case_links, error) for every postliste page of the given dates.
+
+    The pages are fetched by a background thread that follows the "neste"
+    links and moves on to the next date while the caller processes cases,
+    staying at most depth pages ahead through a bounded queue. After the last
+    page of a date comes (date, None, None), or (date, None, error) if a page
+    could not be fetched.
+    """
+    pages = Queue(maxsize=depth)
+    closed = threading.Event()
+    prefix = getattr(_log_context, "prefix", "")
+
+    def put(item):
+        while not closed.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch_all():
+        set_log_prefix(prefix)
+        for date in dates:
+            page_url = postliste_url(kommune_config, date)
+            error = None
+            while page_url and not _stop_requested.is_set():
+                try:
+                    case_links, page_url = fetch_listing(kommune_config, page_url)
+                except Exception as e:
+                    error = e
+                    break
+                if not put((date, case_links, None)):
+                    return
+            if _stop_requested.is_set() or not put((date, None, error)):
+                break
+        put(None)
+
+    thread = threading.Thread(target=fetch_all, name="postliste-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is None:
+                return
+            yield item
+    finally:
+        closed.set()
+
+def process_dates(kommune_config, dates, force=False, case_pool=None, document_pool=None):
+    """Process every postliste page of the given dates as a pipeline.
+
+    Listings are prefetched ahead of the cases, and the cases of up to
+    PREFETCH_PAGES pages are in the case_pool at once, so the workers move on
+    to the next page while the last cases of the previous one finish.
+    """
+    in_flight = deque()
+
+    def finish_oldest():
+        date, pending = in_flight.popleft()
+        if pending is None:
+            count(kommune_config["base_url"], "dates")
         else:
-            date_url = None
+            wait_for_cases(pending)
+
+    current_date = None
+    for date, case_links, error in prefetch_listings(kommune_config, dates):
+        if _stop_requested.is_set():
+            break
+        if date != current_date:
+            log(date.strftime("%Y-%m-%d"))
+            current_date = date
+        if error is not None:
+            count(kommune_config["base_url"], "errors")
+            log(f"Error processing date {date.strftime(DATE_FORMAT)}: {error}")
+            continue
+        # A None entry marks the end of a date, counted once its cases are done
+        in_flight.append((date, None if case_links is None else
+                          submit_cases(kommune_config, date, case_links, force, case_pool, document_pool)))
+        while len(in_flight) > PREFETCH_PAGES:
+            finish_oldest()
+    while in_flight and not _stop_requested.is_set():
+        finish_oldest()
+
+def process_date(kommune_config, date, force=False, case_pool=None, document_pool=None):
+    """Processes a specific date URL, including all paginated pages."""
+    process_dates(kommune_config, [date], force, case_pool, document_pool)
+
+class WorkQueue:
+    """Persistent SQLite queue of (kommune, date, page) work units for large backfills.
+
+    Units move from pending to claimed to done. A failed unit goes back to
+    pending until it has been tried max_attempts times, and is then marked
+    failed. A worker renews its claim while it works on a unit (see
+    holding()), and claims older than the lease are handed out again, so a
+    crashed worker's unit is picked up by another one; a worker whose claim
+    was taken over can't record the unit's result. Several processes on one
+    machine can claim units from the same queue. The queue uses SQLite's WAL
+    journal, which needs shared memory and doesn't work over a network file
+    system, so a queue file on one is refused: to spread a backfill over
+    several machines, give each its own local queue file and --shard K/N.
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        fs_type = network_filesystem(path)
+        if fs_type:
+            raise ValueError(f"{path} is on a network file system ({fs_type}); use a local queue file per machine with --shard K/N")
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS units (
+            kommune TEXT NOT NULL,
+            date TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at REAL,
+            error TEXT,
+            PRIMARY KEY (kommune, date, page))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS units_status ON units (status)")
+
+    def enqueue_range(self, kommune, start_date, stop_date, shard=None, shards=1):
+        """Add the first postliste page of every date in the range (or shard); existing units are kept."""
+        kommune_config = KOMMUNE_CONFIG[kommune]
+        rows = []
+        current_date = start_date
+        while current_date <= stop_date:
+            if shard is None or date_shard(current_date, shards) == shard:
+                rows.append((kommune, current_date.strftime(DATE_FORMAT), 1, postliste_url(kommune_config, current_date)))
+            current_date += timedelta(days=1)
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO units (kommune, date, page, url) VALUES (?, ?, ?, ?)", rows)
+
+    def add_page(self, kommune, date, page, url):
+        """Add a follow-up postliste page discovered while processing a unit."""
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO units (kommune, date, page, url) VALUES (?, ?, ?, ?)",
+                              (kommune, date, page, url))
+
+    def claim(self, shard=None, shards=1):
+        """Claim the next available unit and return it as a dict, or None when there is nothing left."""
+        now = time.time()
+        query = """SELECT kommune, date, page, url, attempts FROM units
+                   WHERE (status = 'pending' OR (status = 'claimed' AND claimed_at < ?))"""
+        params = [now - self.lease_seconds]
+        if shard is not None:
+            # Same day number as date_shard(): the Julian day of the date
+            query += " AND CAST(julianday(date) AS INTEGER) % ? = ?"
+            params.extend([shards, shard])
+        query += " ORDER BY date, kommune, page LIMIT 1"
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(query, params).fetchone()
+                if row:
+                    self.conn.execute("UPDATE units SET status = 'claimed', claimed_by = ?, claimed_at = ? WHERE kommune = ? AND date = ? AND page = ?",
+                                      (self.worker_id, now, row[0], row[1], row[2]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return dict(zip(("kommune", "date", "page", "url", "attempts"), row))
+
+    def renew(self, unit):
+        """Extend the claim on a unit by another lease; returns False if this worker no longer holds it."""
+        with self.lock:
+            return self.conn.execute("UPDATE units SET claimed_at = ? WHERE kommune = ? AND date = ? AND page = ? "
+                                     "AND status = 'claimed' AND claimed_by = ?",
+                                     (time.time(), unit["kommune"], unit["date"], unit["page"], self.worker_id)).rowcount == 1
+
+    @contextmanager
+    def holding(self, unit):
+        """Renew the claim on a unit in a background thread while the block works on it."""
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.lease_seconds / LEASE_RENEWALS):
+                if not self.renew(unit):
+                    log(f"Lost the claim on {unit['kommune']} {unit['date']} page {unit['page']} to another worker")
+                    return
+
+        thread = threading.Thread(target=heartbeat, name="lease-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _set_status(self, unit, status, attempts, error=None):
+        """Set a claimed unit's status; returns False, changing nothing, if this worker no longer holds the claim."""
+        with self.lock:
+            return self.conn.execute("UPDATE units SET status = ?, attempts = ?, error = ?, claimed_by = NULL, claimed_at = NULL "
+                                     "WHERE kommune = ? AND date = ? AND page = ? AND status = 'claimed' AND claimed_by = ?",
+                                     (status, attempts, error, unit["kommune"], unit["date"], unit["page"], self.worker_id)).rowcount == 1
+
+    def complete(self, unit):
+        """Mark a unit done; returns False if its claim was taken over by another worker."""
+        return self._set_status(unit, "done", unit["attempts"] + 1)
+
+    def fail(self, unit, error):
+        """Record a failed attempt, returning the unit to the queue unless it is out of retries.
+
+        Returns the new status, or "lost" if the claim was taken over by another worker.
+        """
+        attempts = unit["attempts"] + 1
+        status = "failed" if attempts >= self.max_attempts else "pending"
+        return status if self._set_status(unit, status, attempts, str(error)) else "lost"
+
+    def release(self, unit):
+        """Hand an unfinished unit back without counting it as an attempt."""
+        self._set_status(unit, "pending", unit["attempts"])
+
+    def retry_failed(self):
+        """Put every failed unit back in the queue with a fresh retry budget."""
+        with self.lock:
+            return self.conn.execute("UPDATE units SET status = 'pending', attempts = 0 WHERE status = 'failed'").rowcount
+
+    def status_counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT kommune, status, COUNT(*) FROM units GROUP BY kommune, status").fetchall()
+        counts = {}
+        for kommune, status, n in rows:
+            counts.setdefault(kommune, {})[status] = n
+        return counts
+
+def network_filesystem(path):
+    """The type of the network file system path is on (e.g. "nfs" or "cifs"), or None if it is local or unknown.
+
+    Read from /proc/mounts, so it is only detected on Linux.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        with open("/proc/mounts", "r", encoding="utf-8") as f:
+            # Mount points escape spaces as \040
+            mounts = [(fields[1].replace("\\040", " "), fields[2]) for fields in map(str.split, f) if len(fields) >= 3]
+    except OSError:
+        return None
+    # The longest mount point that contains the directory is the one it is on
+    matches = [(mount, fs_type) for mount, fs_type in mounts
+               if directory == mount or directory.startswith(mount.rstrip("/") + "/")]
+    if not matches:
+        return None
+    fs_type = max(matches, key=lambda m: len(m[0]))[1]
+    return fs_type if fs_type in NETWORK_FILESYSTEMS or fs_type.startswith("nfs") else None
+
+def date_shard(date, shards):
+    """Return which of N shards a date belongs to, spreading consecutive days across shards."""
+    return (date.toordinal() + 1721424) % shards  # Julian day number, as used in WorkQueue.claim()
+
+def run_queue_worker(queue_path, force=False, workers=1, shard=None, shards=1, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Claim and process units from a work queue until it is empty or a stop is requested."""
+    queue = WorkQueue(queue_path, max_attempts=max_attempts)
+    case_pool = None
+    document_pool = None
+    if workers > 1:
+        case_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="case")
+        document_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="document")
+
+    try:
+        while not _stop_requested.is_set():
+            unit = queue.claim(shard, shards)
+            if unit is None:
+                break
+            kommune_config = KOMMUNE_CONFIG[unit["kommune"]]
+            date = datetime.strptime(unit["date"], DATE_FORMAT)
+            log(f"[{unit['kommune']}] {unit['date']} (page {unit['page']})")
+            try:
+                with queue.holding(unit):
+                    case_links, next_url = fetch_listing(kommune_config, unit["url"])
+                    if next_url:
+                        # Queue the next page right away so other workers can start on it
+                        queue.add_page(unit["kommune"], unit["date"], unit["page"] + 1, next_url)
+                    failures = process_cases(kommune_config, date, case_links, force, case_pool, document_pool)
+            except KeyboardInterrupt:
+                queue.release(unit)
+                raise
+            except Exception as e:
+                count(kommune_config["base_url"], "errors")
+                status = queue.fail(unit, e)
+                log(f"Error processing {unit['kommune']} {unit['date']} page {unit['page']} ({status}): {e}")
+                continue
+
+            if not next_url:
+                count(kommune_config["base_url"], "dates")
+            if failures:
+                status = queue.fail(unit, f"{failures} case(s) failed")
+                log(f"  {failures} case(s) failed on {unit['kommune']} {unit['date']} page {unit['page']} ({status})")
+            elif not queue.complete(unit):
+                log(f"  {unit['kommune']} {unit['date']} page {unit['page']} was claimed by another worker; not marked done")
+    finally:
+        for pool in (case_pool, document_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+def _queue_worker_process(args, shard, shards, index):
+    """Entry point for a queue worker started with multiprocessing."""
+    configure_from_args(args, rate=args.rate / args.processes)
+    start_metrics_exporter(_worker_metrics_path(args.metrics_prom, index),
+                           args.metrics_port + index if args.metrics_port else None, host=args.metrics_host)
+    try:
+        run_queue_worker(args.queue, args.force, args.workers, shard, shards, args.max_attempts)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        write_metrics_files(_worker_metrics_path(args.metrics_json, index), _worker_metrics_path(args.metrics_prom, index))
+
+def _worker_metrics_path(path, index):
+    """Give each worker process its own metrics file by adding its index before the extension."""
+    if not path:
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+def log_queue_status(queue):
+    """Log how many units of each kommune are pending, claimed, done and failed."""
+    log(f"{'kommune':<12} {'pending':>8} {'claimed':>8} {'done':>8} {'failed':>8}")
+    for kommune, counts in sorted(queue.status_counts().items()):
+        log(f"{kommune:<12} {counts.get('pending', 0):>8} {counts.get('claimed', 0):>8} {counts.get('done', 0):>8} {counts.get('failed', 0):>8}")
+
+def crawl_kommune(kommune, start_date, stop_date, force=False, workers=1, log_prefix=""):
+    """Crawl one kommune over a date range with its own case and document pools."""
+    set_log_prefix(log_prefix)
+    kommune_config = KOMMUNE_CONFIG[kommune]
+
+    case_pool = None
+    document_pool = None
+    if workers > 1:
+        case_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{kommune}-case",
+                                       initializer=set_log_prefix, initargs=(log_prefix,))
+        document_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{kommune}-document",
+                                           initializer=set_log_prefix, initargs=(log_prefix,))
+
+    dates = (start_date + timedelta(days=i) for i in range((stop_date - start_date).days + 1))
+    try:
+        process_dates(kommune_config, dates, force, case_pool, document_pool)
+    finally:
+        for pool in (case_pool, document_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+def log_summary(kommuner, elapsed):
+    """Log per-kommune and combined throughput for a finished crawl."""
+    totals = {}
+    log("")
+    log(f"{'kommune':<12} {'dates':>6} {'pages':>7} {'cases':>7} {'docs':>7} {'MB':>9} {'errors':>7} {'cases/s':>8} {'MB/s':>7}")
+    for kommune in kommuner:
+        counts, _ = get_crawl_stats(KOMMUNE_CONFIG[kommune]["base_url"]).snapshot()
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+        log(_summary_line(kommune, counts, elapsed))
+    if len(kommuner) > 1:
+        log(_summary_line("total", totals, elapsed))
+    log(f"Elapsed: {elapsed:.1f} s")
+
+def _summary_line(label, counts, elapsed):
+    megabytes = counts.get("bytes", 0) / (1024 * 1024)
+    elapsed = max(elapsed, 1e-9)
+    return (f"{label:<12} {counts.get('dates', 0):>6} {counts.get('pages', 0):>7} {counts.get('cases', 0):>7} "
+            f"{counts.get('documents', 0):>7} {megabytes:>9.1f} {counts.get('errors', 0):>7} "
+            f"{counts.get('cases', 0) / elapsed:>8.2f} {megabytes / elapsed:>7.2f}")
+
+def run_queue(args, kommuner, start_date, stop_date):
+    """Add the date range to the work queue and process it with one or more worker processes."""
+    shard, shards = None, 1
+    if args.shard:
+        try:
+            shard, shards = (int(x) for x in args.shard.split("/"))
+        except ValueError:
+            shard = -1
+        if not 0 <= shard < shards:
+            print("Error: --shard must be given as K/N with 0 <= K < N.")
+            return
+
+    try:
+        queue = WorkQueue(args.queue, max_attempts=args.max_attempts)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    for kommune in kommuner:
+        queue.enqueue_range(kommune, start_date, stop_date, shard, shards)
+    if args.retry_failed:
+        log(f"(Retrying {queue.retry_failed()} failed units)")
+
+    started = time.monotonic()
+    if args.processes > 1:
+        processes = [
+            multiprocessing.Process(target=_queue_worker_process, args=(args, shard, shards, index))
+            for index in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            log("Script stopped by user")
+            for process in processes:
+                process.join()
+    else:
+        try:
+            run_queue_worker(args.queue, args.force, args.workers, shard, shards, args.max_attempts)
+        except KeyboardInterrupt:
+            log("Script stopped by user")
+        log_summary(kommuner, time.monotonic() - started)
+    log("")
+    log_queue_status(queue)
+
+def configure_from_args(args, rate=None):
+    """Apply the crawl settings from the command line to this process."""
+    configure_rate_limit(rate or args.rate, args.burst)
+    configure_page_cache(None if args.no_cache else args.cache_dir)
+    configure_parser(args.parser)
+    configure_blob_store(not args.no_dedup)
+    configure_packed(args.packed)
+    configure_concurrency(args.workers, not args.no_adaptive, args.max_retries)
+
+def write_metrics_files(json_path=None, prometheus_path=None):
+    """Write the final metrics to the files given on the command line."""
+    if json_path:
+        write_metrics_json(json_path)
+    if prometheus_path:
+        write_metrics_prometheus(prometheus_path)
 
 def main():
     parser = argparse.ArgumentParser(description="Download case data for a specified kommune and date range.")
-    parser.add_argument("kommune", type=str, help="Name of the kommune (e.g., vagan, vestvagoy).")
+    parser.add_argument("kommune", type=str, help="Name of the kommune (e.g., vagan, vestvagoy), or 'all' to crawl every kommune at the same time.")
     parser.add_argument("start_date", type=str, help="Start date in YYYY-MM-DD format.")
     parser.add_argument("stop_date", type=str, help="Stop date in YYYY-MM-DD format.")
     parser.add_argument("-f", "--force", action="store_true", help="Force re-download of existing data.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help=f"Number of cases (and documents) fetched concurrently (default: 1). The requests to each host are still capped by --rate (default: {DEFAULT_RATE:g} per second).")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help=f"Maximum sustained requests per second per host (default: {DEFAULT_RATE}).")
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST, help=f"Number of requests allowed in a burst per host (default: {DEFAULT_BURST}).")
+    parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES, help=f"Retries of a request that times out or gets a 429/5xx response, with exponential backoff (default: {DEFAULT_MAX_RETRIES}).")
+    parser.add_argument("--no-adaptive", action="store_true", help="Always keep --workers requests in flight per host instead of adapting to the server's latency and errors.")
+    parser.add_argument("--parser", choices=["auto", "lxml", "html.parser"], default="auto", help="HTML parser backend (default: lxml if installed).")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR, help=f"Directory for the conditional-request page cache (default: {DEFAULT_CACHE_DIR}).")
+    parser.add_argument("--no-cache", action="store_true", help="Do not cache or revalidate fetched pages.")
+    parser.add_argument("--no-dedup", action="store_true", help="Store documents as plain files in each case directory instead of linking them from the content-addressed store.")
+    parser.add_argument("--packed", action="store_true", help="Pack each finished case into large segment files in the archive (see segments.py) instead of keeping a directory of small files per case.")
+    parser.add_argument("--metrics-json", type=str, help="Write a JSON summary of request rates, bytes, per-phase latencies and errors to this file at exit.")
+    parser.add_argument("--metrics-prom", type=str, help="Keep a Prometheus text file with the crawl metrics up to date while running.")
+    parser.add_argument("--metrics-port", type=int, help="Serve the crawl metrics for Prometheus on http://127.0.0.1:PORT/metrics while running.")
+    parser.add_argument("--metrics-host", type=str, default=DEFAULT_METRICS_HOST, help=f"Address for --metrics-port to listen on, e.g. 0.0.0.0 for a Prometheus on another machine (default: {DEFAULT_METRICS_HOST}).")
+    parser.add_argument("--queue", type=str, help="Work queue file (SQLite). The date range is added to the queue and processed from it, so an interrupted backfill resumes where it stopped.")
+    parser.add_argument("--processes", type=int, default=1, help="With --queue: number of worker processes claiming units (default: 1). The --rate is shared between them.")
+    parser.add_argument("--shard", type=str, help="With --queue: only enqueue and claim dates of shard K out of N, given as K/N (e.g. 0/3).")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help=f"With --queue: attempts before a unit is marked failed (default: {DEFAULT_MAX_ATTEMPTS}).")
+    parser.add_argument("--retry-failed", action="store_true", help="With --queue: put failed units back in the queue before starting.")
 
     args = parser.parse_args()
 
@@ -225,7 +1673,7 @@ def main():
     stop_date = args.stop_date
     force = args.force
 
-    if kommune not in KOMMUNE_CONFIG:
+    if kommune != "all" and kommune not in KOMMUNE_CONFIG:
         print(f"Error: Unknown kommune '{kommune}'. Supported kommune names: {', '.join(KOMMUNE_CONFIG.keys())}")
         return
 
@@ -236,22 +1684,43 @@ def main():
         print(f"Error: Invalid date format. Dates must be in YYYY-MM-DD format. ({e})")
         return
 
-    kommune_config = KOMMUNE_CONFIG[kommune]
+    if args.workers < 1 or args.processes < 1 or args.rate <= 0 or args.max_retries < 0:
+        print("Error: --workers and --processes must be at least 1, --rate must be positive and --max-retries can't be negative.")
+        return
 
-    current_date = start_date
-    while current_date <= stop_date:
-        try:
-            process_date(kommune_config, current_date, force)
-            if randint(1, 3) == 1:
-                sleep_time = randint(1, 5)
-                log(f"(Sleeping {sleep_time} seconds)")
-                time.sleep(sleep_time)
-        except KeyboardInterrupt:
-            log("Script stopped by user")
-            break
-        except Exception as e:
-            log(f"Error processing date {current_date}: {e}")
-        current_date += timedelta(days=1)
+    configure_from_args(args)
+
+    kommuner = list(KOMMUNE_CONFIG) if kommune == "all" else [kommune]
+    if args.queue:
+        if args.processes == 1:
+            start_metrics_exporter(args.metrics_prom, args.metrics_port, host=args.metrics_host)
+        run_queue(args, kommuner, start_date, stop_date)
+        if args.processes == 1:
+            write_metrics_files(args.metrics_json, args.metrics_prom)
+        return
+
+    start_metrics_exporter(args.metrics_prom, args.metrics_port, host=args.metrics_host)
+    started = time.monotonic()
+    try:
+        if len(kommuner) == 1:
+            crawl_kommune(kommune, start_date, stop_date, force, args.workers)
+        else:
+            # One thread per kommune; each gets its own pools and per-host rate limit
+            threads = [
+                threading.Thread(target=crawl_kommune, name=name, daemon=True,
+                                 args=(name, start_date, stop_date, force, args.workers, f"[{name}] "))
+                for name in kommuner
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+    except KeyboardInterrupt:
+        _stop_requested.set()
+        log("Script stopped by user")
+    log_summary(kommuner, time.monotonic() - started)
+    write_metrics_files(args.metrics_json, args.metrics_prom)
 
 
 if __name__ == "__main__":
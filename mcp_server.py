@@ -7,70 +7,576 @@ the downloaded kommune archive data via the Model Context Protocol.
 """
 
 import os
+import sys
 import glob
+import time
+import asyncio
+import sqlite3
+import functools
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
+from dataclasses import dataclass
 
 from fastmcp import FastMCP
 
+# watchdog is optional; without it the archives are polled for changes
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+from catalog import CATALOG_FILENAME, Catalog
+from search_index import SearchIndex, encode_cursor, decode_cursor
+from segments import SEGMENT_DIR_NAME, SegmentStore, is_packed
+from text_extract import TextCache, pdf_backend, sniff_kind, sniff_data_kind
+
 # Initialize the MCP server
 mcp = FastMCP("Kommune Archive Server")
 
 # Base directory for archives (can be overridden via environment variable)
 ARCHIVE_BASE_DIR = os.getenv("KOMMUNE_ARCHIVE_DIR", "./archive-*")
 
+# Minimum seconds between bringing an archive's search index up to date
+INDEX_REFRESH_INTERVAL = 10
 
-def get_available_communes() -> List[str]:
-    """Get list of available commune archives."""
-    archives = glob.glob(ARCHIVE_BASE_DIR)
-    communes = []
-    for archive in archives:
-        if os.path.isdir(archive):
-            commune_name = os.path.basename(archive).replace("archive-", "")
-            communes.append(commune_name)
-    return sorted(communes)
+# Index updates extract text in a pool of processes. Forking this multithreaded server could copy a lock
+# another thread holds into the workers, so they are started by a fork server (spawned where there is none)
+PROCESS_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
 
+# Seconds between polls of the archives for changes, and between applying changes reported by
+# watchdog; with watchdog, a full poll still runs now and then to find new archives
+POLL_INTERVAL = 15
+WATCH_INTERVAL = 1
+WATCHED_POLL_INTERVAL = 120
 
-def search_cases_in_directory(directory: str, search_term: str) -> List[Dict[str, str]]:
-    """Search for cases containing the search term in details.txt files."""
-    results = []
-    search_term_lower = search_term.lower()
-    
-    for details_file in glob.glob(f"{directory}/**/details.txt", recursive=True):
+# Tool calls run in bounded thread pools, so concurrent calls are served in parallel; quick lookups
+# have their own pool so they aren't held up behind searches and document text extraction
+LOOKUP_WORKERS = 4
+SEARCH_WORKERS = 4
+
+# Seconds a tool call may run before it is given up with an error
+TOOL_TIMEOUT = float(os.getenv("KOMMUNE_MCP_TIMEOUT", "30"))
+
+# SQLite steps between checks of whether a running query's tool call was cancelled
+CANCEL_CHECK_STEPS = 10000
+
+_lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix="mcp-lookup")
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="mcp-search")
+# The cancellation event of the tool call a pool thread is working on
+_request = threading.local()
+
+_search_indexes = {}
+_search_indexes_lock = threading.Lock()
+_text_caches = {}
+_text_caches_lock = threading.Lock()
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+@dataclass
+class CaseEntry:
+    """A case directory in the in-memory archive catalog."""
+    commune: str
+    date: str
+    name: str
+    path: str
+    summary: str
+    complete: bool
+    documents: Tuple[Tuple[str, int], ...]
+    packed: bool = False
+
+
+def _is_number_dir(entry) -> bool:
+    return entry.name.isdigit() and entry.is_dir()
+
+
+class ArchiveCatalog:
+    """In-memory catalog of the communes, dates, cases and documents in the archives.
+
+    Loaded on first use and kept current by a background thread. With
+    watchdog installed, the directories the filesystem reports as changed
+    are read again; otherwise the archives are polled every POLL_INTERVAL
+    seconds, and only date and case directories whose mtime changed are
+    read again. Cases re-recorded in catalog.sqlite are picked up as well,
+    and cases in a packed archive are listed from its segment index.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.lock = threading.RLock()
+        self.archives = {}       # commune -> archive directory
+        self.cases = {}          # absolute case directory -> CaseEntry
+        self.by_date = {}        # (commune, date) -> {case name: CaseEntry}
+        self.mtimes = {}         # absolute directory -> mtime when it was last read
+        self.children = {}       # absolute year/month directory -> its numbered subdirectories
+        self.watermarks = {}     # commune -> newest catalog.sqlite updated_at seen
+        self.segments = {}       # commune -> SegmentStore of a packed archive
+        self.packed_watermarks = {}  # commune -> newest packed_at seen in the segment index
+        self.pending = set()     # paths reported changed by the watcher
+        self.loaded = False
+        self.observer = None
+        self.handler = None
+        self.watched = set()
+
+    # Loading
+
+    def _load_case(self, commune: str, date: str, case_dir: str):
+        abs_dir = os.path.abspath(case_dir)
+        name = os.path.basename(abs_dir)
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+            entries = sorted(os.scandir(abs_dir), key=lambda e: e.name)
+            documents = tuple((e.name, e.stat().st_size) for e in entries
+                              if e.name != "details.txt" and not e.name.startswith(".") and e.is_file())
+        except OSError:
+            # A case directory removed by packing is read from the segment index instead
+            if not self._load_packed_case(commune, date, case_dir):
+                self._drop_case(abs_dir)
+            return
+        complete = any(e.name == "details.txt" for e in entries)
+        summary = name
+        if complete:
+            try:
+                with open(os.path.join(abs_dir, "details.txt"), "r", encoding="utf-8") as f:
+                    summary = next((line.strip() for line in f if line.strip()), name)
+            except OSError:
+                pass
+        entry = CaseEntry(commune, date, name, os.path.join(os.path.dirname(case_dir), name), summary, complete, documents)
+        self.cases[abs_dir] = entry
+        self.by_date.setdefault((commune, date), {})[name] = entry
+        self.mtimes[abs_dir] = mtime
+
+    def _segment_store(self, commune: str) -> Optional[SegmentStore]:
+        """The SegmentStore of a packed archive, or None if the archive isn't packed."""
+        store = self.segments.get(commune)
+        archive_dir = self.archives.get(commune)
+        if store is None and archive_dir is not None and is_packed(archive_dir):
+            store = self.segments[commune] = SegmentStore(archive_dir)
+        return store
+
+    def _load_packed_case(self, commune: str, date: str, case_dir: str) -> bool:
+        """Load a case from the segment index; returns False if it isn't packed."""
+        store = self._segment_store(commune)
+        archive_dir = self.archives.get(commune)
+        if store is None:
+            return False
+        rel_dir = os.path.relpath(os.path.abspath(case_dir), os.path.abspath(archive_dir))
+        packed = store.case(rel_dir)
+        if packed is None:
+            return False
+        abs_dir = os.path.abspath(case_dir)
+        name = os.path.basename(abs_dir)
+        details = store.read(os.path.join(rel_dir, "details.txt"))
+        summary = name
+        if details is not None:
+            summary = next((line.strip() for line in details.decode("utf-8", errors="replace").splitlines() if line.strip()), name)
+        documents = tuple(sorted((file_name, size) for file_name, size, _ in packed[1] if file_name != "details.txt"))
+        entry = CaseEntry(commune, date, name, os.path.join(archive_dir, rel_dir), summary, details is not None, documents, packed=True)
+        self.cases[abs_dir] = entry
+        self.by_date.setdefault((commune, date), {})[name] = entry
+        self.mtimes.pop(abs_dir, None)
+        return True
+
+    def _sync_packed(self, commune: str, archive_dir: str):
+        """Load the cases packed since the last sync, and drop packed cases if the archive was unpacked."""
+        store = self._segment_store(commune)
+        if store is None:
+            if commune in self.segments:
+                for abs_dir in [d for d, e in self.cases.items() if e.commune == commune and e.packed]:
+                    self._drop_case(abs_dir)
+                self.segments.pop(commune, None)
+                self.packed_watermarks.pop(commune, None)
+            return
+        if not is_packed(archive_dir):
+            # Unpacked while open: the store would keep reading the removed segment files
+            self.segments.pop(commune).close()
+            self._sync_packed(commune, archive_dir)
+            return
+        for rel_dir, date, packed_at in store.cases(since=self.packed_watermarks.get(commune, 0)):
+            if date:
+                self._load_packed_case(commune, date, os.path.join(archive_dir, rel_dir))
+            self.packed_watermarks[commune] = max(self.packed_watermarks.get(commune, 0), packed_at)
+
+    def _drop_case(self, abs_dir: str):
+        entry = self.cases.pop(abs_dir, None)
+        self.mtimes.pop(abs_dir, None)
+        if entry is not None:
+            self.by_date.get((entry.commune, entry.date), {}).pop(entry.name, None)
+
+    def _load_date(self, commune: str, date: str, date_dir: str):
+        """Read the case directories of one date, keeping unchanged cases as they are."""
+        abs_dir = os.path.abspath(date_dir)
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+            case_dirs = [e.name for e in os.scandir(abs_dir) if e.is_dir() and not e.name.startswith(".")]
+        except OSError:
+            case_dirs, mtime = [], None
+        for name, entry in list(self.by_date.get((commune, date), {}).items()):
+            if name not in case_dirs and not entry.packed and not self._load_packed_case(commune, date, entry.path):
+                self._drop_case(os.path.join(abs_dir, name))
+        for name in case_dirs:
+            case_abs = os.path.join(abs_dir, name)
+            try:
+                changed = os.stat(case_abs).st_mtime != self.mtimes.get(case_abs)
+            except OSError:
+                changed = True
+            if changed:
+                self._load_case(commune, date, os.path.join(date_dir, name))
+        if mtime is None:
+            self.mtimes.pop(abs_dir, None)
+            if not self.by_date.get((commune, date)):
+                self.by_date.pop((commune, date), None)
+        else:
+            self.mtimes[abs_dir] = mtime
+
+    def _numbered_children(self, directory: str) -> List[str]:
+        """The numbered subdirectories of a directory, listed again only when its mtime changes."""
+        abs_dir = os.path.abspath(directory)
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+        except OSError:
+            return []
+        if self.mtimes.get(abs_dir) != mtime or abs_dir not in self.children:
+            try:
+                self.children[abs_dir] = sorted(e.name for e in os.scandir(abs_dir) if _is_number_dir(e))
+            except OSError:
+                self.children[abs_dir] = []
+            self.mtimes[abs_dir] = mtime
+        return self.children[abs_dir]
+
+    def _sync_archive(self, commune: str, archive_dir: str):
+        """Bring one archive up to date, reading only new or changed date directories."""
+        seen = set()
+        for year in self._numbered_children(archive_dir):
+            year_dir = os.path.join(archive_dir, year)
+            for month in self._numbered_children(year_dir):
+                month_dir = os.path.join(year_dir, month)
+                for day in self._numbered_children(month_dir):
+                    date_dir = os.path.join(month_dir, day)
+                    date = f"{year}-{month}-{day}"
+                    seen.add(date)
+                    try:
+                        changed = os.stat(date_dir).st_mtime != self.mtimes.get(os.path.abspath(date_dir))
+                    except OSError:
+                        changed = True
+                    if changed:
+                        self._load_date(commune, date, date_dir)
+        for key in [key for key in self.by_date if key[0] == commune and key[1] not in seen]:
+            for name, entry in list(self.by_date[key].items()):
+                if not entry.packed:
+                    self._drop_case(os.path.join(os.path.abspath(archive_dir), *key[1].split("-"), name))
+            if not self.by_date[key]:
+                self.by_date.pop(key, None)
+
+    def _recheck_cases(self, commune: str, archive_dir: str):
+        """Re-read cases still being downloaded, and cases re-recorded in catalog.sqlite."""
+        for abs_dir, entry in list(self.cases.items()):
+            if entry.commune == commune and not entry.complete and not entry.packed:
+                try:
+                    changed = os.stat(abs_dir).st_mtime != self.mtimes.get(abs_dir)
+                except OSError:
+                    changed = True
+                if changed:
+                    self._load_case(commune, entry.date, entry.path)
+        catalog_path = os.path.join(archive_dir, CATALOG_FILENAME)
+        if not os.path.exists(catalog_path):
+            return
+        watermark = self.watermarks.get(commune)
         try:
-            with open(details_file, "r", encoding="utf-8") as f:
-                content = f.read()
-                if search_term_lower in content.lower():
-                    case_dir = os.path.dirname(details_file)
-                    case_name = os.path.basename(case_dir)
-                    
-                    # Extract date from path (format: archive-xxx/YYYY/MM/DD/case)
-                    path_parts = case_dir.split(os.sep)
-                    if len(path_parts) >= 4:
-                        year, month, day = path_parts[-4], path_parts[-3], path_parts[-2]
-                        date_str = f"{year}-{month}-{day}"
-                    else:
-                        date_str = "unknown"
-                    
-                    # Extract first line (usually contains the main IDs)
-                    first_lines = [line for line in content.split("\n") if line.strip()]
-                    summary = first_lines[0] if first_lines else case_name
-                    
-                    results.append({
-                        "case_name": case_name,
-                        "date": date_str,
-                        "path": case_dir,
-                        "summary": summary
-                    })
-        except Exception as e:
-            # Skip files that can't be read
-            continue
+            catalog = sqlite3.connect(catalog_path)
+            try:
+                if watermark is None:
+                    self.watermarks[commune] = catalog.execute("SELECT MAX(updated_at) FROM cases").fetchone()[0] or 0
+                    return
+                rows = catalog.execute("SELECT case_dir, date, updated_at FROM cases WHERE updated_at > ?",
+                                       (watermark,)).fetchall()
+            finally:
+                catalog.close()
+        except sqlite3.Error:
+            return
+        for case_dir, date, updated_at in rows:
+            if date:
+                self._load_case(commune, date, os.path.join(archive_dir, case_dir))
+            self.watermarks[commune] = max(self.watermarks[commune], updated_at)
+
+    def refresh(self):
+        """Find new and removed archives and bring every archive up to date."""
+        archives = {}
+        for archive in glob.glob(self.pattern):
+            if os.path.isdir(archive):
+                archives[os.path.basename(archive).replace("archive-", "")] = archive
+        with self.lock:
+            for commune in set(self.archives) - set(archives):
+                for abs_dir in [d for d, e in self.cases.items() if e.commune == commune]:
+                    self._drop_case(abs_dir)
+                self.by_date = {k: v for k, v in self.by_date.items() if k[0] != commune}
+                self.watermarks.pop(commune, None)
+                self.packed_watermarks.pop(commune, None)
+                if commune in self.segments:
+                    self.segments.pop(commune).close()
+            self.archives = archives
+            for commune, archive_dir in archives.items():
+                self._sync_archive(commune, archive_dir)
+                self._sync_packed(commune, archive_dir)
+                self._recheck_cases(commune, archive_dir)
+            self.loaded = True
+
+    # Watching
+
+    def _changed(self, path: str):
+        """Called by the watcher for every changed path."""
+        with self.lock:
+            self.pending.add(os.path.abspath(path))
+
+    def _apply_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, set()
+            for commune, archive_dir in self.archives.items():
+                root = os.path.abspath(archive_dir)
+                relevant = [os.path.relpath(p, root).split(os.sep) for p in pending if p.startswith(root + os.sep)]
+                relevant = [parts for parts in relevant if not any(part.startswith(".") for part in parts)]
+                if any(len(parts) <= 3 and parts[0].isdigit() for parts in relevant):
+                    self._sync_archive(commune, archive_dir)
+                dates = {tuple(parts[:3]) for parts in relevant if len(parts) == 4}
+                for year, month, day in dates:
+                    self._load_date(commune, f"{year}-{month}-{day}", os.path.join(archive_dir, year, month, day))
+                for parts in relevant:
+                    if len(parts) >= 5 and tuple(parts[:3]) not in dates:
+                        self._load_case(commune, "-".join(parts[:3]), os.path.join(archive_dir, *parts[:4]))
+                if any(parts[0] == SEGMENT_DIR_NAME for parts in
+                       (os.path.relpath(p, root).split(os.sep) for p in pending if p.startswith(root + os.sep))):
+                    self._sync_packed(commune, archive_dir)
+
+    def _start_observer(self):
+        catalog = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                catalog._changed(event.src_path)
+                if getattr(event, "dest_path", None):
+                    catalog._changed(event.dest_path)
+
+        self.handler = Handler()
+        self.observer = Observer()
+        self.observer.daemon = True
+        self.observer.start()
+        self._watch_new_archives()
+
+    def _watch_new_archives(self):
+        for archive_dir in set(self.archives.values()) - self.watched:
+            self.observer.schedule(self.handler, archive_dir, recursive=True)
+            self.watched.add(archive_dir)
+
+    def _run(self):
+        last_poll = time.monotonic()
+        while True:
+            time.sleep(WATCH_INTERVAL if self.observer is not None else POLL_INTERVAL)
+            try:
+                if self.observer is not None:
+                    self._apply_pending()
+                    if time.monotonic() - last_poll < WATCHED_POLL_INTERVAL:
+                        continue
+                    last_poll = time.monotonic()
+                    self.refresh()
+                    self._watch_new_archives()
+                else:
+                    self.refresh()
+            except Exception:
+                # Keep serving the last known state; the next round tries again. Logged to stderr, as stdout carries the MCP protocol
+                print(f"Archive catalog refresh failed:\n{traceback.format_exc()}", file=sys.stderr, flush=True)
+
+    def start(self):
+        """Load the catalog and keep it current in the background."""
+        with self.lock:
+            if self.loaded:
+                return
+            self.refresh()
+            if Observer is not None:
+                self._start_observer()
+        threading.Thread(target=self._run, name="archive-catalog", daemon=True).start()
+
+    # Lookups
+
+    def communes(self) -> List[str]:
+        self.start()
+        with self.lock:
+            return sorted(self.archives)
+
+    def archive_dir(self, commune: str) -> Optional[str]:
+        self.start()
+        with self.lock:
+            return self.archives.get(commune)
+
+    def cases_on(self, commune: str, date: str) -> List[CaseEntry]:
+        self.start()
+        with self.lock:
+            return sorted(self.by_date.get((commune, date), {}).values(), key=lambda e: e.name)
+
+    def case(self, path: str) -> Optional[CaseEntry]:
+        """Return the case at path; a case created since the last refresh is read on the spot."""
+        self.start()
+        abs_path = os.path.abspath(path)
+        with self.lock:
+            entry = self.cases.get(abs_path)
+            archive_dir = self.archive_for_path(abs_path) if entry is None else None
+            if archive_dir is not None:
+                parts = os.path.relpath(abs_path, os.path.abspath(archive_dir)).split(os.sep)
+                if len(parts) == 4 and all(part.isdigit() for part in parts[:3]):
+                    commune = next(c for c, d in self.archives.items() if d == archive_dir)
+                    # _load_case() falls back to the segment index when there is no directory
+                    self._load_case(commune, "-".join(parts[:3]), os.path.join(archive_dir, *parts))
+                    entry = self.cases.get(abs_path)
+            return entry
+
+    def read_packed(self, path: str) -> Optional[Tuple[bytes, str]]:
+        """(contents, sha256) of a file in a packed case, or None if it isn't packed."""
+        self.start()
+        archive_dir = self.archive_for_path(path)
+        with self.lock:
+            commune = next((c for c, d in self.archives.items() if d == archive_dir), None)
+            store = self._segment_store(commune) if commune is not None else None
+            if store is None:
+                return None
+            rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(archive_dir))
+            info = store.file_info(rel_path)
+        # Read outside the lock, so a large document doesn't hold up other lookups
+        return (store.read(rel_path), info[1]) if info is not None else None
+
+    def archive_for_path(self, path: str) -> Optional[str]:
+        """Return the archive directory that contains path, or None if it is outside the archives."""
+        self.start()
+        abs_path = os.path.abspath(path)
+        with self.lock:
+            for archive_dir in self.archives.values():
+                if abs_path.startswith(os.path.abspath(archive_dir) + os.sep):
+                    return archive_dir
+        return None
+
+
+ARCHIVES = ArchiveCatalog(ARCHIVE_BASE_DIR)
+
+
+def _interrupt_if_cancelled() -> int:
+    """SQLite progress handler: abort the running query when its tool call was cancelled or timed out."""
+    cancelled = getattr(_request, "cancelled", None)
+    return 1 if cancelled is not None and cancelled.is_set() else 0
+
+
+def offload(pool: ThreadPoolExecutor, error):
+    """Turn a blocking tool function into an async one that runs in pool.
     
-    return results
+    The call is given up after TOOL_TIMEOUT seconds, returning error(message).
+    When it is given up or cancelled by the client, it is dropped if it
+    hasn't started yet, and a running SQLite query is interrupted.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cancelled = threading.Event()
+
+            def call():
+                if cancelled.is_set():
+                    return None
+                _request.cancelled = cancelled
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    _request.cancelled = None
+
+            try:
+                return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(pool, call), TOOL_TIMEOUT)
+            except asyncio.TimeoutError:
+                return error(f"{func.__name__} timed out after {TOOL_TIMEOUT:g} seconds. Try a narrower query, or try again later.")
+            finally:
+                cancelled.set()
+        return wrapper
+    return decorator
+
+
+def list_error(message: str) -> List[Dict[str, str]]:
+    return [{"error": message}]
+
+
+def dict_error(message: str) -> Dict[str, str]:
+    return {"error": message}
+
+
+def text_error(message: str) -> str:
+    return f"Error: {message}"
+
+
+def get_available_communes() -> List[str]:
+    """Get list of available commune archives."""
+    return ARCHIVES.communes()
+
+
+def get_search_index(directory: str) -> SearchIndex:
+    """Return the search index for an archive directory, starting an update if it hasn't had one for a while.
+
+    The update runs in a background thread, and searches use the index as
+    it is until it is done, so a search never waits for one.
+    """
+    with _search_indexes_lock:
+        entry = _search_indexes.get(directory)
+        if entry is None:
+            index = SearchIndex(directory)
+            index.conn.set_progress_handler(_interrupt_if_cancelled, CANCEL_CHECK_STEPS)
+            entry = _search_indexes[directory] = {"index": index, "updated": 0.0, "updating": False}
+        start = not entry["updating"] and time.monotonic() - entry["updated"] > INDEX_REFRESH_INTERVAL
+        if start:
+            entry["updating"] = True
+    if start:
+        threading.Thread(target=_update_search_index, args=(directory, entry), name="search-index-update", daemon=True).start()
+    return entry["index"]
+
+
+def search_index_updating(directory: str) -> bool:
+    """Whether the search index of an archive directory is being updated."""
+    with _search_indexes_lock:
+        entry = _search_indexes.get(directory)
+        return entry is not None and entry["updating"]
+
+
+def _update_search_index(directory: str, entry: Dict[str, Any]) -> None:
+    """Bring a search index up to date; runs in its own thread, outside any tool call, so it is never interrupted."""
+    try:
+        entry["index"].update(mp_context=PROCESS_CONTEXT)
+    except Exception:
+        print(f"Search index update of {directory} failed:\n{traceback.format_exc()}", file=sys.stderr, flush=True)
+    finally:
+        with _search_indexes_lock:
+            entry["updated"] = time.monotonic()
+            entry["updating"] = False
+
+
+def search_cases_in_directory(directory: str, search_term: str, max_results: int = 20,
+                              cursor: Optional[str] = None, ranked: bool = False) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Search for cases whose details.txt or documents contain every word of the search term.
+
+    Results are newest first, or most relevant first with ranked=True. Returns
+    one page of results and the cursor for the next page (None on the last page).
+    """
+    index = get_search_index(directory)
+    if ranked:
+        results, next_cursor = index.search_ranked_page(search_term, max_results, cursor)
+    else:
+        results, next_cursor = index.search_page(search_term, max_results, cursor)
+    for result in results:
+        result["path"] = os.path.join(directory, result["path"])
+        if "score" in result:
+            result["score"] = round(result["score"], 3)
+    return results, next_cursor
 
 
 @mcp.tool()
+@offload(_lookup_pool, list_error)
 def list_communes() -> List[str]:
     """List all available commune archives.
     
@@ -84,39 +590,150 @@ def list_communes() -> List[str]:
 
 
 @mcp.tool()
-def search_cases(commune: str, search_term: str, max_results: int = 20) -> List[Dict[str, str]]:
+@offload(_search_pool, list_error)
+def search_cases(commune: str, search_term: str, max_results: int = 20, cursor: Optional[str] = None,
+                 ranked: bool = False) -> List[Dict[str, Any]]:
     """Search for cases in a commune archive by keyword.
     
+    Every word of the search term must match the start of a word in the case
+    (so "bygg" finds "byggesak") or, for words of three or more letters, part
+    of a word ("smolt" finds "Polarsmolt"), ignoring case and accents; "aa"
+    matches "å".
+    Results are newest first. With ranked=True they are ordered by relevance
+    (BM25) instead and include a score, and misspelt or inflected words also
+    match similar words ("Klepstadveien" finds "Kleppstadveien"). If there are
+    more than max_results matches, the last item is {"next_cursor": ...}; pass
+    that as cursor to get the next page.
+    
     Args:
         commune: Name of the commune (e.g., 'vagan', 'vestvagoy')
         search_term: Keyword to search for in case details
         max_results: Maximum number of results to return (default: 20)
+        cursor: next_cursor from the previous page of the same search
+        ranked: Order by relevance instead of date, with fuzzy matching
     
     Returns:
         List of matching cases with their metadata
     """
-    archive_dir = f"./archive-{commune}"
+    archive_dir = ARCHIVES.archive_dir(commune)
     
-    if not os.path.exists(archive_dir):
+    if archive_dir is None:
         return [{
             "error": f"Archive for commune '{commune}' not found. Available communes: {', '.join(get_available_communes())}"
         }]
     
-    results = search_cases_in_directory(archive_dir, search_term)
-    
-    # Sort by date (newest first) and limit results
-    results.sort(key=lambda x: x["date"], reverse=True)
-    results = results[:max_results]
+    try:
+        results, next_cursor = search_cases_in_directory(archive_dir, search_term, max_results, cursor, ranked)
+    except ValueError as e:
+        return [{"error": f"{e}. Use the next_cursor from the previous page of the same search."}]
     
     if not results:
+        updating = " (the search index is being updated, so try again shortly)" if search_index_updating(archive_dir) else ""
+        return [{
+            "message": f"No {'more ' if cursor else ''}cases found matching '{search_term}' in {commune} archive{updating}"
+        }]
+    
+    if next_cursor:
+        results.append({"next_cursor": next_cursor})
+    return results
+
+
+def get_catalog(directory: str) -> Optional[Catalog]:
+    """Return the catalog of an archive directory, or None if it has no catalog.sqlite."""
+    with _catalogs_lock:
+        if directory not in _catalogs:
+            if not os.path.exists(os.path.join(directory, CATALOG_FILENAME)):
+                return None
+            # Read-only: the server never creates, upgrades or reindexes a catalog download.py writes
+            catalog = Catalog(directory, read_only=True)
+            catalog.conn.set_progress_handler(_interrupt_if_cancelled, CANCEL_CHECK_STEPS)
+            _catalogs[directory] = catalog
+        return _catalogs[directory]
+
+
+@mcp.tool()
+@offload(_search_pool, list_error)
+def query_cases(commune: str, from_date: Optional[str] = None, to_date: Optional[str] = None,
+                sender: Optional[str] = None, dokumentansvarlig: Optional[str] = None,
+                arkivsak_id: Optional[str] = None, censored: Optional[bool] = None,
+                max_results: int = 50, cursor: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Find cases in a commune archive by their fields.
+    
+    All given filters must match. sender and dokumentansvarlig match names
+    starting with the given text, ignoring case ("polarsmolt" finds
+    "Polarsmolt AS"); arkivsak_id matches the start of the ArkivsakID
+    ("25/75"). Results are newest first. If there are more than max_results
+    matches, the last item is {"next_cursor": ...}; pass that as cursor to
+    get the next page.
+    
+    Args:
+        commune: Name of the commune (e.g., 'vagan', 'vestvagoy')
+        from_date: First date to include, in YYYY-MM-DD format
+        to_date: Last date to include, in YYYY-MM-DD format
+        sender: Sender name, or the start of it
+        dokumentansvarlig: Name of the Dokumentansvarlig, or the start of it
+        arkivsak_id: Start of the ArkivsakID (case number)
+        censored: True for only censored cases, False for only uncensored ones
+        max_results: Maximum number of results to return (default: 50)
+        cursor: next_cursor from the previous page of the same query
+    
+    Returns:
+        List of matching cases with their fields
+    """
+    archive_dir = ARCHIVES.archive_dir(commune)
+    if archive_dir is None:
         return [{
-            "message": f"No cases found matching '{search_term}' in {commune} archive"
+            "error": f"Archive for commune '{commune}' not found. Available communes: {', '.join(get_available_communes())}"
         }]
     
+    try:
+        from_date, to_date = [datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d") if value else None
+                              for value in (from_date, to_date)]
+    except ValueError:
+        return [{"error": f"Invalid date format. Use YYYY-MM-DD format."}]
+    
+    catalog = get_catalog(archive_dir)
+    if catalog is None:
+        return [{
+            "error": f"{archive_dir} has no {CATALOG_FILENAME}. Build it with 'python catalog.py rebuild {archive_dir}'."
+        }]
+    
+    if (sender or dokumentansvarlig) and not catalog.has_name_keys():
+        return [{
+            "error": f"The {CATALOG_FILENAME} of {archive_dir} predates name queries. "
+                     f"Upgrade it with 'python catalog.py query {archive_dir}' (or by running download.py)."
+        }]
+    
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return [{"error": f"{e}. Use the next_cursor from the previous page of the same query."}]
+    
+    cases = catalog.query_cases(from_date, to_date, sender, dokumentansvarlig, arkivsak_id, censored,
+                                max_results + 1, after)
+    if not cases:
+        return [{
+            "message": f"No {'more ' if cursor else ''}cases found matching the query in {commune} archive"
+        }]
+    
+    results = [{
+        "case_name": os.path.basename(case["case_dir"]),
+        "path": os.path.join(archive_dir, case["case_dir"]),
+        "date": case["date"],
+        "dokument_id": case["dokument_id"],
+        "arkivsak_id": case["arkivsak_id"],
+        "dokumentansvarlig": case["dokumentansvarlig"],
+        "senders": case["senders"],
+        "is_censored": case["is_censored"]
+    } for case in cases[:max_results]]
+    if len(cases) > max_results:
+        last = cases[max_results - 1]
+        results.append({"next_cursor": encode_cursor(last["date"], last["case_dir"])})
     return results
 
 
 @mcp.tool()
+@offload(_lookup_pool, dict_error)
 def get_case_details(case_path: str) -> Dict[str, any]:
     """Get detailed information about a specific case.
     
@@ -126,28 +743,24 @@ def get_case_details(case_path: str) -> Dict[str, any]:
     Returns:
         Dictionary with case details and list of documents
     """
-    if not os.path.exists(case_path):
+    case = ARCHIVES.case(case_path)
+    if case is None:
         return {"error": f"Case path not found: {case_path}"}
-    
-    details_file = os.path.join(case_path, "details.txt")
-    if not os.path.exists(details_file):
+    if not case.complete:
         return {"error": f"details.txt not found in {case_path}"}
     
     try:
-        with open(details_file, "r", encoding="utf-8") as f:
-            details_content = f.read()
+        if case.packed:
+            details_content = ARCHIVES.read_packed(os.path.join(case_path, "details.txt"))[0].decode("utf-8")
+        else:
+            with open(os.path.join(case_path, "details.txt"), "r", encoding="utf-8") as f:
+                details_content = f.read()
         
-        # List all files in the case directory
-        files = []
-        for file in os.listdir(case_path):
-            if file != "details.txt":
-                file_path = os.path.join(case_path, file)
-                file_size = os.path.getsize(file_path)
-                files.append({
-                    "name": file,
-                    "size_bytes": file_size,
-                    "path": file_path
-                })
+        files = [{
+            "name": name,
+            "size_bytes": size,
+            "path": os.path.join(case_path, name)
+        } for name, size in case.documents]
         
         return {
             "path": case_path,
@@ -160,6 +773,7 @@ def get_case_details(case_path: str) -> Dict[str, any]:
 
 
 @mcp.tool()
+@offload(_lookup_pool, list_error)
 def list_cases_by_date(commune: str, date: str) -> List[Dict[str, str]]:
     """List all cases for a specific date in a commune archive.
     
@@ -170,84 +784,119 @@ def list_cases_by_date(commune: str, date: str) -> List[Dict[str, str]]:
     Returns:
         List of cases for that date
     """
-    archive_dir = f"./archive-{commune}"
-    
-    if not os.path.exists(archive_dir):
+    if ARCHIVES.archive_dir(commune) is None:
         return [{
             "error": f"Archive for commune '{commune}' not found. Available communes: {', '.join(get_available_communes())}"
         }]
     
     try:
-        # Parse date and construct path
-        date_obj = datetime.strptime(date, "%Y-%m-%d")
-        date_path = os.path.join(
-            archive_dir,
-            date_obj.strftime("%Y"),
-            date_obj.strftime("%m"),
-            date_obj.strftime("%d")
-        )
-        
-        if not os.path.exists(date_path):
-            return [{
-                "message": f"No cases found for {date} in {commune} archive"
-            }]
-        
-        # List all case directories for this date
-        cases = []
-        for case_dir in os.listdir(date_path):
-            case_full_path = os.path.join(date_path, case_dir)
-            if os.path.isdir(case_full_path):
-                # Read first line of details for summary
-                details_file = os.path.join(case_full_path, "details.txt")
-                summary = case_dir
-                if os.path.exists(details_file):
-                    try:
-                        with open(details_file, "r", encoding="utf-8") as f:
-                            first_line = f.readline().strip()
-                            if first_line:
-                                summary = first_line
-                    except:
-                        pass
-                
-                cases.append({
-                    "case_name": case_dir,
-                    "path": case_full_path,
-                    "summary": summary
-                })
-        
-        return sorted(cases, key=lambda x: x["case_name"])
-        
-    except ValueError as e:
+        date = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
         return [{"error": f"Invalid date format. Use YYYY-MM-DD format."}]
+    
+    cases = [{
+        "case_name": case.name,
+        "path": case.path,
+        "summary": case.summary
+    } for case in ARCHIVES.cases_on(commune, date)]
+    if not cases:
+        return [{
+            "message": f"No cases found for {date} in {commune} archive"
+        }]
+    return cases
+
+
+def find_archive_dir(path: str) -> Optional[str]:
+    """Return the archive directory that contains path, or None if it is outside the archives."""
+    return ARCHIVES.archive_for_path(path)
+
+
+def get_text_cache(directory: str) -> TextCache:
+    """Return the extracted-text cache for an archive directory."""
+    with _text_caches_lock:
+        if directory not in _text_caches:
+            _text_caches[directory] = TextCache(directory)
+        return _text_caches[directory]
+
+
+def read_packed_file(archive_dir: str, path: str, data: bytes, sha256: str) -> str:
+    """read_archive_file() for a file read from a packed archive."""
+    kind = sniff_data_kind(data)
+    if kind == "text":
+        return data.decode("utf-8", errors="replace")
+    if kind:
+        text = get_text_cache(archive_dir).extract_packed({sha256: lambda: data}).get(sha256)
+        if text is not None:
+            return text
+    if kind == "pdf" and pdf_backend() is None:
+        return "Error: Can't extract text from PDF files; install pypdf (pip install pypdf) on the server."
+    return f"Error: No text could be extracted from {path}."
+
+
+def read_archive_file(path: str) -> str:
+    """Return the text of an archive file: text files as they are, PDF/DOCX documents as extracted text."""
+    try:
+        # Security check: only allow reading from archive directories
+        archive_dir = find_archive_dir(path)
+        if archive_dir is None:
+            return "Error: Access denied. Can only read files from kommune archives."
+        abs_path = os.path.abspath(path)
+        if not os.path.exists(abs_path):
+            packed = ARCHIVES.read_packed(abs_path)
+            if packed is not None:
+                return read_packed_file(archive_dir, path, *packed)
+
+        kind = sniff_kind(abs_path)
+        if kind == "text":
+            with open(abs_path, "r", encoding="utf-8", errors="replace") as f:
+                return f.read()
+        text = get_text_cache(archive_dir).text_for(abs_path) if kind else None
+        if text is not None:
+            return text
+        if kind == "pdf" and pdf_backend() is None:
+            return "Error: Can't extract text from PDF files; install pypdf (pip install pypdf) on the server."
+        return f"Error: No text could be extracted from {path}."
+    except FileNotFoundError:
+        return f"Error: File not found: {path}"
     except Exception as e:
-        return [{"error": f"Error listing cases: {str(e)}"}]
+        return f"Error reading file: {str(e)}"
 
 
 @mcp.resource("file://{path}")
+@offload(_search_pool, text_error)
 def read_file(path: str) -> str:
     """Read and return a file's content.
     
+    PDF and DOCX documents are returned as their extracted text.
+    
     Args:
         path: Absolute path to the file
     
     Returns:
         File content as string
     """
-    try:
-        # Security check: only allow reading from archive directories
-        abs_path = os.path.abspath(path)
-        if not any(abs_path.startswith(os.path.abspath(f"./archive-{commune}")) 
-                   for commune in get_available_communes()):
-            return "Error: Access denied. Can only read files from kommune archives."
-        
-        with open(abs_path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
-    except FileNotFoundError:
-        return f"Error: File not found: {path}"
-    except Exception as e:
-        return f"Error reading file: {str(e)}"
+    return read_archive_file(path)
+
+
+@mcp.tool()
+@offload(_search_pool, text_error)
+def read_document(path: str) -> str:
+    """Read the text of a file in a commune archive.
+    
+    PDF and DOCX documents are returned as their extracted text, and
+    details.txt and other text files as they are.
+    
+    Args:
+        path: Path to the file, as given in the documents of get_case_details
+    
+    Returns:
+        The text of the file, or an error message
+    """
+    return read_archive_file(path)
 
 
 if __name__ == "__main__":
+    # Load the archive catalog before serving, so the first tool call doesn't wait for it
+    ARCHIVES.start()
     # Run the MCP server
     mcp.run()
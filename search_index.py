@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+"""
+Persistent full-text index of an archive directory.
+
+The details.txt of every case, together with the text extracted from its
+PDF/DOCX documents (see text_extract.py), is tokenized into an inverted
+index in <output_dir>/search-index.sqlite, so a search looks up the
+matching cases instead of reading every file in the archive. Searches
+return the newest matching cases first, or with ranked=True the most
+relevant ones by BM25, where misspelt and inflected words also match
+similar words through a trigram index of the vocabulary. The index is kept up to date
+incrementally: cases that download.py has added to catalog.sqlite since
+the last update are re-indexed, and an archive without a catalog is
+scanned for details.txt files whose mtime has changed. Cases packed into
+segment files (see segments.py) are read through the segment index, with
+the time they were packed in place of the details.txt mtime.
+
+    python search_index.py update archive-vagan [archive-vestvagoy ...]
+    python search_index.py update --scan archive-vagan
+    python search_index.py update --rebuild archive-vagan
+"""
+
+import os
+import re
+import json
+import math
+import heapq
+import base64
+import time
+import sqlite3
+import argparse
+import threading
+import functools
+import unicodedata
+
+from concurrent.futures import ProcessPoolExecutor
+
+from catalog import CATALOG_FILENAME, case_date_from_path
+from segments import SegmentStore, is_packed
+from text_extract import TextCache, document_files, pdf_backend
+
+SEARCH_INDEX_FILENAME = "search-index.sqlite"
+
+# Changed whenever what is indexed changes; an index of another version is rebuilt
+INDEX_VERSION = "3"
+
+# Cases indexed per transaction, and the number of changed cases worth starting extraction processes for
+INDEX_BATCH_SIZE = 200
+PROCESS_POOL_MIN_CASES = 20
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Average case length in terms assumed for BM25 impacts until the index has cases, and how far the
+# real average may drift from the one the impacts were computed with before update() recomputes them
+DEFAULT_AVERAGE_LENGTH = 200
+IMPACT_REFRESH_DRIFT = 0.2
+
+# Ranked search: the score of a prefix, infix or fuzzy match relative to an exact word match, the most index
+# terms a query word expands to, and the trigram similarity and word length needed for fuzzy matches
+PREFIX_WEIGHT = 0.8
+INFIX_WEIGHT = 0.7
+FUZZY_WEIGHT = 0.6
+MAX_PREFIX_TERMS = 50
+MAX_FUZZY_TERMS = 8
+FUZZY_MIN_SIMILARITY = 0.5
+FUZZY_MIN_LENGTH = 4
+
+# Query words of letters at least this long also match inside longer words ("smolt" finds "polarsmolt")
+INFIX_MIN_LENGTH = 3
+
+# A ranked search over at most this many postings scores every match; larger ones stop early
+DIRECT_SCORE_MAX_POSTINGS = 2000
+
+# A search whose rarest word has fewer postings than this sorts that word's cases; others scan cases newest first
+ORDERED_SCAN_MIN_POSTINGS = 2000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    date TEXT,
+    summary TEXT,
+    length INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    impact REAL NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+CREATE INDEX IF NOT EXISTS postings_impact ON postings (term, impact DESC);
+DROP INDEX IF EXISTS docs_date;
+CREATE INDEX IF NOT EXISTS docs_order ON docs (date DESC, path);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trigrams (
+    gram TEXT NOT NULL,
+    term TEXT NOT NULL,
+    PRIMARY KEY (gram, term)
+) WITHOUT ROWID;
+"""
+
+# Accented letters from other languages fold to their Norwegian base letter; æ, ø and å are kept
+FOLD_TABLE = str.maketrans({
+    "ä": "æ", "ö": "ø", "á": "a", "à": "a", "â": "a", "é": "e", "è": "e", "ê": "e", "ë": "e",
+    "ó": "o", "ò": "o", "ô": "o", "ü": "u", "ú": "u", "í": "i", "ç": "c", "ñ": "n",
+})
+
+# Words, numbers and compounds joined by / . _ - such as case numbers (25/75) and dates
+TOKEN_RE = re.compile(r"[^\W_]+(?:[/._\-][^\W_]+)*")
+JOINER_RE = re.compile(r"[/._\-]")
+
+
+def fold(text):
+    """Casefold text for matching: æ, ø and å are letters of their own, "aa" is å, other accents are dropped."""
+    return unicodedata.normalize("NFC", text).casefold().translate(FOLD_TABLE).replace("aa", "å")
+
+
+def tokenize(text):
+    """Split text into folded index terms.
+
+    A compound like 25/75 or 25_75 (as in directory names) is indexed as
+    "25/75" and as its parts, so it is found by either.
+    """
+    terms = []
+    for match in TOKEN_RE.finditer(fold(text)):
+        token = match.group(0)
+        parts = JOINER_RE.split(token)
+        if len(parts) > 1:
+            terms.append("/".join(parts))
+            terms.extend(parts)
+        else:
+            terms.append(token)
+    return terms
+
+
+def trigrams(term):
+    """The trigrams of a term, with $ marking its start and end."""
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def is_fuzzy_term(term):
+    """Whether a term takes part in fuzzy matching: words of letters, not numbers, codes or short words."""
+    return len(term) >= FUZZY_MIN_LENGTH and term.isalpha()
+
+
+def infix_trigrams(word):
+    """The unpadded trigrams every indexed word containing word has, or [] if word doesn't match inside words."""
+    if len(word) < INFIX_MIN_LENGTH or not word.isalpha():
+        return []
+    return sorted({word[i:i + 3] for i in range(len(word) - 2)})
+
+
+def idf(df, count):
+    """BM25 inverse document frequency of a term found in df of count cases."""
+    return math.log(1 + (count - df + 0.5) / (df + 0.5))
+
+
+def details_summary(content, default):
+    """The first non-empty line of a details.txt, which usually holds the main IDs."""
+    for line in content.split("\n"):
+        if line.strip():
+            return line.strip()
+    return default
+
+
+def encode_cursor(date, path):
+    """An opaque pagination cursor for the result with this date and path."""
+    return base64.urlsafe_b64encode(json.dumps([date, path]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """The (date, path) in a cursor from encode_cursor(); raises ValueError if it isn't one."""
+    try:
+        date, path = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if not isinstance(date, str) or not isinstance(path, str):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return date, path
+
+
+class SearchIndex:
+    """Inverted index over the details.txt files of one archive directory."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()  # One update at a time; self.lock guards the connection
+        self.conn = sqlite3.connect(os.path.join(output_dir, SEARCH_INDEX_FILENAME), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if self._meta("version") != INDEX_VERSION:
+            # The tables of another version may differ, so start over; update() then indexes every case
+            for table in ("docs", "postings", "terms", "trigrams"):
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute("DELETE FROM meta")
+            self._set_meta("version", INDEX_VERSION)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.average_length = float(self._meta("impact_length", DEFAULT_AVERAGE_LENGTH))
+        self.text_cache = TextCache(output_dir)
+        self.segments = None
+
+    def _segment_store(self):
+        """The archive's SegmentStore if it has packed cases, else None."""
+        if self.segments is None and is_packed(self.output_dir):
+            self.segments = SegmentStore(self.output_dir)
+        return self.segments
+
+    def _packed_documents(self, rel_paths):
+        """{sha256: function reading the document} for the documents of the given cases that are packed."""
+        store = self._segment_store()
+        documents = {}
+        for rel_path in rel_paths if store is not None else ():
+            packed = store.case(rel_path)
+            if packed is not None and not os.path.isdir(os.path.join(self.output_dir, rel_path)):
+                for name, _, sha256 in packed[1]:
+                    if name != "details.txt":
+                        documents[sha256] = functools.partial(store.read, os.path.join(rel_path, name))
+        return documents
+
+    def _meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def _remove(self, doc_id):
+        self.conn.execute("UPDATE terms SET df = df - 1 WHERE term IN (SELECT term FROM postings WHERE doc = ?)", (doc_id,))
+        self.conn.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+        self.conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    def _index_case(self, rel_path, mtime, texts):
+        """(Re)index one case from its details.txt and the extracted text of its documents; mtime None removes it.
+
+        texts holds the text of the documents by path, or by SHA-256 for packed documents.
+        """
+        case_dir = os.path.join(self.output_dir, rel_path)
+        row = self.conn.execute("SELECT id FROM docs WHERE path = ?", (rel_path,)).fetchone()
+        if row:
+            self._remove(row[0])
+        if mtime is None:
+            return
+        packed = None
+        try:
+            with open(os.path.join(case_dir, "details.txt"), "r", encoding="utf-8") as f:
+                content = f.read()
+        except OSError:
+            store = self._segment_store()
+            packed = store.case(rel_path) if store is not None else None
+            if packed is None:
+                return
+            content = store.read(os.path.join(rel_path, "details.txt")).decode("utf-8")
+
+        case_name = os.path.basename(rel_path)
+        if packed is not None:
+            document_text = "\n".join(texts[sha256] for name, _, sha256 in sorted(packed[1]) if name != "details.txt" and sha256 in texts)
+        else:
+            document_text = "\n".join(texts[path] for path in document_files(case_dir) if path in texts)
+        self._index_text(rel_path, mtime, case_date_from_path(rel_path) or "unknown",
+                         details_summary(content, case_name), case_name + "\n" + content + "\n" + document_text)
+
+    def _index_text(self, rel_path, mtime, date, summary, text):
+        """Add a case to the index from its text, with each term's BM25 impact; it must not be indexed already."""
+        terms = tokenize(text)
+        frequencies = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        cursor = self.conn.execute("INSERT INTO docs (path, date, summary, length, mtime) VALUES (?, ?, ?, ?, ?)",
+                                   (rel_path, date, summary, len(terms), mtime))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(terms) / self.average_length)
+        self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+                              [(term, cursor.lastrowid, tf, tf * (BM25_K1 + 1) / (tf + norm))
+                               for term, tf in frequencies.items()])
+        self._add_terms(list(frequencies))
+
+    def _add_terms(self, terms):
+        """Count a new case in the document frequency of its terms, adding new terms to the vocabulary."""
+        known = set()
+        for i in range(0, len(terms), 500):
+            chunk = terms[i:i + 500]
+            known.update(row[0] for row in self.conn.execute(
+                f"SELECT term FROM terms WHERE term IN ({', '.join('?' * len(chunk))})", chunk))
+        new = [term for term in terms if term not in known]
+        self.conn.executemany("INSERT INTO terms VALUES (?, 1)", [(term,) for term in new])
+        self.conn.executemany("UPDATE terms SET df = df + 1 WHERE term = ?", [(term,) for term in known])
+        self.conn.executemany("INSERT OR IGNORE INTO trigrams VALUES (?, ?)",
+                              [(gram, term) for term in new if is_fuzzy_term(term) for gram in trigrams(term)])
+
+    def _refresh_impacts(self):
+        """Recompute the BM25 impacts if the average case length has drifted from the one they use."""
+        count, total = self.conn.execute("SELECT COUNT(*), SUM(length) FROM docs").fetchone()
+        if not count or not total:
+            return
+        average = total / count
+        if self._meta("impact_length") is not None and abs(average / self.average_length - 1) <= IMPACT_REFRESH_DRIFT:
+            return
+        self.conn.execute("UPDATE postings SET impact = tf * ? / (tf + ? * (? + ? * (SELECT length FROM docs WHERE id = doc)))",
+                          (BM25_K1 + 1, BM25_K1, 1 - BM25_B, BM25_B / average))
+        self.average_length = average
+        self._set_meta("impact_length", average)
+
+    def update(self, scan=False, processes=None, rebuild=False, mp_context=None):
+        """Bring the index up to date and return the number of cases added, changed or removed.
+
+        Uses the cases recorded in catalog.sqlite since the last update when
+        there is a catalog, and otherwise (or on the first update, or with
+        scan=True) walks the archive comparing details.txt mtimes. The text of
+        the documents in changed cases is extracted through the text cache, in
+        a pool of processes (default: one per CPU) when there are many,
+        started with mp_context if given. With rebuild=True every case is
+        indexed again.
+
+        Searches can run during an update: the text is extracted without
+        holding the index lock, which is only taken to find the stale cases
+        and to write each batch.
+        """
+        catalog_path = os.path.join(self.output_dir, CATALOG_FILENAME)
+        with self.update_lock:
+            with self.lock:
+                if rebuild:
+                    for table in ("docs", "postings", "terms", "trigrams"):
+                        self.conn.execute(f"DELETE FROM {table}")
+                first = self.conn.execute("SELECT 1 FROM docs LIMIT 1").fetchone() is None
+                if os.path.exists(catalog_path) and not scan and not first:
+                    stale, watermark = self._stale_from_catalog(catalog_path)
+                else:
+                    stale, watermark = self._stale_from_scan(catalog_path)
+
+            executor = None
+            if len(stale) >= PROCESS_POOL_MIN_CASES and processes != 1:
+                executor = ProcessPoolExecutor(max_workers=processes, mp_context=mp_context)
+            try:
+                for i in range(0, len(stale), INDEX_BATCH_SIZE):
+                    batch = stale[i:i + INDEX_BATCH_SIZE]
+                    paths = [path for rel_path, mtime in batch if mtime is not None
+                             for path in document_files(os.path.join(self.output_dir, rel_path))]
+                    texts = self.text_cache.extract_files(paths, executor)
+                    packed = self._packed_documents([rel_path for rel_path, mtime in batch if mtime is not None])
+                    if packed:
+                        texts.update(self.text_cache.extract_packed(packed, executor))
+                    with self.lock:
+                        for rel_path, mtime in batch:
+                            self._index_case(rel_path, mtime, texts)
+                        self.conn.commit()
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+            with self.lock:
+                if stale:
+                    self._refresh_impacts()
+                if watermark is not None:
+                    self._set_meta("catalog_updated_at", watermark)
+                self.conn.commit()
+        return len(stale)
+
+    def _catalog_watermark(self, catalog_path):
+        """The newest updated_at in the catalog, or None without a catalog."""
+        if not os.path.exists(catalog_path):
+            return None
+        catalog = sqlite3.connect(catalog_path)
+        try:
+            return catalog.execute("SELECT MAX(updated_at) FROM cases").fetchone()[0]
+        except sqlite3.Error:
+            return None
+        finally:
+            catalog.close()
+
+    def _stale_from_catalog(self, catalog_path):
+        """Cases recorded in the catalog since the last update whose details.txt changed, as (path, mtime) pairs."""
+        # Look a little behind the watermark; a case recorded by another process may commit late
+        watermark = float(self._meta("catalog_updated_at", 0))
+        catalog = sqlite3.connect(catalog_path)
+        try:
+            rows = catalog.execute("SELECT case_dir, updated_at FROM cases WHERE updated_at > ?",
+                                   (watermark - 5,)).fetchall()
+        finally:
+            catalog.close()
+        stale = []
+        for rel_path, updated_at in rows:
+            watermark = max(watermark, updated_at)
+            try:
+                mtime = os.stat(os.path.join(self.output_dir, rel_path, "details.txt")).st_mtime
+            except OSError:
+                mtime = self._packed_at(rel_path)
+            row = self.conn.execute("SELECT mtime FROM docs WHERE path = ?", (rel_path,)).fetchone()
+            if (row[0] if row else None) != mtime:
+                stale.append((rel_path, mtime))
+        return stale, watermark
+
+    def _packed_at(self, rel_path):
+        """When a case was packed, or None if it isn't packed either."""
+        store = self._segment_store()
+        packed = store.case(rel_path) if store is not None else None
+        return packed[0] if packed is not None else None
+
+    def _stale_from_scan(self, catalog_path):
+        """Cases in the archive that are new, changed or gone since the last update, as (path, mtime) pairs."""
+        watermark = self._catalog_watermark(catalog_path)
+        known = dict(self.conn.execute("SELECT path, mtime FROM docs"))
+        seen = set()
+        stale = []
+        for root, dirs, files in os.walk(self.output_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if "details.txt" not in files:
+                continue
+            dirs[:] = []
+            rel_path = os.path.relpath(root, self.output_dir)
+            try:
+                mtime = os.stat(os.path.join(root, "details.txt")).st_mtime
+            except OSError:
+                continue
+            seen.add(rel_path)
+            if known.get(rel_path) != mtime:
+                stale.append((rel_path, mtime))
+        store = self._segment_store()
+        for rel_path, _, packed_at in store.cases() if store is not None else ():
+            if rel_path not in seen:
+                seen.add(rel_path)
+                if known.get(rel_path) != packed_at:
+                    stale.append((rel_path, packed_at))
+        stale.extend((rel_path, None) for rel_path in set(known) - seen)
+        return stale, watermark
+
+    def search(self, query, limit=20, after=None):
+        """Return up to limit cases matching every word of the query, newest first.
+
+        Each query word matches index terms starting with it, so "bygg" finds
+        "byggesak", and a word of letters also matches inside longer words,
+        so "smolt" finds "Polarsmolt". Results are dicts with case_name, date, path (relative to
+        the archive directory) and summary. With after=(date, path), only
+        cases that sort after that one are returned.
+
+        When every word is common, cases are read newest first through the
+        docs_order index and each is checked against the postings, stopping
+        after limit matches, so the first page doesn't cost every match. When
+        the rarest word has few postings, its cases are read and sorted instead.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self.lock:
+            counts = {term: self._count_postings(term, ORDERED_SCAN_MIN_POSTINGS) for term in terms}
+            rarest = min(terms, key=counts.get)
+            ordered = counts[rarest] >= ORDERED_SCAN_MIN_POSTINGS
+            conditions, params = [], []
+            if not ordered:
+                term_condition, term_params = self._term_condition(rarest)
+                conditions.append(f"id IN (SELECT doc FROM postings WHERE {term_condition})")
+                params += term_params
+            for term in terms:
+                if ordered or term != rarest:
+                    term_condition, term_params = self._term_condition(term)
+                    conditions.append(f"EXISTS (SELECT 1 FROM postings INDEXED BY postings_doc "
+                                      f"WHERE doc = docs.id AND {term_condition})")
+                    params += term_params
+            if after is not None:
+                conditions.append("(date < ? OR (date = ? AND path > ?))")
+                params += [after[0], after[0], after[1]]
+            rows = self.conn.execute(f"SELECT path, date, summary FROM docs "
+                                     f"{'INDEXED BY docs_order' if ordered else 'NOT INDEXED'} "
+                                     f"WHERE {' AND '.join(conditions)} ORDER BY date DESC, path LIMIT ?",
+                                     params + [limit]).fetchall()
+        return [{"case_name": os.path.basename(path), "date": date, "path": path, "summary": summary}
+                for path, date, summary in rows]
+
+    def _count_postings(self, term, limit):
+        """The number of postings for terms term matches, counting no further than limit."""
+        term_condition, term_params = self._term_condition(term)
+        return self.conn.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM postings WHERE {term_condition} LIMIT ?)",
+                                 term_params + [limit]).fetchone()[0]
+
+    def _term_condition(self, word):
+        """SQL condition on postings.term, with its parameters, for the index terms a query word matches.
+
+        Terms starting with the word are a range of the postings key. Terms
+        containing it further in are the trigram index's terms that have
+        every trigram of the word, checked with instr() since having the
+        trigrams doesn't make the word a substring. Only words of letters
+        are in the trigram index, as for fuzzy matching.
+        """
+        condition, params = "term >= ? AND term < ?", [word, word + "\U0010ffff"]
+        grams = infix_trigrams(word)
+        if grams:
+            condition = (f"({condition} OR term IN (SELECT term FROM trigrams WHERE gram IN ({', '.join('?' * len(grams))}) "
+                         "GROUP BY term HAVING COUNT(*) = ? AND instr(term, ?) > 1))")
+            params += grams + [len(grams), word]
+        return condition, params
+
+    def search_page(self, query, limit=20, cursor=None):
+        """Return (results, next_cursor) for one page of search results.
+
+        next_cursor is None on the last page; pass it back as cursor to get
+        the next page, which continues after the last result instead of
+        searching from the start. Raises ValueError for a malformed cursor.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        if after is not None and after[0] == "ranked":
+            raise ValueError(f"Invalid cursor: {cursor!r}")
+        results = self.search(query, limit + 1, after)
+        if len(results) <= limit:
+            return results, None
+        results = results[:limit]
+        return results, encode_cursor(results[-1]["date"], results[-1]["path"])
+
+    def search_ranked(self, query, limit=20, offset=0):
+        """Return up to limit cases matching every word of the query, most relevant first, skipping offset.
+
+        Results are dicts like those of search() with a BM25 "score". A query
+        word matches the same word, up to MAX_PREFIX_TERMS of the most common
+        words starting with it and as many containing it further in, and up
+        to MAX_FUZZY_TERMS words with similar trigrams (misspellings,
+        inflections), with lower weights for prefix, infix and fuzzy matches. A case scores the best match of each word.
+
+        When the matching words have few postings all of them are scored;
+        otherwise the postings are read best impact first and scoring stops
+        as soon as no unseen case can make it into the results.
+        """
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words:
+            return []
+        with self.lock:
+            count = self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            expansions = [self._expand(word) for word in words]
+            if not all(expansions):
+                return []
+            weights = [{term: weight * idf(df, count) for term, (weight, df) in expansion.items()}
+                       for expansion in expansions]
+            if sum(df for expansion in expansions for _, df in expansion.values()) <= DIRECT_SCORE_MAX_POSTINGS:
+                scores = self._score_all(weights)
+            else:
+                scores = self._score_top(weights, offset + limit)
+            ranked = heapq.nsmallest(offset + limit, scores.items(), key=lambda item: (-item[1], item[0]))[offset:]
+            rows = {}
+            for doc, path, date, summary in self.conn.execute(
+                    f"SELECT id, path, date, summary FROM docs WHERE id IN ({', '.join('?' * len(ranked))})",
+                    [doc for doc, _ in ranked]):
+                rows[doc] = (path, date, summary)
+        return [{"case_name": os.path.basename(rows[doc][0]), "date": rows[doc][1], "path": rows[doc][0],
+                 "summary": rows[doc][2], "score": score}
+                for doc, score in ranked if doc in rows]
+
+    def _expand(self, word):
+        """The index terms a ranked query word matches, as {term: (weight, document frequency)}."""
+        expansions = {}
+        row = self.conn.execute("SELECT df FROM terms WHERE term = ? AND df > 0", (word,)).fetchone()
+        if row:
+            expansions[word] = (1.0, row[0])
+        for term, df in self.conn.execute("SELECT term, df FROM terms WHERE term > ? AND term < ? AND df > 0 "
+                                          "ORDER BY df DESC LIMIT ?", (word, word + "\U0010ffff", MAX_PREFIX_TERMS)):
+            expansions[term] = (PREFIX_WEIGHT, df)
+        grams = infix_trigrams(word)
+        if grams:
+            for term, df in self.conn.execute(
+                    f"SELECT term, df FROM terms WHERE term IN (SELECT term FROM trigrams WHERE gram IN ({', '.join('?' * len(grams))}) "
+                    "GROUP BY term HAVING COUNT(*) = ? AND instr(term, ?) > 1) AND df > 0 ORDER BY df DESC LIMIT ?",
+                    grams + [len(grams), word, MAX_PREFIX_TERMS]):
+                expansions.setdefault(term, (INFIX_WEIGHT, df))
+        if is_fuzzy_term(word):
+            for term, similarity, df in self._fuzzy_terms(word):
+                expansions.setdefault(term, (FUZZY_WEIGHT * similarity, df))
+        return expansions
+
+    def _fuzzy_terms(self, word):
+        """Up to MAX_FUZZY_TERMS (term, similarity, df) whose trigrams are similar to the word's, most similar first.
+
+        Similarity is the Jaccard index of the trigram sets. A term at least
+        FUZZY_MIN_SIMILARITY similar shares at least that share of the word's
+        trigrams, so the shared trigrams are counted in SQL and only the
+        terms with enough of them are compared. Like most spelling
+        correction, only terms with the same first letter are considered,
+        which keeps the count to a range of each trigram's terms.
+        """
+        grams = sorted(trigrams(word))
+        needed = math.ceil(FUZZY_MIN_SIMILARITY * len(grams))
+        candidates = self.conn.execute(f"SELECT term, COUNT(*) FROM trigrams WHERE gram IN ({', '.join('?' * len(grams))}) "
+                                       "AND term >= ? AND term < ? GROUP BY term HAVING COUNT(*) >= ?",
+                                       grams + [word[0], word[0] + "\U0010ffff", needed]).fetchall()
+        similar = []
+        for term, shared in candidates:
+            similarity = shared / (len(grams) + len(trigrams(term)) - shared)
+            if term != word and similarity >= FUZZY_MIN_SIMILARITY:
+                similar.append((similarity, term))
+        results = []
+        for similarity, term in sorted(similar, reverse=True):
+            row = self.conn.execute("SELECT df FROM terms WHERE term = ? AND df > 0", (term,)).fetchone()
+            if row:
+                results.append((term, similarity, row[0]))
+                if len(results) == MAX_FUZZY_TERMS:
+                    break
+        return results
+
+    def _score_all(self, weights):
+        """BM25 scores {doc: score} of every case matching all query words; weights are {term: weight × idf} per word."""
+        best = []
+        for word_weights in weights:
+            scores = {}
+            terms = list(word_weights)
+            for i in range(0, len(terms), 500):
+                chunk = terms[i:i + 500]
+                for term, doc, impact in self.conn.execute(
+                        f"SELECT term, doc, impact FROM postings WHERE term IN ({', '.join('?' * len(chunk))})", chunk):
+                    score = word_weights[term] * impact
+                    if score > scores.get(doc, 0.0):
+                        scores[doc] = score
+            best.append(scores)
+        docs = set(best[0]).intersection(*best[1:])
+        return {doc: sum(scores[doc] for scores in best) for doc in docs}
+
+    def _score_top(self, weights, k):
+        """BM25 scores of the k best cases matching all query words, with the threshold algorithm.
+
+        Each word's postings are read in order of falling score through the
+        postings_impact index, a round at a time. A case seen for the first
+        time is scored in full by looking up its postings for the other
+        words. Once k cases score at least the sum of the scores at the
+        read positions, no unread case can beat them, and once any word's
+        postings are used up every case matching all words has been seen.
+        """
+        streams = [self._impact_stream(word_weights) for word_weights in weights]
+        all_terms = {term for word_weights in weights for term in word_weights}
+        lookup = (f"SELECT term, impact FROM postings WHERE doc = ? "
+                  f"AND term IN ({', '.join('?' * len(all_terms))})")
+        all_terms = list(all_terms)
+        bounds = [math.inf] * len(streams)
+        seen = set()
+        top = []
+        while True:
+            for i, stream in enumerate(streams):
+                entry = next(stream, None)
+                if entry is None:
+                    return {-negated_doc: score for score, negated_doc in top}
+                bounds[i], doc = entry
+                if doc in seen:
+                    continue
+                seen.add(doc)
+                impacts = dict(self.conn.execute(lookup, [doc] + all_terms).fetchall())
+                score = 0.0
+                for word_weights in weights:
+                    word_score = max((weight * impacts[term] for term, weight in word_weights.items() if term in impacts),
+                                     default=None)
+                    if word_score is None:
+                        break
+                    score += word_score
+                else:
+                    # Ties go to the lower doc id, as in search_ranked()
+                    if len(top) < k:
+                        heapq.heappush(top, (score, -doc))
+                    elif (score, -doc) > top[0]:
+                        heapq.heapreplace(top, (score, -doc))
+            if len(top) >= k and top[0][0] >= sum(bounds):
+                return {-negated_doc: score for score, negated_doc in top}
+
+    def _impact_stream(self, word_weights):
+        """(score, doc) for every posting of one query word's terms, highest score first."""
+        def term_stream(term, weight):
+            cursor = self.conn.execute("SELECT impact, doc FROM postings INDEXED BY postings_impact "
+                                       "WHERE term = ? ORDER BY impact DESC", (term,))
+            while True:
+                rows = cursor.fetchmany(256)
+                if not rows:
+                    return
+                for impact, doc in rows:
+                    yield weight * impact, doc
+        return heapq.merge(*(term_stream(term, weight) for term, weight in word_weights.items()),
+                           key=lambda entry: -entry[0])
+
+    def search_ranked_page(self, query, limit=20, cursor=None):
+        """Return (results, next_cursor) for one page of ranked search results, like search_page()."""
+        offset = 0
+        if cursor:
+            kind, position = decode_cursor(cursor)
+            if kind != "ranked" or not position.isdigit():
+                raise ValueError(f"Invalid cursor: {cursor!r}")
+            offset = int(position)
+        results = self.search_ranked(query, limit + 1, offset)
+        if len(results) <= limit:
+            return results, None
+        # A ranked cursor holds the number of results already returned
+        return results[:limit], encode_cursor("ranked", str(offset + limit))
+
+    def close(self):
+        self.text_cache.close()
+        if self.segments is not None:
+            self.segments.close()
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the full-text search index of kommune archives.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="Index new and changed cases in an archive.")
+    update_parser.add_argument("archives", nargs="+", help="Archive directories (e.g. archive-vagan).")
+    update_parser.add_argument("--scan", action="store_true", help="Walk the archive for changed details.txt files instead of using catalog.sqlite.")
+    update_parser.add_argument("--rebuild", action="store_true", help="Index every case again, e.g. after installing pypdf.")
+    update_parser.add_argument("--processes", type=int, help="Document text extraction processes (default: one per CPU).")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        if pdf_backend() is None:
+            print("Warning: neither pypdf nor pdftotext is installed, so the text of PDFs is not indexed. Install pypdf with 'pip install pypdf'.")
+        for archive in args.archives:
+            if not os.path.isdir(archive):
+                print(f"Error: {archive} is not a directory")
+                continue
+            started = time.monotonic()
+            index = SearchIndex(archive)
+            changed = index.update(scan=args.scan, processes=args.processes, rebuild=args.rebuild)
+            index.close()
+            print(f"{archive}: {changed} cases updated in {time.monotonic() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
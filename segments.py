@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Packed storage of an archive directory in large segment files.
+
+In the directory layout every case is a directory holding details.txt and
+a few documents, so a multi-year archive is hundreds of thousands of small
+files, and walking or backing it up on a network share is mostly metadata
+traffic. A packed archive instead appends the files of each case to
+segment files of up to 1 GB in <output_dir>/.segments, and keeps an index
+of where each file is (segment, offset, size and SHA-256) in
+.segments/index.sqlite. Reading a file is one index lookup and one
+positioned read, and listing the cases of a date is a query on the index.
+
+Packed files keep the paths they have in the directory layout
+(YYYY/MM/DD/<case>/<file>), so catalog.sqlite, the search index and the
+MCP server refer to cases the same way in both layouts, and an archive can
+have cases in both. download.py --packed writes new cases packed, and an
+existing archive is converted with:
+
+    python segments.py pack archive-vagan [archive-vestvagoy ...]
+    python segments.py unpack archive-vagan
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+
+# fcntl is not available on Windows; there, only one process at a time may append to an archive
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from catalog import case_date_from_path
+
+SEGMENT_DIR_NAME = ".segments"
+SEGMENT_INDEX_FILENAME = "index.sqlite"
+
+# A new segment file is started once the current one reaches this size
+SEGMENT_MAX_BYTES = 1024 * 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_dir TEXT PRIMARY KEY,
+    date TEXT,
+    packed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cases_date ON cases (date, case_dir);
+CREATE INDEX IF NOT EXISTS cases_packed_at ON cases (packed_at);
+CREATE TABLE IF NOT EXISTS files (
+    case_dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (case_dir, name)
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+"""
+
+
+def is_packed(output_dir):
+    """True if an archive directory has packed cases (or had, and hasn't been fully unpacked)."""
+    return os.path.exists(os.path.join(output_dir, SEGMENT_DIR_NAME, SEGMENT_INDEX_FILENAME))
+
+
+def case_files(case_dir):
+    """The files of a case directory to pack: details.txt and the documents, but no hidden or partial files.
+
+    They are kept in directory listing order, which tellusr-upload.py numbers attachments by.
+    """
+    return [name for name in os.listdir(case_dir)
+            if not name.startswith(".") and os.path.isfile(os.path.join(case_dir, name))]
+
+
+def copy_hashed(source, target):
+    """Copy one open file to another and return (sha256, size) of the bytes copied."""
+    digest = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+        digest.update(block)
+        target.write(block)
+        size += len(block)
+    return digest.hexdigest(), size
+
+
+class SegmentStore:
+    """Segment files and offset index of one archive directory.
+
+    Files are appended to the newest segment and never rewritten; a case
+    packed again points the index at its new copy, and a document whose
+    content is already in a segment points at the stored copy instead of
+    being written again. Paths are relative to the archive directory.
+
+    self.lock guards the index connection and is only held for single
+    queries and commits; appends are serialised by the append lock, so
+    readers are never held up by a case being written.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.segment_dir = os.path.join(output_dir, SEGMENT_DIR_NAME)
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.append_lock = threading.Lock()
+        self.readers = {}  # segment number -> file descriptor open for reading
+        self.conn = sqlite3.connect(os.path.join(self.segment_dir, SEGMENT_INDEX_FILENAME), timeout=60,
+                                    check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def segment_path(self, segment):
+        return os.path.join(self.segment_dir, f"segment-{segment:06d}.pack")
+
+    def _segments(self):
+        return sorted(int(name[8:14]) for name in os.listdir(self.segment_dir)
+                      if name.startswith("segment-") and name.endswith(".pack"))
+
+    @contextmanager
+    def _appending(self):
+        """Hold the archive's append lock, shared with other processes where fcntl is available."""
+        with self.append_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.segment_dir, "append.lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Writing
+
+    def add_case(self, case_dir, remove=True):
+        """Pack the files of a case directory, replacing a version packed before, and remove the directory.
+
+        The files are written and synced to the segment before the index
+        points at them, so an interrupted add leaves the directory as it was
+        and at most some unused bytes at the end of a segment. Each file is
+        hashed as it is copied, so the hash is of the bytes stored; a file
+        whose content turns out to be stored already is cut off the segment
+        again. Only the appends hold the append lock; the sync and the index
+        update come after it.
+        """
+        rel_dir = os.path.relpath(case_dir, self.output_dir)
+        files = [(name, os.path.join(case_dir, name)) for name in case_files(case_dir)]
+        rows = []
+        outs = []
+        try:
+            with self._appending():
+                segments = self._segments()
+                segment = segments[-1] if segments else 1
+                out = open(self.segment_path(segment), "ab")
+                outs.append(out)
+                offset = out.seek(0, os.SEEK_END)
+                stored = {}  # sha256 -> (segment, offset, size) of documents written for this case
+                for position, (name, path) in enumerate(files):
+                    if offset >= SEGMENT_MAX_BYTES:
+                        out.flush()
+                        segment += 1
+                        out = open(self.segment_path(segment), "ab")
+                        outs.append(out)
+                        offset = out.seek(0, os.SEEK_END)
+                    with open(path, "rb") as f:
+                        sha256, size = copy_hashed(f, out)
+                    known = stored.get(sha256) or self._stored(sha256)
+                    if known:
+                        out.truncate(offset)
+                        rows.append((rel_dir, name, position, *known, sha256))
+                        continue
+                    stored[sha256] = (segment, offset, size)
+                    rows.append((rel_dir, name, position, segment, offset, size, sha256))
+                    offset += size
+                for out in outs:
+                    out.flush()
+            for out in outs:
+                os.fsync(out.fileno())
+        finally:
+            for out in outs:
+                out.close()
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE case_dir = ?", (rel_dir,))
+            self.conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO cases VALUES (?, ?, ?)",
+                              (rel_dir, case_date_from_path(rel_dir), time.time()))
+            self.conn.commit()
+        if remove:
+            shutil.rmtree(case_dir)
+        return len(rows)
+
+    def _stored(self, sha256):
+        """(segment, offset, size) of a stored copy of content with this SHA-256, or None."""
+        with self.lock:
+            return self.conn.execute("SELECT segment, offset, size FROM files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+
+    def remove_case(self, rel_dir):
+        """Drop a case from the index; its bytes stay in the segment."""
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE case_dir = ?", (rel_dir,))
+            self.conn.execute("DELETE FROM cases WHERE case_dir = ?", (rel_dir,))
+            self.conn.commit()
+
+    # Reading
+
+    def _reader(self, segment):
+        with self.lock:
+            fd = self.readers.get(segment)
+            if fd is None:
+                fd = self.readers[segment] = os.open(self.segment_path(segment), os.O_RDONLY)
+            return fd
+
+    def file_info(self, rel_path):
+        """(size, sha256) of a packed file, or None if it isn't packed."""
+        case_dir, name = os.path.split(os.path.normpath(rel_path))
+        with self.lock:
+            return self.conn.execute("SELECT size, sha256 FROM files WHERE case_dir = ? AND name = ?",
+                                     (case_dir, name)).fetchone()
+
+    def read(self, rel_path, limit=None):
+        """The contents of a packed file (at most limit bytes), or None if it isn't packed."""
+        case_dir, name = os.path.split(os.path.normpath(rel_path))
+        with self.lock:
+            row = self.conn.execute("SELECT segment, offset, size FROM files WHERE case_dir = ? AND name = ?",
+                                    (case_dir, name)).fetchone()
+        if row is None:
+            return None
+        segment, offset, size = row
+        size = size if limit is None else min(size, limit)
+        fd = self._reader(segment)
+        chunks = []
+        while size > 0:
+            chunk = os.pread(fd, size, offset)
+            if not chunk:
+                raise OSError(f"Segment {segment} of {self.output_dir} is truncated")
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def case(self, rel_dir):
+        """(packed_at, [(name, size, sha256), ...]) of a packed case in the order the files were listed, or None."""
+        rel_dir = os.path.normpath(rel_dir)
+        with self.lock:
+            row = self.conn.execute("SELECT packed_at FROM cases WHERE case_dir = ?", (rel_dir,)).fetchone()
+            if row is None:
+                return None
+            files = self.conn.execute("SELECT name, size, sha256 FROM files WHERE case_dir = ? ORDER BY position",
+                                      (rel_dir,)).fetchall()
+        return row[0], files
+
+    def cases(self, date=None, since=None):
+        """(case_dir, date, packed_at) of the packed cases, of one YYYY-MM-DD date or packed after since."""
+        query, params = "SELECT case_dir, date, packed_at FROM cases", ()
+        if date is not None:
+            query, params = query + " WHERE date = ? ORDER BY case_dir", (date,)
+        elif since is not None:
+            query, params = query + " WHERE packed_at > ? ORDER BY packed_at", (since,)
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def extract_case(self, rel_dir, case_dir=None):
+        """Write a packed case back to its directory, details.txt last, and return the number of files."""
+        case_dir = case_dir or os.path.join(self.output_dir, rel_dir)
+        packed = self.case(rel_dir)
+        if packed is None:
+            return 0
+        files = sorted(packed[1], key=lambda f: f[0] == "details.txt")
+        os.makedirs(case_dir, exist_ok=True)
+        for name, _, _ in files:
+            # Hidden until complete, so an interrupted unpack leaves nothing that looks like a document.
+            part_path = os.path.join(case_dir, f".{name}.part")
+            with open(part_path, "wb") as f:
+                f.write(self.read(os.path.join(rel_dir, name)))
+            os.replace(part_path, os.path.join(case_dir, name))
+        return len(files)
+
+    def stats(self):
+        """Numbers of cases and files, bytes referenced by the index, and bytes in the segment files."""
+        with self.lock:
+            cases = self.conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+            files, referenced = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            stored = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT segment, offset, size FROM files)").fetchone()[0]
+        on_disk = sum(os.path.getsize(self.segment_path(segment)) for segment in self._segments())
+        return {"cases": cases, "files": files, "referenced_bytes": referenced, "stored_bytes": stored, "segment_bytes": on_disk}
+
+    def close(self):
+        with self.lock:
+            for fd in self.readers.values():
+                os.close(fd)
+            self.readers = {}
+            self.conn.close()
+
+
+def _remove_empty_dirs(output_dir):
+    """Remove the date directories left empty by packing."""
+    for root, dirs, files in os.walk(output_dir, topdown=False):
+        rel_root = os.path.relpath(root, output_dir)
+        if rel_root != "." and rel_root.split(os.sep)[0].isdigit() and not os.listdir(root):
+            os.rmdir(root)
+
+
+def pack(output_dir, remove_blobs=False):
+    """Pack every case directory of an archive and return the number of cases packed."""
+    store = SegmentStore(output_dir)
+    packed = 0
+    for root, dirs, files in os.walk(output_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        if "details.txt" in files and case_date_from_path(os.path.relpath(root, output_dir)):
+            dirs[:] = []
+            store.add_case(root)
+            packed += 1
+            if packed % 1000 == 0:
+                print(f"\r  {packed} cases packed", end="", flush=True)
+    _remove_empty_dirs(output_dir)
+    store.close()
+    # The store of download.py links documents into case directories; once none are left it only duplicates the segments
+    blob_dir = os.path.join(output_dir, ".blobs")
+    if remove_blobs and os.path.isdir(blob_dir):
+        shutil.rmtree(blob_dir)
+    return packed
+
+
+def unpack(output_dir):
+    """Write every packed case of an archive back to its directory and return the number of cases."""
+    if not is_packed(output_dir):
+        return 0
+    store = SegmentStore(output_dir)
+    unpacked = 0
+    for rel_dir, _, _ in store.cases():
+        store.extract_case(rel_dir)
+        store.remove_case(rel_dir)
+        unpacked += 1
+        if unpacked % 1000 == 0:
+            print(f"\r  {unpacked} cases unpacked", end="", flush=True)
+    store.close()
+    shutil.rmtree(os.path.join(output_dir, SEGMENT_DIR_NAME))
+    return unpacked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert kommune archives between the directory and packed layouts.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Move every case directory of an archive into segment files.")
+    pack_parser.add_argument("archives", nargs="+", help="Archive directories (e.g. archive-vagan).")
+    pack_parser.add_argument("--remove-blobs", action="store_true",
+                             help="Also remove the .blobs document store, which only duplicates the packed documents.")
+    unpack_parser = subparsers.add_parser("unpack", help="Write every packed case back to a case directory.")
+    unpack_parser.add_argument("archives", nargs="+", help="Archive directories (e.g. archive-vagan).")
+    stats_parser = subparsers.add_parser("stats", help="Show the cases, files and bytes in an archive's segments.")
+    stats_parser.add_argument("archives", nargs="+", help="Archive directories (e.g. archive-vagan).")
+    args = parser.parse_args()
+
+    for archive in args.archives:
+        if not os.path.isdir(archive):
+            print(f"Error: {archive} is not a directory")
+            continue
+        if args.command == "pack":
+            print(f"\r{archive}: {pack(archive, args.remove_blobs)} cases packed")
+        elif args.command == "unpack":
+            print(f"\r{archive}: {unpack(archive)} cases unpacked")
+        elif not is_packed(archive):
+            print(f"{archive}: not packed")
+        else:
+            store = SegmentStore(archive)
+            stats = store.stats()
+            store.close()
+            print(f"{archive}: {stats['cases']} cases, {stats['files']} files, "
+                  f"{stats['stored_bytes'] / 1024 / 1024:.1f} MB stored for {stats['referenced_bytes'] / 1024 / 1024:.1f} MB of files, "
+                  f"{stats['segment_bytes'] / 1024 / 1024:.1f} MB in segments")
+
+
+if __name__ == "__main__":
+    main()
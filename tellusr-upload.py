@@ -2,32 +2,203 @@ import os
 import requests
 import json
 import re
+import time
+import sqlite3
+import hashlib
+import random
 import traceback
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-# API Configuration
-PROJECT = "kommune"
-BASE_DIR = "/Volumes/home/kommune"  # Root directory containing all archives
-BASE_URL = "https://christian.tellusrapp.com"
+from segments import SegmentStore, is_packed
+
+# API Configuration (can be overridden via environment variables, e.g. to upload to a local test server)
+PROJECT = os.environ.get("TELLUSR_PROJECT", "kommune")
+BASE_DIR = os.environ.get("TELLUSR_BASE_DIR", "/Volumes/home/kommune")  # Root directory containing all archives
+BASE_URL = os.environ.get("TELLUSR_URL", "https://christian.tellusrapp.com").rstrip("/")
 API_DOCS_URL = f"{BASE_URL}/tellusr/api/v1/{PROJECT}/update-many-docs"
 API_UPLOAD_URL = f"{BASE_URL}/tellusr/api/v1/{PROJECT}/upload-file"
-AUTH = ("", "")
-
-# Path to progress log file
+API_DELETE_URL = f"{BASE_URL}/tellusr/api/v1/{PROJECT}/delete-docs"
+AUTH = (os.environ.get("TELLUSR_USER", ""), os.environ.get("TELLUSR_PASSWORD", ""))
+
+# A case changed since it was uploaded is sent again under the ID it was uploaded under, which update-many-docs
+# overwrites. Set TELLUSR_DELETE_BEFORE_REPLACE=1 for a server that answers Duplicate ID for a known ID instead:
+# the old documents are then deleted first with delete-docs, which is not part of the documented API
+DELETE_BEFORE_REPLACE = os.environ.get("TELLUSR_DELETE_BEFORE_REPLACE", "") == "1"
+
+# Metadata documents are posted to update-many-docs in batches of up to this many documents / bytes
+BATCH_MAX_DOCS = 100
+BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+# Seconds to wait for a batch of metadata to be accepted
+BATCH_TIMEOUT = 120
+
+# Attachments uploaded at the same time, and cases whose attachments may be uploading at once;
+# the walk waits for the oldest case when this many are in flight, so memory stays flat
+UPLOAD_WORKERS = int(os.environ.get("TELLUSR_WORKERS", "8"))
+MAX_CASES_IN_FLIGHT = 32
+
+# Failed uploads (network errors, 429 and 5xx) are retried this many times, waiting
+# about 1, 2, 4, ... seconds (up to UPLOAD_BACKOFF_MAX) with random jitter
+UPLOAD_MAX_RETRIES = 4
+UPLOAD_BACKOFF_BASE = 1.0
+UPLOAD_BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Seconds to wait for a connection and for an attachment upload to be answered
+UPLOAD_TIMEOUT = (10, 300)
+
+# One session for all requests, so connections to the server are reused by all upload workers
+SESSION = requests.Session()
+SESSION.auth = AUTH
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_WORKERS + 2))
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_WORKERS + 2))
+
+# Sync state: what was uploaded from each case and each attachment, with the size, modification time and
+# SHA-256 it had, so only new and changed cases and attachments are uploaded again
+SYNC_DB = os.environ.get("TELLUSR_SYNC_DB", "tellusr-sync.sqlite")
+
+# Progress log of earlier versions; the cases in it are imported into SYNC_DB as uploaded
 LOG_FILE = "uploaded_cases.log"
 
-
-# Function to read processed cases from log file
-def get_processed_cases():
-    if os.path.exists(LOG_FILE):
+# Archives with a catalog.sqlite (written by download.py) are only read for cases recorded since the last run;
+# set to True to walk every archive and compare all cases with the sync state instead
+FULL_SCAN = False
+
+# Catalog that download.py keeps in each archive directory
+CATALOG_FILE = "catalog.sqlite"
+
+# Seconds to look behind the catalog watermark: download.py stamps a case before it commits it, so with several
+# workers or processes a case can be committed after a run read the watermark with an earlier updated_at.
+# Cases seen again are compared with the sync state and skipped if unchanged
+CATALOG_LOOKBACK = 5
+
+# Segment stores of packed archives (see segments.py) by archive path, None for archives that aren't packed.
+# Cases in a packed archive keep their paths, and their files are read through the segment index
+SEGMENT_STORES = {}
+
+SYNC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_path TEXT PRIMARY KEY,
+    archive TEXT NOT NULL,
+    doc_id TEXT,
+    details_size INTEGER,
+    details_mtime REAL,
+    details_sha256 TEXT,
+    status TEXT NOT NULL,
+    synced_at REAL
+);
+CREATE INDEX IF NOT EXISTS cases_status ON cases (archive, status);
+CREATE TABLE IF NOT EXISTS attachments (
+    file_path TEXT PRIMARY KEY,
+    case_path TEXT NOT NULL,
+    attachment_id TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT,
+    uploaded_at REAL
+);
+CREATE INDEX IF NOT EXISTS attachments_case ON attachments (case_path);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# Function to open the sync state, importing the progress log of earlier versions the first time
+def open_sync_state():
+    state = sqlite3.connect(SYNC_DB)
+    state.executescript(SYNC_SCHEMA)
+    imported = state.execute("SELECT value FROM meta WHERE key = 'imported_log'").fetchone()
+    if not imported and os.path.exists(LOG_FILE):
         with open(LOG_FILE, "r", encoding="utf-8") as log:
-            return set(log.read().splitlines())  # Load processed case paths
-    return set()
+            case_paths = set(log.read().splitlines())
+        # Logged cases were uploaded, but with unknown contents: their fingerprints are taken on the next visit
+        with state:
+            state.executemany("INSERT OR IGNORE INTO cases (case_path, archive, status) VALUES (?, ?, 'synced')",
+                              [(path, archive_of(path)) for path in case_paths if path])
+            state.execute("INSERT OR REPLACE INTO meta VALUES ('imported_log', ?)", (str(len(case_paths)),))
+        print(f"📥 Imported {len(case_paths)} cases from {LOG_FILE}")
+    return state
+
+
+# Function to get the archive directory name of a case path
+def archive_of(case_path):
+    relative = os.path.relpath(case_path, BASE_DIR)
+    return relative.split(os.sep, 1)[0]
+
+
+# Function to get the segment store of an archive, or None if it isn't packed
+def segment_store(archive_path):
+    if archive_path not in SEGMENT_STORES:
+        SEGMENT_STORES[archive_path] = SegmentStore(archive_path) if is_packed(archive_path) else None
+    return SEGMENT_STORES[archive_path]
+
+
+# Function to find a file in a packed archive; returns (segment store, path in the archive), or None if it is on disk
+def packed_path(file_path):
+    archive_path = os.path.join(BASE_DIR, archive_of(file_path))
+    store = segment_store(archive_path)
+    if store is None or os.path.exists(file_path):
+        return None
+    return store, os.path.relpath(file_path, archive_path)
 
 
-# Function to save a processed case to the log
-def mark_case_as_processed(case_path):
-    with open(LOG_FILE, "a", encoding="utf-8") as log:
-        log.write(case_path + "\n")
+# Function to read a file from disk or from a packed archive
+def read_case_file(file_path):
+    packed = packed_path(file_path)
+    if packed is None:
+        with open(file_path, "rb") as file_data:
+            return file_data.read()
+    data = packed[0].read(packed[1])
+    if data is None:
+        raise FileNotFoundError(f"No such file: {file_path}")
+    return data
+
+
+# Function to check whether a case directory has a details.txt, on disk or in a packed archive
+def case_exists(case_path):
+    details_file = os.path.join(case_path, "details.txt")
+    packed = packed_path(details_file)
+    return os.path.exists(details_file) if packed is None else packed[0].file_info(packed[1]) is not None
+
+
+# Function to read the size and modification time of a file, and optionally its SHA-256
+def file_fingerprint(file_path, with_hash=True):
+    packed = packed_path(file_path)
+    if packed is not None:
+        # The size and SHA-256 are in the segment index, and the time the case was packed stands in for the mtime
+        store, relative = packed
+        info = store.file_info(relative)
+        if info is None:
+            raise FileNotFoundError(f"No such file: {file_path}")
+        return (info[0], store.case(os.path.dirname(relative))[0], info[1])
+    stat = os.stat(file_path)
+    sha256 = None
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file_data:
+            for chunk in iter(lambda: file_data.read(1024 * 1024), b""):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+    return (stat.st_size, stat.st_mtime, sha256)
+
+
+# Function to check a file against its recorded (size, mtime, sha256); a new mtime with the same content
+# (as after download.py --force) counts as unchanged. Returns (changed, current fingerprint)
+def file_changed(file_path, recorded):
+    size, mtime, _ = file_fingerprint(file_path, with_hash=False)
+    if recorded is None:
+        return True, None
+    if recorded[0] == size and recorded[1] == mtime:
+        return False, recorded
+    if recorded[2] is None or recorded[0] != size:
+        return True, None
+    current = file_fingerprint(file_path)
+    return current[2] != recorded[2], current
 
 
 # Function to parse details.txt with error handling
@@ -36,27 +207,26 @@ def parse_details_file(details_file):
     authors = []
 
     try:
-        with open(details_file, "r", encoding="utf-8") as file:
-            for line in file:
-                line = line.strip()
-                if ": " in line:  # Ensure the line has expected format before splitting
-                    key, value = line.split(": ", 1)
-                    if key == "DokumentID":
-                        data["id"] = value
-                    elif key == "ArkivsakID":
-                        data["title"] = value
-                    elif key == "Journaldato":
-                        data["journal_date"] = value
-                    elif key == "Brevdato":
-                        data["letter_date"] = value
-                    elif key == "Dokumentansvarlig":
-                        data["responsible_person"] = value
-                    elif key == "Avsender(e)":
-                        continue  # Skip, next lines might contain authors
-                elif line and not re.match(r"^\w+: ", line):  # No known prefix → assume author
-                    authors.append(line)
-                else:
-                    print(f"⚠️ Skipping unrecognized line in {details_file}: {line}")
+        for line in read_case_file(details_file).decode("utf-8").splitlines():
+            line = line.strip()
+            if ": " in line:  # Ensure the line has expected format before splitting
+                key, value = line.split(": ", 1)
+                if key == "DokumentID":
+                    data["id"] = value
+                elif key == "ArkivsakID":
+                    data["title"] = value
+                elif key == "Journaldato":
+                    data["journal_date"] = value
+                elif key == "Brevdato":
+                    data["letter_date"] = value
+                elif key == "Dokumentansvarlig":
+                    data["responsible_person"] = value
+                elif key == "Avsender(e)":
+                    continue  # Skip, next lines might contain authors
+            elif line and not re.match(r"^\w+: ", line):  # No known prefix → assume author
+                authors.append(line)
+            else:
+                print(f"⚠️ Skipping unrecognized line in {details_file}: {line}")
 
         data["authors"] = authors
 
@@ -76,11 +246,16 @@ def parse_details_file(details_file):
 def find_attachments(case_path, base_id):
     attachments = []
     try:
-        file_list = [
-            f
-            for f in os.listdir(case_path)
-            if os.path.isfile(os.path.join(case_path, f))
-        ]
+        packed = packed_path(case_path)
+        if packed is not None:
+            # A packed case lists its files from the segment index, in the order they were listed when it was packed
+            file_list = [name for name, _, _ in packed[0].case(packed[1])[1]]
+        else:
+            file_list = [
+                f
+                for f in os.listdir(case_path)
+                if os.path.isfile(os.path.join(case_path, f))
+            ]
         valid_files = [
             f
             for f in file_list
@@ -98,31 +273,97 @@ def find_attachments(case_path, base_id):
     return attachments
 
 
-# Function to upload a single file using /upload-file
+# Function to send a request with send(), retrying network errors, timeouts, 429 and 5xx with backoff. Returns the
+# last response, or None if the last attempt got none; other errors, such as a file that can't be read, are raised
+def send_with_retries(description, send):
+    response, error = None, None
+    for attempt in range(UPLOAD_MAX_RETRIES + 1):
+        try:
+            response = send()
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            error = f"HTTP {response.status_code}"
+        except requests.RequestException as e:
+            response, error = None, str(e)
+
+        if attempt < UPLOAD_MAX_RETRIES:
+            # Equal jitter: half the exponential delay plus a random share of the other half
+            delay = min(UPLOAD_BACKOFF_MAX, UPLOAD_BACKOFF_BASE * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            print(f"⚠️ {description} failed ({error}), retrying in {delay:.1f} s")
+            time.sleep(delay)
+
+    print(f"❌ {description} failed after {UPLOAD_MAX_RETRIES + 1} attempts: {error}")
+    return response
+
+
+# Function to tell whether send_with_retries gave up on a request, so it is worth trying again on a later run
+def gave_up(response):
+    return response is None or response.status_code in RETRY_STATUS_CODES
+
+
+# Function to upload a single file using /upload-file, retrying failures with backoff
 def upload_file(file_path, doc_id):
     file_name = os.path.basename(file_path)
     print(f"📤 Uploading attachment: {file_name} as {doc_id}...")
 
-    try:
-        with open(file_path, "rb") as file_data:
+    def send():
+        # A file in a packed archive is read through the segment index in one go
+        packed = packed_path(file_path)
+        with open(file_path, "rb") if packed is None else nullcontext(read_case_file(file_path)) as file_data:
             files = {"file": (file_name, file_data)}
             params = {"id": doc_id, "saveCopy": "true", "generateThumbnail": "true"}
-            response = requests.post(API_UPLOAD_URL, auth=AUTH, files=files, params=params)
-
-        if response.status_code == 200:
-            print(f"✅ Successfully uploaded: {file_name} (ID: {doc_id})")
-            return file_name  # Return filename to reference in metadata
-        else:
-            print(f"❌ Failed to upload {file_name}: {response.text}")
-            return None
+            return SESSION.post(API_UPLOAD_URL, files=files, params=params, timeout=UPLOAD_TIMEOUT)
 
+    try:
+        response = send_with_retries(f"Upload of {file_name}", send)
+    except OSError as e:
+        print(f"❌ Error reading file {file_name}: {e}")
+        return None
     except Exception as e:
         print(f"❌ Error uploading file {file_name}: {e}")
         return None
 
+    if gave_up(response):
+        return None
+    if response.status_code == 200:
+        print(f"✅ Successfully uploaded: {file_name} (ID: {doc_id})")
+        return file_name  # Return filename to reference in metadata
+    print(f"❌ Failed to upload {file_name}: {response.text}")
+    return None
+
 
-# Function to upload document metadata with retry on duplicate ID
-def upload_document(document):
+# Function to upload an attachment for the upload workers; returns (file name, fingerprint) or None if it failed
+def upload_attachment(file_path, attachment_id):
+    try:
+        fingerprint = file_fingerprint(file_path)  # Taken before the upload, so a file changed meanwhile is sent again
+    except OSError as e:
+        print(f"❌ Error reading file {os.path.basename(file_path)}: {e}")
+        return None
+    file_name = upload_file(file_path, attachment_id)
+    return (file_name, fingerprint) if file_name else None
+
+
+# Function to delete documents by ID before they are replaced (DELETE_BEFORE_REPLACE only); returns True if it worked
+def delete_documents(doc_ids):
+    headers = {"Content-Type": "application/json"}
+    try:
+        response = send_with_retries(f"Deleting {len(doc_ids)} outdated documents", lambda: SESSION.post(
+            API_DELETE_URL, headers=headers, json={"ids": doc_ids}, timeout=BATCH_TIMEOUT))
+    except Exception as e:
+        print(f"❌ Error deleting {len(doc_ids)} outdated documents: {e}")
+        return False
+    if gave_up(response):
+        return False
+    if response.status_code != 200:
+        print(f"❌ Failed to delete {len(doc_ids)} outdated documents | Error: {response.text[:200]}")
+        return False
+    return True
+
+
+# Function to upload document metadata with retry on duplicate ID. Documents replacing an earlier upload must keep
+# their ID, so for them (rejected is a list) a duplicate ID adds the ID to rejected instead of giving it a new one
+def upload_document(document, rejected=None):
     headers = {"Content-Type": "application/json"}
     attempt = 1
     original_id = document["id"]
@@ -130,12 +371,18 @@ def upload_document(document):
     while True:
         try:
             payload = {"docs": [document]}
-            response = requests.post(API_DOCS_URL, auth=AUTH, headers=headers, json=payload)
+            response = send_with_retries(f"Metadata upload of {document['id']}", lambda: SESSION.post(
+                API_DOCS_URL, headers=headers, json=payload, timeout=BATCH_TIMEOUT))
 
-            if response.status_code == 200:
+            if gave_up(response):
+                return False
+            elif response.status_code == 200:
                 print(f"✅ Successfully uploaded metadata: {document['title']} (ID: {document['id']})")
                 return True
-            elif "duplicate ID" in response.text.lower():
+            elif "duplicate id" in response.text.lower() and rejected is not None:
+                rejected.append(document["id"])
+                return False
+            elif "duplicate id" in response.text.lower():
                 new_id = f"{original_id}-{attempt + 1}"
                 print(f"⚠️ Duplicate ID detected for {original_id}. Retrying with new ID: {new_id}")
                 document["id"] = new_id  # Append increasing suffix
@@ -149,58 +396,290 @@ def upload_document(document):
             return False
 
 
-# Main function to process cases one by one
+# Function to upload a batch of (case_path, document) pairs in one request; returns the case paths that were uploaded.
+# For documents replacing earlier uploads, rejected is a list collecting the IDs the server refused as duplicates
+def upload_batch(batch, rejected=None):
+    if len(batch) == 1:
+        case_path, document = batch[0]
+        return [case_path] if upload_document(document, rejected) else []
+
+    headers = {"Content-Type": "application/json"}
+    payload = {"docs": [document for _, document in batch]}
+    try:
+        response = send_with_retries(f"Metadata batch of {len(batch)} documents", lambda: SESSION.post(
+            API_DOCS_URL, headers=headers, json=payload, timeout=BATCH_TIMEOUT))
+    except Exception as e:
+        print(f"❌ Error uploading metadata batch of {len(batch)} documents: {e}")
+        return []
+
+    if gave_up(response):
+        # The server or network is the problem, not a document; the cases are retried on the next run
+        return []
+    if response.status_code == 200:
+        print(f"✅ Successfully uploaded metadata batch of {len(batch)} documents")
+        return [case_path for case_path, _ in batch]
+    if not 400 <= response.status_code < 500:
+        print(f"❌ Metadata batch of {len(batch)} documents failed; the cases are retried on the next run | Error: {response.text[:200]}")
+        return []
+
+    # One bad or duplicate document fails the whole request: split the batch until the failing
+    # documents are sent on their own, where upload_document handles duplicate IDs. Rejected replacements
+    # are reported once by flush_batch
+    if rejected is None or "duplicate id" not in response.text.lower():
+        print(f"⚠️ Metadata batch of {len(batch)} documents was rejected, splitting it | Error: {response.text[:200]}")
+    middle = len(batch) // 2
+    return upload_batch(batch[:middle], rejected) + upload_batch(batch[middle:], rejected)
+
+
+# Function to upload a batch and record its uploaded cases as synced, with the details.txt fingerprints they were built from
+def flush_batch(state, batch, details_fingerprints):
+    # Changed cases keep the ID they were uploaded under and are sent on their own, so their documents overwrite
+    # the earlier uploads instead of getting a new ID
+    new, replacements = [], []
+    for case_path, document in batch:
+        row = state.execute("SELECT doc_id FROM cases WHERE case_path = ?", (case_path,)).fetchone()
+        (replacements if row and row[0] == document["id"] else new).append((case_path, document))
+    uploaded = upload_batch(new) if new else []
+    failed = []
+    if replacements:
+        rejected = []
+        if DELETE_BEFORE_REPLACE and not delete_documents(sorted(document["id"] for _, document in replacements)):
+            failed = [case_path for case_path, _ in replacements]
+        else:
+            uploaded += upload_batch(replacements, rejected)
+            failed = [case_path for case_path, document in replacements if document["id"] in rejected]
+        if failed:
+            hint = "" if DELETE_BEFORE_REPLACE else " (set TELLUSR_DELETE_BEFORE_REPLACE=1 if the server can't overwrite them)"
+            print(f"❌ {len(failed)} changed cases could not replace their earlier upload and are marked failed{hint}; "
+                  f"they are retried when they change again or on a full scan")
+    documents = dict(batch)
+    with state:  # One transaction for the batch, which also commits the progress recorded since the last one
+        state.executemany("UPDATE cases SET status = 'failed' WHERE case_path = ?", [(case_path,) for case_path in failed])
+        for case_path in uploaded:
+            document = documents[case_path]
+            size, mtime, sha256 = details_fingerprints[case_path]
+            state.execute("UPDATE cases SET doc_id = ?, details_size = ?, details_mtime = ?, details_sha256 = ?, "
+                          "status = 'synced', synced_at = ? WHERE case_path = ?",
+                          (document["id"], size, mtime, sha256, time.time(), case_path))
+            # Attachments no longer in the case were left out of its metadata
+            names = set(document["attachments"])
+            for (file_path,) in state.execute("SELECT file_path FROM attachments WHERE case_path = ?", (case_path,)).fetchall():
+                if os.path.basename(file_path) not in names:
+                    state.execute("DELETE FROM attachments WHERE file_path = ?", (file_path,))
+    for case_path, _ in batch:
+        details_fingerprints.pop(case_path, None)
+
+
+# Function to record the current files of a case imported from the progress log as uploaded, without hashing them
+def adopt_case(state, root, details_file, attachments):
+    size, mtime, _ = file_fingerprint(details_file, with_hash=False)
+    state.execute("UPDATE cases SET details_size = ?, details_mtime = ? WHERE case_path = ?", (size, mtime, root))
+    for attachment_id, file_path in attachments:
+        size, mtime, _ = file_fingerprint(file_path, with_hash=False)
+        state.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, NULL, NULL)",
+                      (file_path, root, attachment_id, size, mtime))
+
+
+# Function to compare a case with the sync state. Returns None if it is unchanged since it was uploaded, and
+# otherwise (document ID, details.txt fingerprint, attachments to upload); attachments uploaded before that
+# are unchanged are not uploaded again
+def case_changes(state, root, details, attachments):
+    details_file = os.path.join(root, "details.txt")
+    row = state.execute("SELECT doc_id, details_size, details_mtime, details_sha256, status FROM cases "
+                        "WHERE case_path = ?", (root,)).fetchone()
+    if row and row[4] == "synced" and row[1] is None:
+        adopt_case(state, root, details_file, attachments)
+        return None
+
+    recorded = {
+        file_path: (attachment_id, (size, mtime, sha256))
+        for file_path, attachment_id, size, mtime, sha256 in state.execute(
+            "SELECT file_path, attachment_id, size, mtime, sha256 FROM attachments WHERE case_path = ?", (root,))
+    }
+    details_changed, details_fingerprint = file_changed(details_file, row[1:4] if row else None)
+    to_upload = []
+    for attachment_id, file_path in attachments:
+        recorded_id, fingerprint = recorded.pop(file_path, (None, None))
+        changed, current = file_changed(file_path, fingerprint)
+        if changed or recorded_id != attachment_id:
+            to_upload.append((attachment_id, file_path))
+        elif current != fingerprint:
+            # Same content with a new modification time: remember it so the file isn't hashed again
+            state.execute("UPDATE attachments SET mtime = ?, sha256 = ? WHERE file_path = ?", (current[1], current[2], file_path))
+
+    if row and row[4] == "synced" and not details_changed and not to_upload and not recorded:
+        if details_fingerprint != tuple(row[1:4]):
+            state.execute("UPDATE cases SET details_mtime = ?, details_sha256 = ? WHERE case_path = ?",
+                          (details_fingerprint[1], details_fingerprint[2], root))
+        return None
+
+    if details_changed or details_fingerprint[2] is None:
+        details_fingerprint = file_fingerprint(details_file)
+    # A case uploaded before keeps the document ID it was given, which may have a duplicate suffix
+    doc_id = row[0] if row and row[0] else details["id"]
+    state.execute("INSERT INTO cases (case_path, archive, status) VALUES (?, ?, 'pending') "
+                  "ON CONFLICT (case_path) DO UPDATE SET status = 'pending'", (root, archive_of(root)))
+    return doc_id, details_fingerprint, to_upload
+
+
+# Function to build the metadata document of a case once its attachments are uploaded; None if any failed
+def finish_case(state, root, doc_id, details, attachments, uploads):
+    failed = False
+    for attachment_id, file_path in attachments:
+        if attachment_id not in uploads:
+            continue  # Uploaded on an earlier run
+        result = uploads[attachment_id].result()  # Waits for the upload
+        if result is None:
+            failed = True
+            continue
+        size, mtime, sha256 = result[1]
+        # Recorded even if the case fails, so the next run only uploads what is missing
+        state.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (file_path, root, attachment_id, size, mtime, sha256, time.time()))
+    if failed:
+        print(f"❌ Not all attachments of {root} were uploaded; the case is retried on the next run")
+        return None
+
+    return {
+        "id": doc_id,
+        "title": details["title"],
+        "authors": details["authors"],
+        "content": f"Document related to {details['title']}",
+        "content_segmented": [{"content_segment": f"Details for {details['title']}"}],
+        "yourField1": "example",
+        "yourField2": [],
+        "yourField3": {},
+        "attachments": [os.path.basename(file_path) for _, file_path in attachments],
+    }
+
+
+# Function to list the cases of an archive by walking it, followed by the cases packed into its segment files
+def walk_cases(archive_path):
+    for root, dirs, files in os.walk(archive_path):
+        if "details.txt" in files:
+            yield root
+    store = segment_store(archive_path)
+    for case_dir, _, _ in store.cases() if store is not None else ():
+        if not os.path.isdir(os.path.join(archive_path, case_dir)):
+            yield os.path.join(archive_path, case_dir)
+
+
+# Function to list the cases of an archive to compare with the sync state, and the catalog watermark to save
+# once they are queued: the cases download.py recorded in the catalog since the last run and the cases left
+# pending by an interrupted or failed run, or every case when there is no catalog to go by
+def find_cases(state, archive_dir, archive_path):
+    catalog_path = os.path.join(archive_path, CATALOG_FILE)
+    if not os.path.exists(catalog_path):
+        return walk_cases(archive_path), None
+
+    row = state.execute("SELECT value FROM meta WHERE key = ?", (f"catalog_updated_at:{archive_dir}",)).fetchone()
+    try:
+        catalog = sqlite3.connect(catalog_path)
+        try:
+            if FULL_SCAN or row is None:
+                watermark = catalog.execute("SELECT MAX(updated_at) FROM cases").fetchone()[0]
+                return walk_cases(archive_path), watermark
+            recorded = catalog.execute("SELECT case_dir, updated_at FROM cases WHERE updated_at > ? ORDER BY updated_at",
+                                       (float(row[0]) - CATALOG_LOOKBACK,)).fetchall()
+        finally:
+            catalog.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not read {catalog_path}, walking the archive instead: {e}")
+        return walk_cases(archive_path), None
+
+    pending = [case_path for (case_path,) in state.execute(
+        "SELECT case_path FROM cases WHERE archive = ? AND status = 'pending'", (archive_dir,))]
+    case_paths = pending + [os.path.join(archive_path, case_dir) for case_dir, _ in recorded]
+    watermark = max([float(row[0])] + [updated_at for _, updated_at in recorded])
+    print(f"🗂️ {len(recorded)} cases recorded in the catalog since the last run (or just before), {len(pending)} pending")
+    return [path for path in dict.fromkeys(case_paths) if case_exists(path)], watermark
+
+
+# Main function to process cases: the walk parses new and changed cases and queues their attachments on a pool
+# of upload workers, and the metadata of each case is batched once its attachments are uploaded
 def process_all_cases():
-    processed_cases = get_processed_cases()  # Load progress
+    state = open_sync_state()  # Load progress
+    batch = []  # (case_path, document) pairs waiting to be uploaded
+    batch_size = 0
+    details_fingerprints = {}  # case_path -> details.txt fingerprint of the cases in the batch
+    in_flight = deque()  # (case_path, document ID, details, attachments, upload futures) in walk order
     print(f"🔍 Searching in: {BASE_DIR}")
 
-    for archive_dir in os.listdir(BASE_DIR):
-        archive_path = os.path.join(BASE_DIR, archive_dir)
+    def add_to_batch(root, document):
+        nonlocal batch, batch_size
+        # A document with the same ID as one in the batch goes in the next batch, so the server sees it as a duplicate
+        size = len(json.dumps(document, ensure_ascii=False).encode("utf-8"))
+        if batch and (len(batch) >= BATCH_MAX_DOCS or batch_size + size > BATCH_MAX_BYTES
+                      or any(queued["id"] == document["id"] for _, queued in batch)):
+            flush_batch(state, batch, details_fingerprints)
+            batch, batch_size = [], 0
+        batch.append((root, document))
+        batch_size += size
+
+    def finish_oldest():
+        root, doc_id, details, attachments, uploads = in_flight.popleft()
+        document = finish_case(state, root, doc_id, details, attachments, uploads)
+        if document is not None:
+            add_to_batch(root, document)
+        else:
+            details_fingerprints.pop(root, None)
 
-        if not os.path.isdir(archive_path) or not archive_dir.startswith("archive-"):
-            continue  # Skip non-archive directories
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_pool:
+        for archive_dir in os.listdir(BASE_DIR):
+            archive_path = os.path.join(BASE_DIR, archive_dir)
 
-        print(f"\n📂 Processing archive: {archive_dir}")
+            if not os.path.isdir(archive_path) or not archive_dir.startswith("archive-"):
+                continue  # Skip non-archive directories
 
-        for root, dirs, files in os.walk(archive_path):
-            if "details.txt" in files:
-                if root in processed_cases:
-                    print(f"⏭️ Skipping already processed case: {root}")
-                    continue  # Skip already processed cases
+            print(f"\n📂 Processing archive: {archive_dir}")
+            case_paths, watermark = find_cases(state, archive_dir, archive_path)
 
+            for root in case_paths:
                 details_file = os.path.join(root, "details.txt")
                 details = parse_details_file(details_file)
                 if not details:
-                    continue  # Skip if details.txt is invalid
-
-                base_id = details["id"]
-                attachments = find_attachments(root, base_id)
+                    # Skip if details.txt is invalid, but keep the case pending so the next run reads it again
+                    state.execute("INSERT INTO cases (case_path, archive, status) VALUES (?, ?, 'pending') "
+                                  "ON CONFLICT (case_path) DO UPDATE SET status = 'pending'", (root, archive_of(root)))
+                    continue
+
+                attachments = find_attachments(root, details["id"])
+                changes = case_changes(state, root, details, attachments)
+                if changes is None:
+                    print(f"⏭️ Skipping unchanged case: {root}")
+                    continue  # Skip cases uploaded before that haven't changed
+                doc_id, details_fingerprints[root], to_upload = changes
 
                 print(f"\n📄 Found details.txt in: {root}")
-                print(f"   ➡️ Document ID: {base_id}")
+                print(f"   ➡️ Document ID: {doc_id}")
                 print(f"   ➡️ Title: {details['title']}")
                 print(f"   📎 Attachments: {[f[1] for f in attachments] if attachments else 'None'}")
 
-                uploaded_files = []
-                for attachment_id, file_path in attachments:
-                    uploaded_file = upload_file(file_path, attachment_id)
-                    if uploaded_file:
-                        uploaded_files.append(uploaded_file)
-
-                document = {
-                    "id": base_id,
-                    "title": details["title"],
-                    "authors": details["authors"],
-                    "content": f"Document related to {details['title']}",
-                    "content_segmented": [{"content_segment": f"Details for {details['title']}"}],
-                    "yourField1": "example",
-                    "yourField2": [],
-                    "yourField3": {},
-                    "attachments": uploaded_files,
-                }
-
-                if upload_document(document):
-                    mark_case_as_processed(root)  # Mark case as successfully processed
+                uploads = {attachment_id: upload_pool.submit(upload_attachment, file_path, attachment_id)
+                           for attachment_id, file_path in to_upload}
+                in_flight.append((root, doc_id, details, attachments, uploads))
+
+                # Backpressure: wait for the oldest case when too many are in flight, and batch finished ones
+                while in_flight and (len(in_flight) > MAX_CASES_IN_FLIGHT
+                                     or all(future.done() for future in in_flight[0][4].values())):
+                    finish_oldest()
+
+            if watermark is not None:
+                # The archive's cases are queued, and recorded as pending until they are uploaded
+                with state:
+                    state.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (f"catalog_updated_at:{archive_dir}", str(watermark)))
+
+        while in_flight:
+            finish_oldest()
+
+    if batch:
+        flush_batch(state, batch, details_fingerprints)
+    state.commit()
+    state.close()
+    for store in SEGMENT_STORES.values():
+        if store is not None:
+            store.close()
+    SEGMENT_STORES.clear()
 
 
 # Run the script
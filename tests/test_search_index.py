@@ -0,0 +1,41 @@
+"""Regression tests for search_index.py. Run with: python -m unittest discover tests"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search_index import SearchIndex  # noqa: E402
+
+
+class InfixSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp(prefix="search-index-test-")
+        for name, sender in [("2025011101016 25_75 - Utskifting av oppdrettskar", "Polarsmolt AS"),
+                             ("2025011202019 25_76 - Tilsyn med skole", "Kari Nordmann")]:
+            case_dir = os.path.join(self.archive_dir, "2025", "01", name[6:8], name)
+            os.makedirs(case_dir)
+            with open(os.path.join(case_dir, "details.txt"), "w", encoding="utf-8") as f:
+                f.write(f"Journaldato: {name[6:8]}.01.2025\n\nAvsender(e):\n{sender}\n")
+        self.index = SearchIndex(self.archive_dir)
+        self.index.update()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.archive_dir)
+
+    def test_word_part_matches_inside_word(self):
+        for search in (self.index.search, self.index.search_ranked):
+            results = search("smolt")
+            self.assertEqual([result["case_name"] for result in results],
+                             ["2025011101016 25_75 - Utskifting av oppdrettskar"])
+
+    def test_word_part_combines_with_other_words(self):
+        self.assertEqual(len(self.index.search("smolt oppdrettskar")), 1)
+        self.assertEqual(self.index.search("smolt skole"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Text extraction for the documents in an archive directory.
+
+The PDF, DOCX and plain text documents that download.py saves next to each
+details.txt are converted to text in a process pool. The text is cached in
+<output_dir>/text-cache.sqlite by the SHA-256 of the file, and each file's
+size and mtime are remembered so unchanged files are not read again. A
+document stored in many cases is only extracted once. Documents in a
+packed archive (see segments.py) are looked up by the SHA-256 recorded in
+the segment index, so they are only read when their text isn't cached.
+
+PDF text needs pypdf (pip install pypdf) or the pdftotext command; DOCX and
+plain text need nothing extra.
+
+    python text_extract.py archive-vagan [archive-vestvagoy ...] [--processes 4]
+"""
+
+import os
+import io
+import time
+import shutil
+import tempfile
+import functools
+import sqlite3
+import zipfile
+import hashlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+from segments import SegmentStore, is_packed
+
+# pypdf is optional; without it PDFs are converted with the pdftotext command if it is installed
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+TEXT_CACHE_FILENAME = "text-cache.sqlite"
+
+# Files larger than this are not treated as plain text
+MAX_PLAIN_TEXT_BYTES = 10 * 1024 * 1024
+
+# Packed documents are written to temporary files for extraction this many at a time
+PACKED_SPOOL_BATCH = 64
+
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS texts (
+    sha256 TEXT PRIMARY KEY,
+    kind TEXT,
+    text TEXT,
+    backend TEXT
+);
+"""
+
+
+def pdf_backend():
+    """Name of the available PDF text backend, or None."""
+    if pypdf is not None:
+        return "pypdf"
+    if shutil.which("pdftotext"):
+        return "pdftotext"
+    return None
+
+
+def sniff_kind(path):
+    """Return "pdf", "docx" or "text" from a file's content, or None if it can't be converted to text."""
+    with open(path, "rb") as f:
+        head = f.read(8192)
+    return _sniff(head, os.path.getsize(path), path)
+
+
+def sniff_data_kind(data):
+    """sniff_kind() for the contents of a file, e.g. one read from a packed archive."""
+    return _sniff(data[:8192], len(data), io.BytesIO(data))
+
+
+def _sniff(head, size, source):
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(source) as archive:
+                return "docx" if "word/document.xml" in archive.namelist() else None
+        except zipfile.BadZipFile:
+            return None
+    if b"\x00" in head or size > MAX_PLAIN_TEXT_BYTES:
+        return None
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample is fine
+        if e.start < len(head) - 4:
+            return None
+    return "text"
+
+
+def extract_pdf(path):
+    if pypdf is not None:
+        reader = pypdf.PdfReader(path)
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+    result = subprocess.run(["pdftotext", "-enc", "UTF-8", path, "-"], capture_output=True, check=True)
+    return result.stdout.decode("utf-8", errors="replace")
+
+
+def extract_docx(path):
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{DOCX_NAMESPACE}p"):
+        paragraphs.append("".join(node.text or "" for node in paragraph.iter(f"{DOCX_NAMESPACE}t")))
+    return "\n".join(paragraphs)
+
+
+def extract_plain(path):
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+EXTRACTORS = {"pdf": extract_pdf, "docx": extract_docx, "text": extract_plain}
+
+
+def extract_text(path):
+    """Return (kind, text) for a document, with text None if it can't be extracted.
+
+    A PDF without an available backend, or one that fails to parse, gives
+    ("pdf", None).
+    """
+    kind = sniff_kind(path)
+    if kind is None or (kind == "pdf" and pdf_backend() is None):
+        return kind, None
+    try:
+        return kind, EXTRACTORS[kind](path)
+    except Exception:
+        return kind, None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hash_worker(path):
+    """Pool worker: (path, size, mtime, sha256), or None if the file is gone."""
+    try:
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime, file_sha256(path)
+    except OSError:
+        return None
+
+
+def _extract_worker(item):
+    """Pool worker: (sha256, kind, text, backend) for a (sha256, path) pair."""
+    sha256, path = item
+    try:
+        kind, text = extract_text(path)
+    except OSError:
+        kind, text = None, None
+    return sha256, kind, text, pdf_backend() if kind == "pdf" else None
+
+
+def _needs_extraction(kind, text, backend):
+    """True for a PDF that was skipped for lack of a backend, now that one is installed."""
+    return kind == "pdf" and text is None and backend is None and pdf_backend() is not None
+
+
+def document_files(case_dir):
+    """The document files in a case directory: everything but details.txt and hidden files."""
+    try:
+        names = sorted(os.listdir(case_dir))
+    except OSError:
+        return []
+    return [os.path.join(case_dir, name) for name in names
+            if name != "details.txt" and not name.startswith(".") and os.path.isfile(os.path.join(case_dir, name))]
+
+
+class TextCache:
+    """Extracted document text for one archive directory, cached by content hash."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(output_dir, TEXT_CACHE_FILENAME), check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def _key(self, path):
+        return os.path.relpath(path, self.output_dir)
+
+    def cached_text(self, path):
+        """Return the cached text for a file if it is unchanged since it was extracted, else None."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT t.text FROM files f JOIN texts t ON t.sha256 = f.sha256 "
+                                    "WHERE f.path = ? AND f.size = ? AND f.mtime = ? AND t.text IS NOT NULL",
+                                    (self._key(path), stat.st_size, stat.st_mtime)).fetchone()
+        return row[0] if row else None
+
+    def extract_files(self, paths, executor=None):
+        """Extract the text of the given files that isn't cached yet, and return {path: text}.
+
+        Changed files are hashed, and files whose content hasn't been seen
+        before are extracted, through executor.map when an executor is given.
+        Files without extractable text are left out of the result.
+        """
+        mapper = executor.map if executor is not None else map
+        with self.lock:
+            stale = []
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                row = self.conn.execute("SELECT f.size, f.mtime, t.kind, t.text, t.backend FROM files f "
+                                        "LEFT JOIN texts t ON t.sha256 = f.sha256 WHERE f.path = ?",
+                                        (self._key(path),)).fetchone()
+                if row is None or row[:2] != (stat.st_size, stat.st_mtime) or _needs_extraction(*row[2:]):
+                    stale.append(path)
+
+        if stale:
+            hashed = [h for h in mapper(_hash_worker, stale) if h is not None]
+            with self.lock:
+                known = set()
+                for _, _, _, sha256 in hashed:
+                    row = self.conn.execute("SELECT kind, text, backend FROM texts WHERE sha256 = ?", (sha256,)).fetchone()
+                    if row and not _needs_extraction(*row):
+                        known.add(sha256)
+            todo = {}
+            for path, _, _, sha256 in hashed:
+                if sha256 not in known:
+                    todo.setdefault(sha256, path)
+            extracted = list(mapper(_extract_worker, todo.items())) if todo else []
+            with self.lock:
+                # Files without text are cached too, so they aren't read again; see _needs_extraction()
+                self.conn.executemany("INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?)", extracted)
+                self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                      [(self._key(path), size, mtime, sha256) for path, size, mtime, sha256 in hashed])
+                self.conn.commit()
+
+        texts = {}
+        for path in paths:
+            text = self.cached_text(path)
+            if text is not None:
+                texts[path] = text
+        return texts
+
+    def text_for(self, path):
+        """Return the text of one file, extracting and caching it if needed, or None."""
+        return self.extract_files([path]).get(path)
+
+    def extract_packed(self, documents, executor=None):
+        """Extract the text of packed documents that isn't cached yet, and return {sha256: text}.
+
+        documents maps the SHA-256 of each document, as recorded in the
+        segment index, to a function returning its contents. Documents not
+        seen before are written to temporary files for the extractors.
+        """
+        mapper = executor.map if executor is not None else map
+        with self.lock:
+            cached = {}
+            for sha256 in documents:
+                row = self.conn.execute("SELECT kind, text, backend FROM texts WHERE sha256 = ?", (sha256,)).fetchone()
+                if row and not _needs_extraction(*row):
+                    cached[sha256] = row[1]
+        todo = [sha256 for sha256 in documents if sha256 not in cached]
+        for i in range(0, len(todo), PACKED_SPOOL_BATCH):
+            with tempfile.TemporaryDirectory(prefix="text-extract-") as spool:
+                items = []
+                for sha256 in todo[i:i + PACKED_SPOOL_BATCH]:
+                    path = os.path.join(spool, sha256)
+                    with open(path, "wb") as f:
+                        f.write(documents[sha256]())
+                    items.append((sha256, path))
+                extracted = list(mapper(_extract_worker, items))
+            with self.lock:
+                # Documents without text are cached too, so they aren't read again; see _needs_extraction()
+                self.conn.executemany("INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?)", extracted)
+                self.conn.commit()
+            cached.update((sha256, text) for sha256, _, text, _ in extracted)
+        return {sha256: text for sha256, text in cached.items() if text is not None}
+
+    def close(self):
+        self.conn.close()
+
+
+def extract_archive(output_dir, processes=None, mp_context=None):
+    """Extract the text of every document in an archive and return (documents, with_text).
+
+    The processes are started with mp_context if given; pass a spawn or
+    forkserver context when calling from a multithreaded process.
+    """
+    paths = []
+    for root, dirs, files in os.walk(output_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        if "details.txt" in files:
+            paths.extend(document_files(root))
+            dirs[:] = []
+    packed, store = {}, None
+    if is_packed(output_dir):
+        store = SegmentStore(output_dir)
+        for case_dir, _, _ in store.cases():
+            for name, _, sha256 in store.case(case_dir)[1]:
+                if name != "details.txt":
+                    packed[sha256] = functools.partial(store.read, os.path.join(case_dir, name))
+    cache = TextCache(output_dir)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+        texts = cache.extract_files(paths, executor)
+        packed_texts = cache.extract_packed(packed, executor) if packed else {}
+    cache.close()
+    if store is not None:
+        store.close()
+    return len(paths) + len(packed), len(texts) + len(packed_texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract and cache the text of the documents in kommune archives.")
+    parser.add_argument("archives", nargs="+", help="Archive directories (e.g. archive-vagan).")
+    parser.add_argument("--processes", type=int, help="Extraction processes (default: one per CPU).")
+    args = parser.parse_args()
+
+    if pdf_backend() is None:
+        print("Warning: neither pypdf nor pdftotext is installed, so PDFs are skipped. Install pypdf with 'pip install pypdf'.")
+    for archive in args.archives:
+        if not os.path.isdir(archive):
+            print(f"Error: {archive} is not a directory")
+            continue
+        started = time.monotonic()
+        documents, with_text = extract_archive(archive, args.processes)
+        print(f"{archive}: text for {with_text} of {documents} documents in {time.monotonic() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()